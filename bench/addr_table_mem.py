@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Memory benchmark: string/set based processing of MAIL_FORWARDING (as done
+# before mkhost.addr_table) versus AddrTable, on a synthetic configuration.
+#
+# Usage: bench/addr_table_mem.py [EDGES] [FANOUT] [DOMAINS]
+#
+# Trade-off: AddrTable retains less than half the memory, but is built by
+# Python code (interning, hashing) rather than by set and dict builtins, and
+# takes about 2.5 times longer to build. For instance, with 500k edges
+# (without tracemalloc, which slows everything down): 35 MiB and 0.46 s
+# (before) versus 15 MiB and 1.1 s (after). The table is built when the
+# configuration cache misses (see mkhost.cfg_parser) and on every watch mode
+# reload.
+
+import copy
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import mkhost.addr_table
+import mkhost.common
+
+# Generates a synthetic configuration: (MAILBOXES, MAIL_FORWARDING).
+def gen_cfg(edges, fanout, ndomains):
+    mailboxes  = dict(("dom{}.example".format(d), ["user{}".format(i) for i in range(10)]) for d in range(ndomains))
+    forwarding = {}
+    for s in range(edges // fanout):
+        d = s % ndomains
+        forwarding["alias{}@dom{}.example".format(s, d)] = \
+            ["user{}@dom{}.example".format((s + k) % 10, (d + k) % ndomains) for k in range(fanout - 1)] + \
+            ["ext{}@remote{}.example".format(s, s % 1000)]
+    return (mailboxes, forwarding)
+
+# The structures built from MAIL_FORWARDING by mkhost before AddrTable.
+def before(mailboxes, forwarding):
+    mfwd     = copy.deepcopy(forwarding)                                            # write_valias_map
+    vals     = set(x for ys in map(mkhost.common.tolist, forwarding.values()) for x in ys)
+    outgoing = vals.difference(forwarding.keys())                                   # get_fwd_dst_addresses
+    keydoms  = mkhost.common.addr2dom(forwarding.keys())                            # get_alias_domains
+    vboxes   = set("{}@{}".format(x,d) for d, xs in mailboxes.items() for x in xs)  # get_virtual_mailboxes
+    return (mfwd, vals, outgoing, keydoms, vboxes)
+
+def after(mailboxes, forwarding):
+    return mkhost.addr_table.AddrTable.from_cfg(mailboxes, forwarding)
+
+def measure(name, fn, *args):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.monotonic()
+    x  = fn(*args)
+    t1 = time.monotonic()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<8} retained {:>10.1f} MiB, peak {:>10.1f} MiB, {:>7.2f}s".format(
+        name, current / 2**20, peak / 2**20, t1 - t0))
+    return x
+
+if __name__ == "__main__":
+    edges    = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    fanout   = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    ndomains = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+
+    print("edges: {}, fanout: {}, domains: {}".format(edges, fanout, ndomains))
+    cfg = measure("config", gen_cfg, edges, fanout, ndomains)
+    x   = measure("before", before, *cfg)
+    del x
+    y   = measure("after",  after,  *cfg)
+    print("addresses: {}, forwarding edges: {}".format(len(y), y.num_edges()))
@@ -5,13 +5,22 @@ import logging
 import os
 import sys
 
-import mkhost.cfg
-import mkhost.common
+import mkhost.bench
+import mkhost.calibrate
+import mkhost.context
 import mkhost.dovecot
+import mkhost.journal
 import mkhost.letsencrypt
+import mkhost.logstats
 import mkhost.opendkim
+import mkhost.plan
 import mkhost.postfix
+import mkhost.resolver
+import mkhost.storage
+import mkhost.systemd
 import mkhost.unix
+import mkhost.usage
+import mkhost.watch
 
 if __name__ == "__main__":
 
@@ -43,41 +52,200 @@ if __name__ == "__main__":
                         default=False,
                         help="dry run (no change)")
 
+    parser.add_argument("--log-detail",
+                        required=False,
+                        action="store_true",
+                        default=False,
+                        help="log every single mailbox, mapping etc. at INFO level (not just summary counts)")
+
+    parser.add_argument("--plan",
+                        required=False,
+                        action="store_true",
+                        default=False,
+                        help="print unified diffs and commands to run, then exit (no change); "
+                             "exit status is 2 if any change is planned")
+
+    parser.add_argument("--watch",
+                        required=False,
+                        action="store_true",
+                        default=False,
+                        help="after re-configuring this machine, keep watching the configuration file "
+                             "and apply mailbox, forwarding and domain changes incrementally")
+
+    parser.add_argument("--no-resume",
+                        required=False,
+                        action="store_true",
+                        default=False,
+                        help="run every stage, even those completed by the previous (failed) run")
+
     parser.add_argument("--verbose",
                         required=False,
                         action="store_true",
                         default=False,
                         help="verbose processing")
 
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND",
+                                       help="command to run (default: re-configure this machine)")
+
+    subparsers.add_parser("renew",
+                          help="renew Let's Encrypt certificate (if due) and reload Postfix and Dovecot "
+                               "if it has changed; nothing else is re-configured")
+
+    calibrate_parser = subparsers.add_parser("calibrate",
+                                             help="measure the login CPU cost of every password hash scheme "
+                                                  "on this machine; record the highest cost within the "
+                                                  "budget in the configuration file")
+    calibrate_parser.add_argument("--scheme",
+                                  required=False,
+                                  choices=sorted(mkhost.calibrate.SCHEMES),
+                                  help="password hash scheme to use; default: DOVECOT_PWD_SCHEME")
+    calibrate_parser.add_argument("--budget",
+                                  metavar="MS",
+                                  required=False,
+                                  type=int,
+                                  help="per-login CPU time budget (milliseconds); default: DOVECOT_PWD_BUDGET_MS")
+
+    logstats_parser = subparsers.add_parser("logstats",
+                                            help="report delivery delays, deferral reasons, TLS usage and "
+                                                 "authentication failures per domain (JSON), from the mail log "
+                                                 "lines logged since the previous run")
+    logstats_parser.add_argument("--log",
+                                 metavar="FILE",
+                                 required=False,
+                                 default="/var/log/mail.log",
+                                 help="mail log file (rotated files: FILE.1, FILE.2.gz...); default: %(default)s")
+    logstats_parser.add_argument("--all",
+                                 required=False,
+                                 action="store_true",
+                                 default=False,
+                                 help="read the whole log, rotated files included (ignore the saved position)")
+
+    subparsers.add_parser("migrate",
+                          help="migrate virtual mail to MAIL_STORAGE_FORMAT (resumable), then switch "
+                               "Dovecot and Postfix over to it")
+
+    bench_parser = subparsers.add_parser("bench",
+                                         help="benchmark this machine: concurrent SMTP transactions (to the "
+                                              "hosted mailboxes) and IMAP sessions; report throughput and "
+                                              "p50/p99 latency")
+    bench_parser.add_argument("--host",
+                              required=False,
+                              default="127.0.0.1",
+                              help="target host; default: %(default)s")
+    bench_parser.add_argument("--smtp-port",
+                              required=False,
+                              type=int,
+                              default=25,
+                              help="SMTP port (0: skip SMTP); default: %(default)s")
+    bench_parser.add_argument("--imap-port",
+                              required=False,
+                              type=int,
+                              default=143,
+                              help="IMAP port (0: skip IMAP); default: %(default)s")
+    bench_parser.add_argument("--count",
+                              required=False,
+                              type=int,
+                              default=1000,
+                              help="number of SMTP transactions and of IMAP sessions; default: %(default)s")
+    bench_parser.add_argument("--concurrency",
+                              required=False,
+                              type=int,
+                              default=50,
+                              help="max number of concurrent connections; default: %(default)s")
+    bench_parser.add_argument("--size",
+                              required=False,
+                              type=int,
+                              default=1024,
+                              help="message size (bytes); default: %(default)s")
+    bench_parser.add_argument("--credentials",
+                              metavar="FILE",
+                              required=False,
+                              help="IMAP credentials file (username:password lines); IMAP is skipped if none")
+    bench_parser.add_argument("--standin",
+                              required=False,
+                              action="store_true",
+                              default=False,
+                              help="benchmark built-in stand-in SMTP and IMAP servers (no Postfix or Dovecot needed)")
+
+    usage_parser = subparsers.add_parser("usage",
+                                         help="report mailbox storage usage (messages and bytes) "
+                                              "per mailbox and per domain")
+    usage_parser.add_argument("--format",
+                              required=False,
+                              choices=["json", "csv"],
+                              default="json",
+                              help="output format; default: %(default)s")
+
     # Parse command line arguments
     args = parser.parse_args()
+    if args.watch and (args.plan or args.command):
+        parser.error("--watch cannot be combined with --plan or a command")
 
     # Setup logging
     log_format = '[{asctime}] {levelname:8} {threadName:<14} {message}'
     logging.basicConfig(stream=sys.stderr, level=(logging.DEBUG if args.verbose else logging.INFO), format=log_format, style='{')
 
-    # Setup global variables
-    mkhost.common.set_verbose(args.verbose)
-    mkhost.common.set_dry_run(args.dry_run)
-    mkhost.common.set_non_interactive(args.batch)
-
-    # validate config
-    mkhost.cfg_parser.validate()
-
-    # Destructively re-configure the machine
-    logging.info("update system packages...")
-    mkhost.unix.update_pkgs()
-    logging.info("setup letsencrypt...")
-    mkhost.letsencrypt.install()
-    logging.info("setup opendkim...")
-    mkhost.opendkim.install()
-    logging.info("setup dovecot...")
-    mkhost.dovecot.install(args.doveconf, args.letsencrypt)
-    logging.info("setup postfix...")
-    mkhost.postfix.install(args.letsencrypt)
+    # Setup the run context (see mkhost.context)
+    ctx = mkhost.context.RunContext(dry_run=(args.dry_run or args.plan),
+                                    verbose=args.verbose,
+                                    non_interactive=args.batch,
+                                    log_detail=args.log_detail)
+
+    # Keep other runs out (except read-only ones)
+    if not (ctx.dry_run or args.command in ("bench", "logstats", "usage")):
+        mkhost.journal.lock(ctx)
+
+    # validate config (unless cached)
+    mkhost.cfg_parser.load(ctx)
+
+    # Run the given command, if any
+    if args.command == "renew":
+        mkhost.letsencrypt.renew(ctx, args.letsencrypt)
+        sys.exit(0)
+    elif args.command == "bench":
+        mkhost.bench.bench(ctx, args.host, args.smtp_port, args.imap_port, args.count, args.concurrency,
+                           args.size, args.credentials, args.standin)
+        sys.exit(0)
+    elif args.command == "calibrate":
+        mkhost.calibrate.calibrate(ctx, args.scheme, args.budget)
+        sys.exit(0)
+    elif args.command == "logstats":
+        mkhost.logstats.report(ctx, args.log, sys.stdout, args.all)
+        sys.exit(0)
+    elif args.command == "migrate":
+        mkhost.storage.migrate(ctx, args.doveconf, args.letsencrypt)
+        sys.exit(0)
+    elif args.command == "usage":
+        mkhost.usage.report(ctx, args.format, sys.stdout)
+        sys.exit(0)
+
+    # Print the plan of changes, if requested
+    if args.plan:
+        plan = mkhost.plan.make_plan(ctx, args.doveconf, args.letsencrypt)
+        print(plan)
+        sys.exit(2 if plan else 0)
+
+    # Destructively re-configure the machine (resuming the previous run, if incomplete)
+    mkhost.journal.run(ctx,
+                       [("system packages", mkhost.unix.update_pkgs,    ()),
+                        ("storage",         mkhost.storage.install,     ()),
+                        ("resolver",        mkhost.resolver.install,    ()),
+                        ("letsencrypt",     mkhost.letsencrypt.install, (args.letsencrypt,)),
+                        ("opendkim",        mkhost.opendkim.install,    ()),
+                        ("dovecot",         mkhost.dovecot.install,     (args.doveconf, args.letsencrypt)),
+                        ("postfix",         mkhost.postfix.install,     (args.letsencrypt,)),
+                        ("systemd",         mkhost.systemd.install,     ())],
+                       resume=not args.no_resume)
 
     # Print DNS log
-    if mkhost.common._dns_log:
-        logging.warning("List of DNS changes to apply:{}{}".format(2 * os.linesep, mkhost.common._dns_log))
+    if ctx.dns_log:
+        logging.warning("List of DNS changes to apply:{}{}".format(2 * os.linesep, ctx.dns_log))
     else:
         logging.info("No DNS changes to apply")
+
+    # Keep applying configuration changes, if requested
+    if args.watch:
+        try:
+            mkhost.watch.watch(ctx, args.letsencrypt)
+        except KeyboardInterrupt:
+            logging.info("[watch] interrupted")
@@ -0,0 +1,177 @@
+import array
+import zlib
+
+# Compact table of e-mail addresses: hosted mailboxes and mail forwarding
+# edges.
+#
+# Domains are interned to integer ids. Local parts are stored (UTF-8) in a
+# single byte buffer, and every address (domain id + local part) gets an
+# integer id through an open addressing hash index kept in an array. The hash
+# function (CRC-32) does not depend on the process, so that a pickled table
+# is valid as is (see the config cache in mkhost.cfg_parser). The hash of every
+# address is kept, so that neither probing nor growing the index hashes again.
+# Forwarding edges are kept in array-backed adjacency lists (CSR: a source
+# index points to a slice of the target array). Thus, memory is spent on
+# machine integers and bytes rather than on Python objects, and addresses are
+# turned back into strings on output only.
+#
+# All the ids are array('I') items (unsigned, at least 32 bits).
+class AddrTable:
+    def __init__(self):
+        self._domains     = []                     # domain id => domain
+        self._domain_ids  = {}                     # domain => domain id
+        self._locals      = bytearray()            # local parts (UTF-8), concatenated
+        self._addr_local  = array.array('I', [0])  # address id => local part offset in _locals (+ sentinel)
+        self._addr_domain = array.array('I')       # address id => domain id
+        self._addr_hash   = array.array('I')       # address id => hash (CRC-32 of local part, seeded with domain id)
+        self._slots       = array.array('i', [-1]) * 8   # hash index: slot => address id (-1 if empty)
+        self._src_index   = array.array('i')       # address id => source index (-1 if none)
+        self._mailbox     = bytearray()            # address id => 1 if a hosted mailbox, 0 otherwise
+        self._src         = array.array('I')       # source index => address id
+        self._offsets     = array.array('I', [0])  # source index => 1st target offset in _dst
+        self._dst         = array.array('I')       # forwarding targets (address ids)
+
+    # Builds a table from MAILBOXES and MAIL_FORWARDING dictionaries
+    # (see cfg.py).
+    @classmethod
+    def from_cfg(cls, mailboxes, forwarding):
+        table = cls()
+        for (d, xs) in mailboxes.items():
+            for x in xs:
+                table.add_mailbox("{}@{}".format(x, d))
+        for (x, ys) in forwarding.items():
+            table.add_forwarding(x, ys if isinstance(ys, list) else [ys])
+        return table
+
+    def _local(self, i):
+        return self._locals[self._addr_local[i]:self._addr_local[i + 1]]
+
+    # Returns the hash index slot of the given address (h: its hash): either
+    # the slot holding its id, or the empty slot where it belongs.
+    def _find_slot(self, domain_id, local, h):
+        (slots, hashes, offsets, domains, locals_) = \
+            (self._slots, self._addr_hash, self._addr_local, self._addr_domain, self._locals)
+        mask = len(slots) - 1
+        j    = h & mask
+        while True:
+            i = slots[j]
+            if (i < 0) or ((hashes[i] == h) and (domains[i] == domain_id) and
+                           (locals_[offsets[i]:offsets[i + 1]] == local)):
+                return j
+            j = (j + 1) & mask
+
+    # Doubles the hash index size. Addresses are distinct: each one goes to
+    # the first empty slot (from its stored hash).
+    def _grow(self):
+        slots = array.array('i', [-1]) * (2 * len(self._slots))
+        mask  = len(slots) - 1
+        for (i, h) in enumerate(self._addr_hash):
+            j = h & mask
+            while slots[j] >= 0:
+                j = (j + 1) & mask
+            slots[j] = i
+        self._slots = slots
+
+    # Returns the id of the given address; adds the address if missing.
+    # (The hash index is probed inline: this is the hot path of a build.)
+    def intern(self, addr):
+        (local, _, domain) = addr.partition('@')
+        local = local.encode()
+        d     = self._domain_ids.get(domain)
+        if d is None:
+            d = self._domain_ids[domain] = len(self._domains)
+            self._domains.append(domain)
+
+        (slots, hashes, offsets, domains, locals_) = \
+            (self._slots, self._addr_hash, self._addr_local, self._addr_domain, self._locals)
+        h    = zlib.crc32(local, d)
+        mask = len(slots) - 1
+        j    = h & mask
+        while True:
+            i = slots[j]
+            if i < 0:
+                break
+            if (hashes[i] == h) and (domains[i] == d) and (locals_[offsets[i]:offsets[i + 1]] == local):
+                return i
+            j = (j + 1) & mask
+
+        i = slots[j] = len(domains)
+        locals_.extend(local)
+        offsets.append(len(locals_))
+        domains.append(d)
+        hashes.append(h)
+        self._src_index.append(-1)
+        self._mailbox.append(0)
+        if 2 * (i + 1) > len(slots):
+            self._grow()
+        return i
+
+    # Returns the id of the given address, or None if not in the table.
+    def lookup(self, addr):
+        (local, _, domain) = addr.partition('@')
+        d = self._domain_ids.get(domain)
+        if d is None:
+            return None
+        local = local.encode()
+        i     = self._slots[self._find_slot(d, local, zlib.crc32(local, d))]
+        return None if (i < 0) else i
+
+    def add_mailbox(self, addr):
+        self._mailbox[self.intern(addr)] = 1
+
+    # Adds a forwarding entry: source address => list of target addresses.
+    def add_forwarding(self, src, dsts):
+        i = self.intern(src)
+        if self._src_index[i] >= 0:
+            raise Exception("Duplicate forwarding source address: {}".format(src))
+        self._src_index[i] = len(self._src)
+        self._src.append(i)
+        self._dst.extend(self.intern(x) for x in dsts)
+        self._offsets.append(len(self._dst))
+
+    # Given an address id, returns the address string.
+    def addr(self, i):
+        return "{}@{}".format(self._local(i).decode(), self._domains[self._addr_domain[i]])
+
+    # Given an address id, returns the domain string.
+    def domain(self, i):
+        return self._domains[self._addr_domain[i]]
+
+    def is_mailbox(self, i):
+        return bool(self._mailbox[i])
+
+    # Given an address id, returns its source index, or -1 if the address is
+    # not forwarded.
+    def source_index(self, i):
+        return self._src_index[i]
+
+    # Given a source index, returns the source address id.
+    def source(self, si):
+        return self._src[si]
+
+    # Given a source index, returns the target address ids (an array).
+    def targets(self, si):
+        return self._dst[self._offsets[si]:self._offsets[si + 1]]
+
+    def num_sources(self):
+        return len(self._src)
+
+    def num_edges(self):
+        return len(self._dst)
+
+    # Returns the set of domains of the forwarding source addresses.
+    def source_domains(self):
+        ids = set(self._addr_domain[i] for i in self._src)
+        return set(self._domains[d] for d in ids)
+
+    # Returns the ids of the outgoing addresses (forwarding targets which are
+    # not forwarding sources themselves), in order of first appearance.
+    def outgoing(self):
+        seen = bytearray(len(self))
+        for i in self._dst:
+            if (not seen[i]) and (self._src_index[i] < 0):
+                seen[i] = 1
+                yield i
+
+    def __len__(self):
+        return len(self._addr_domain)
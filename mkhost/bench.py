@@ -0,0 +1,274 @@
+import asyncio
+import email.utils
+import logging
+import math
+import time
+
+import mkhost.cfg_parser
+import mkhost.log
+
+##############################################################################
+# Load generator: concurrent SMTP transactions and IMAP sessions against this
+# machine (or against built-in stand-in servers, for testing without Postfix
+# and Dovecot), with throughput and latency percentiles.
+#
+# Note: SMTP transactions deliver real messages to the hosted mailboxes.
+##############################################################################
+
+# Returns the recipient addresses to send to: the hosted mailboxes, and the
+# forwarding addresses which expand to hosted mailboxes only (mail is never
+# sent out of this machine).
+def recipients(ctx):
+    table = mkhost.cfg_parser.get_addr_table(ctx)
+    local = {}      # address id => True if delivered locally only
+
+    def is_local(i, path):
+        if i not in local:
+            si = table.source_index(i)
+            if si < 0:
+                local[i] = table.is_mailbox(i)
+            elif i in path:
+                local[i] = False    # forwarding loop
+            else:
+                path.add(i)
+                local[i] = all(is_local(j, path) for j in table.targets(si))
+                path.discard(i)
+        return local[i]
+
+    return sorted(table.addr(i) for i in range(len(table)) if is_local(i, set()))
+
+# Reads IMAP credentials: a file of "username:password" lines.
+# Returns a list of pairs.
+def read_credentials(path):
+    with open(path) as f:
+        return [tuple(x.rstrip("\r\n").split(":", 1)) for x in f if ":" in x]
+
+# Returns the p-th percentile (nearest rank) of the given sorted list.
+def percentile(xs, p):
+    return xs[max(0, math.ceil(p / 100 * len(xs)) - 1)]
+
+# Latency samples of a kind of operation.
+class Stats:
+    def __init__(self, name):
+        self.name    = name
+        self.samples = []       # latencies (seconds)
+        self.errors  = 0
+        self.elapsed = 0.0      # wall clock time (seconds)
+
+    def __str__(self):
+        if not self.samples:
+            return "{:<5} {} ok, {} errors".format(self.name, 0, self.errors)
+        xs = sorted(self.samples)
+        return "{:<5} {} ok, {} errors, {:.1f}/s, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+            self.name, mkhost.log.fmt_count(len(xs)), self.errors, len(xs) / self.elapsed,
+            1000 * percentile(xs, 50), 1000 * percentile(xs, 99), 1000 * xs[-1])
+
+##############################################################################
+# Clients
+##############################################################################
+
+# Reads an SMTP reply (possibly multi-line); raises an error unless the reply
+# code is the expected one.
+async def smtp_reply(reader, code):
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("SMTP connection closed")
+        if line[3:4] != b'-':
+            break
+    if not line.startswith(code):
+        raise Exception("SMTP: unexpected reply: {}".format(line.decode(errors="replace").rstrip()))
+
+# Runs an SMTP transaction: a single message to the given recipient.
+async def smtp_send(host, port, sender, rcpt, body):
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        await smtp_reply(reader, b'220')
+        for (cmd, code) in ((b'EHLO localhost\r\n',                          b'250'),
+                            ('MAIL FROM:<{}>\r\n'.format(sender).encode(),   b'250'),
+                            ('RCPT TO:<{}>\r\n'.format(rcpt).encode(),       b'250'),
+                            (b'DATA\r\n',                                    b'354'),
+                            (body,                                           b'250'),
+                            (b'QUIT\r\n',                                    b'221')):
+            writer.write(cmd)
+            await smtp_reply(reader, code)
+    finally:
+        writer.close()
+
+# Sends an IMAP command; reads the response up to the tagged status line,
+# which must be OK.
+# Returns the untagged response lines.
+async def imap_cmd(reader, writer, tag, cmd):
+    writer.write("{} {}\r\n".format(tag, cmd).encode())
+    prefix = "{} ".format(tag).encode()
+    lines  = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("IMAP connection closed")
+        if line.startswith(prefix):
+            break
+        lines.append(line)
+    if not line.startswith(prefix + b'OK'):
+        raise Exception("IMAP: {}".format(line.decode(errors="replace").rstrip()))
+    return lines
+
+# Runs an IMAP session: login, select INBOX, fetch the flags of all the
+# messages (if any), logout.
+async def imap_session(host, port, username, password):
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        if not (await reader.readline()).startswith(b'* OK'):
+            raise Exception("IMAP: bad greeting")
+        await imap_cmd(reader, writer, "a1", 'LOGIN "{}" "{}"'.format(username, password))
+        selected = await imap_cmd(reader, writer, "a2", "SELECT INBOX")
+        if not any(x.startswith(b'* 0 EXISTS') for x in selected):
+            await imap_cmd(reader, writer, "a3", "FETCH 1:* (FLAGS)")
+        await imap_cmd(reader, writer, "a4", "LOGOUT")
+    finally:
+        writer.close()
+
+# Runs count operations (coroutine functions of an operation number) with
+# the given concurrency; records the results in the given Stats object.
+async def run_ops(stats, op, count, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def timed(i):
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                await op(i)
+                stats.samples.append(time.perf_counter() - t0)
+            except Exception as e:
+                stats.errors += 1
+                if stats.errors <= 3:
+                    logging.warning("[bench] {} #{}: {}".format(stats.name, i, e))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(count)))
+    stats.elapsed = time.perf_counter() - t0
+
+##############################################################################
+# Stand-in servers: minimal SMTP and IMAP responders, which accept everything.
+##############################################################################
+
+async def standin_smtp(reader, writer):
+    writer.write(b'220 mkhost stand-in ESMTP\r\n')
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        verb = line[:4].upper()
+        if verb == b'DATA':
+            writer.write(b'354 go ahead\r\n')
+            while (await reader.readline()) not in (b'.\r\n', b''):
+                pass
+            writer.write(b'250 queued\r\n')
+        elif verb == b'QUIT':
+            writer.write(b'221 bye\r\n')
+            break
+        elif verb in (b'EHLO', b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+            writer.write(b'250 ok\r\n')
+        else:
+            writer.write(b'502 not implemented\r\n')
+    await writer.drain()
+    writer.close()
+
+async def standin_imap(reader, writer):
+    writer.write(b'* OK mkhost stand-in IMAP\r\n')
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        (tag, _, rest) = line.decode(errors="replace").strip().partition(' ')
+        cmd = rest.split(' ', 1)[0].upper()
+        if cmd == "SELECT":
+            writer.write(b'* 2 EXISTS\r\n')
+        elif cmd == "FETCH":
+            writer.write(b'* 1 FETCH (FLAGS (\\Seen))\r\n* 2 FETCH (FLAGS ())\r\n')
+        elif cmd == "LOGOUT":
+            writer.write(b'* BYE\r\n')
+        elif cmd not in ("LOGIN", "CAPABILITY", "NOOP"):
+            writer.write("{} BAD unknown command\r\n".format(tag).encode())
+            continue
+        writer.write("{} OK done\r\n".format(tag).encode())
+        if cmd == "LOGOUT":
+            break
+    await writer.drain()
+    writer.close()
+
+##############################################################################
+# Benchmark
+##############################################################################
+
+# Runs the benchmark; prints the results to stdout.
+#
+# Params:
+#   host        : target host
+#   smtp_port   : SMTP port (0: skip SMTP)
+#   imap_port   : IMAP port (0: skip IMAP)
+#   count       : number of SMTP transactions and IMAP sessions, each
+#   concurrency : max number of concurrent connections
+#   size        : message body size (bytes)
+#   credentials : IMAP credentials file (see read_credentials), or None
+#   standin     : if True, benchmark built-in stand-in servers (host and ports are ignored)
+def bench(ctx, host="127.0.0.1", smtp_port=25, imap_port=143, count=1000, concurrency=50, size=1024,
+          credentials=None, standin=False):
+    async def main():
+        nonlocal host, smtp_port, imap_port
+        servers = []
+        if standin:
+            for h in (standin_smtp, standin_imap):
+                servers.append(await asyncio.start_server(h, "127.0.0.1", 0))
+            host      = "127.0.0.1"
+            smtp_port = servers[0].sockets[0].getsockname()[1]
+            imap_port = servers[1].sockets[0].getsockname()[1]
+            logging.info("[bench] stand-in servers: SMTP port {}, IMAP port {}".format(smtp_port, imap_port))
+
+        results = []
+        try:
+            rcpts = recipients(ctx)
+            if smtp_port and rcpts:
+                sender = "bench@{}".format(ctx.cfg.MY_HOST_FULLNAME)
+
+                async def send(i):
+                    rcpt = rcpts[i % len(rcpts)]
+                    body = "\r\n".join([
+                               "From: <{}>".format(sender),
+                               "To: <{}>".format(rcpt),
+                               "Subject: mkhost bench {}".format(i),
+                               "Date: {}".format(email.utils.formatdate()),
+                               "Message-ID: {}".format(email.utils.make_msgid("bench")),
+                               "",
+                               ("x" * 76 + "\r\n") * (size // 78) + "\r\n.\r\n"])
+                    await smtp_send(host, smtp_port, sender, rcpt, body.encode())
+
+                logging.info("[bench] SMTP: {} transactions to {} recipients".format(
+                    mkhost.log.fmt_count(count), mkhost.log.fmt_count(len(rcpts))))
+                results.append(Stats("smtp"))
+                await run_ops(results[-1], send, count, concurrency)
+            elif smtp_port:
+                logging.warning("[bench] SMTP: no local recipient address, skipping")
+
+            if credentials:
+                creds = read_credentials(credentials)
+            else:
+                creds = [("bench", "bench")] if standin else []
+            if imap_port and creds:
+                async def session(i):
+                    await imap_session(host, imap_port, *creds[i % len(creds)])
+
+                logging.info("[bench] IMAP: {} sessions of {} users".format(
+                    mkhost.log.fmt_count(count), mkhost.log.fmt_count(len(creds))))
+                results.append(Stats("imap"))
+                await run_ops(results[-1], session, count, concurrency)
+            elif imap_port:
+                logging.warning("[bench] IMAP: no credentials (see --credentials), skipping")
+        finally:
+            for s in servers:
+                s.close()
+                await s.wait_closed()
+        return results
+
+    for x in asyncio.run(main()):
+        print(x)
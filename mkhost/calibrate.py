@@ -0,0 +1,145 @@
+import logging
+import math
+import os
+import re
+import statistics
+import time
+
+import mkhost.cmd
+import mkhost.dovecot
+import mkhost.log
+
+##############################################################################
+# Password hash calibration: measures, on this machine, the time Dovecot takes
+# to verify a password (i.e. the CPU cost of a single IMAP/POP3/SMTP login)
+# for each password scheme, and picks the highest cost within the per-login
+# budget (DOVECOT_PWD_BUDGET_MS).
+#
+# The chosen scheme and cost are recorded in the configuration file
+# (DOVECOT_PWD_SCHEME, DOVECOT_PWD_ROUNDS). Every hash is self-describing
+# (scheme and cost are part of it): existing hashes keep verifying as they are,
+# new ones (new users, password changes) are made with the new parameters.
+#
+# https://doc.dovecot.org/configuration_manual/authentication/password_schemes/
+##############################################################################
+
+# Password schemes: (min cost, max cost, reference cost, cost model), where
+# the cost is the doveadm pw -r argument, and the model tells how the time
+# grows with it: "linear" (rounds) or "exp2" (log2 of rounds).
+SCHEMES = {
+    "SHA512-CRYPT" : (1000, 999999999, 5000, "linear"),
+    "BLF-CRYPT"    : (4,    31,        5,    "exp2"),
+    "ARGON2ID"     : (1,    10000,     1,    "linear"),
+}
+
+SAMPLES = 5     # time measurements per cost setting (median)
+
+# Returns the password schemes supported by doveadm.
+def available_schemes():
+    (out_lines, _) = mkhost.cmd.execute_cmd_batch(["doveadm", "pw", "-l"])
+    return set(" ".join(out_lines).split())
+
+# Runs the given command SAMPLES times (see mkhost.cmd.execute_cmd_batch).
+# Returns the median wall clock time (seconds).
+def time_cmd(cmdline):
+    ts = []
+    for _ in range(SAMPLES):
+        t0 = time.perf_counter()
+        mkhost.cmd.execute_cmd_batch(cmdline)
+        ts.append(time.perf_counter() - t0)
+    return statistics.median(ts)
+
+# Measures the time Dovecot takes to verify a password hashed with the given
+# scheme and cost, less the time doveadm takes to start (as measured by
+# verifying a plaintext password).
+# Returns the time (seconds).
+def measure(ctx, scheme, rounds, baseline):
+    pwd  = mkhost.dovecot.gen_pwd()
+    hash = mkhost.cmd.execute_cmd_batch(mkhost.dovecot.pwd_hash_cmd(ctx, scheme, rounds) + ["-p", pwd])[0][0].strip()
+    t = max(0.0, time_cmd(["doveadm", "pw", "-t", hash, "-p", pwd]) - baseline)
+    mkhost.log.debug("[calibrate] {} cost {}: {:.1f} ms", scheme, rounds, 1000 * t)
+    return t
+
+# Returns the cost expected to take the target time, given the time t
+# measured at the given cost.
+def extrapolate(model, rounds, t, target):
+    if model == "exp2":
+        return (rounds + math.floor(math.log2(target / t))) if t else (rounds + 1)
+    return math.floor(rounds * target / t) if t else (2 * rounds)
+
+# Finds the highest cost of the given scheme within the given budget (seconds).
+# Returns a pair: (cost, time), or None if even the lowest cost exceeds the
+# budget.
+def calibrate_scheme(ctx, scheme, budget, baseline):
+    (lo, hi, ref, model) = SCHEMES[scheme]
+    target      = 0.9 * budget      # margin for load and measurement noise
+    (rounds, t) = (ref, measure(ctx, scheme, ref, baseline))
+
+    for _ in range(4):
+        x = min(hi, max(lo, extrapolate(model, rounds, t, target)))
+        if x == rounds:
+            break
+        (rounds, t) = (x, measure(ctx, scheme, x, baseline))
+
+    return (rounds, t) if (t <= budget) else None
+
+# Replaces the values of the given settings in the configuration file
+# (assignments at the beginning of a line), and in the configuration of the
+# given run context.
+#
+# Params:
+#   settings : dictionary: setting name => value
+def record_cfg(ctx, settings):
+    path = ctx.cfg.__file__
+    with open(path) as f:
+        text = f.read()
+    for (k, v) in settings.items():
+        value = '"{}"'.format(v) if isinstance(v, str) else repr(v)
+        (text, n) = re.subn(r'^({}\s*=\s*).*$'.format(k), lambda m: m.group(1) + value, text, flags=re.MULTILINE)
+        if n != 1:
+            raise Exception("{}: cannot record {} (found {} assignments)".format(path, k, n))
+        setattr(ctx.cfg, k, v)
+
+    logging.info("[calibrate] recording {} in {}".format(
+        ", ".join("{} = {}".format(k, v) for (k, v) in settings.items()), path))
+    if not ctx.dry_run:
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+# Calibrates every available password scheme against the per-login budget;
+# prints the results, and records the cost of the chosen scheme in the
+# configuration file (except in dry run mode).
+#
+# Params:
+#   scheme    : password scheme to use (default: DOVECOT_PWD_SCHEME)
+#   budget_ms : per-login CPU budget (milliseconds; default: DOVECOT_PWD_BUDGET_MS)
+def calibrate(ctx, scheme=None, budget_ms=None):
+    scheme    = scheme    or ctx.cfg.DOVECOT_PWD_SCHEME
+    budget_ms = budget_ms or ctx.cfg.DOVECOT_PWD_BUDGET_MS
+    budget    = budget_ms / 1000
+
+    available = available_schemes()
+    if scheme not in available:
+        raise Exception("password scheme not supported by Dovecot: {} (see: doveadm pw -l)".format(scheme))
+
+    baseline = time_cmd(["doveadm", "pw", "-t", "{PLAIN}x", "-p", "x"])
+    logging.info("[calibrate] per-login budget {} ms; doveadm start-up time {:.1f} ms (deducted)".format(
+        budget_ms, 1000 * baseline))
+
+    results = {}
+    for x in sorted(SCHEMES):
+        if x not in available:
+            print("{:<13} not supported".format(x))
+            continue
+        results[x] = calibrate_scheme(ctx, x, budget, baseline)
+        if results[x] is None:
+            print("{:<13} over budget at the lowest cost ({})".format(x, SCHEMES[x][0]))
+        else:
+            print("{:<13} cost {:>9}: {:6.1f} ms/login{}".format(
+                x, results[x][0], 1000 * results[x][1], "  <= chosen" if (x == scheme) else ""))
+
+    if results.get(scheme) is None:
+        raise Exception("{}: no cost setting within {} ms per login".format(scheme, budget_ms))
+
+    record_cfg(ctx, {"DOVECOT_PWD_SCHEME": scheme, "DOVECOT_PWD_ROUNDS": results[scheme][0]})
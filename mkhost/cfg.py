@@ -33,6 +33,35 @@ MY_HOST_FULLNAME = (MY_HOST_NAME + "." + MY_HOST_DOMAIN)
 # E-mail address to use with the SSL/TLS certificate.
 X509_EMAIL = ("x509" + "@" + MY_HOST_FULLNAME)
 
+# If set, the SSL/TLS certificate will also cover the mail hostname of every
+# mailbox domain, in a single (SAN) certificate: X509_MAIL_HOST_PREFIX . domain
+# (for example: mail.b-server). Those names must resolve to this machine.
+# Set to None to cover MY_HOST_FULLNAME only.
+X509_MAIL_HOST_PREFIX = None
+
+# Key type of the SSL/TLS certificate:
+#
+#   None    : keep the key type of the current certificate (new certificates:
+#             certbot default)
+#   "ecdsa" : ECDSA P-256 key; smaller certificate, much cheaper handshakes
+#   "rsa"   : RSA key, for very old clients
+#
+# Setting this to a key type other than that of the current certificate
+# replaces the certificate on the next run.
+X509_KEY_TYPE = None
+
+# TLS session cache: lookup table type of the Postfix session caches ("btree",
+# or "lmdb"), and the time to live of cached sessions (seconds), in Postfix
+# and Dovecot. Repeat clients resume their session: no full handshake.
+#
+# http://www.postfix.org/TLS_README.html#server_tls_cache
+TLS_SESSION_CACHE_TYPE    = "btree"
+TLS_SESSION_CACHE_TIMEOUT = 3600
+
+# Skip certbot if the current certificate is still valid for at least that many
+# days (and covers all the required names).
+X509_RENEW_DAYS = 30
+
 # List of mailboxes (per domain).
 MAILBOXES = {
     "b-server": ["user1", "user2"],
@@ -76,6 +105,40 @@ VIRTUAL_MAIL_USER = 'mkhost-mailv'
 # http://www.postfix.org/postconf.5.html#virtual_mailbox_base
 VIRTUAL_MAILBOX_BASE = "/var/mail-virtual/"
 
+# Directory where the mail of removed virtual mailboxes (no longer declared in
+# MAILBOXES) is moved to, as: domain/user.timestamp. Archiving is confirmed
+# first in interactive mode, and never done in watch mode.
+VIRTUAL_MAILBOX_ARCHIVE = "/var/mail-virtual-archive/"
+
+# Virtual mailbox storage format:
+#
+#   "maildir" : one file per message (delivered by Postfix)
+#   "sdbox"   : Dovecot single-dbox, one file per message, with indexes (delivered by Dovecot)
+#   "mdbox"   : Dovecot multi-dbox, many messages per file (delivered by Dovecot); best for
+#               very large mailboxes: fewer inodes, faster directory scans
+#
+# Changing this on a machine with existing mail requires a migration:
+#
+#   mkhost.py migrate
+#
+# https://doc.dovecot.org/admin_manual/mailbox_formats/
+MAIL_STORAGE_FORMAT = "maildir"
+
+# Virtual mail delivery agent:
+#
+#   "virtual" : Postfix virtual(8) delivers maildirs; other storage formats are
+#               delivered by Dovecot LDA
+#   "lmtp"    : Dovecot LMTP delivers all formats and updates mailbox indexes
+#               on delivery (faster IMAP SELECT on large mailboxes)
+#
+# https://doc.dovecot.org/configuration_manual/protocols/lmtp_server/
+MAIL_DELIVERY = "virtual"
+
+# Storage format migration: number of mailboxes copied in parallel, and the
+# load average above which the migration pauses (None: number of CPUs).
+MAIL_MIGRATE_CONCURRENCY = 4
+MAIL_MIGRATE_MAX_LOAD    = None
+
 # List of mail protocols to enable in Dovecot. This is mapped directly to
 # https://doc.dovecot.org/settings/core/#protocols
 DOVECOT_PROTOCOLS = ["imap", "pop3"]
@@ -89,6 +152,41 @@ DOVECOT_LOOPBACK_ONLY = False
 # Dovecot users database
 DOVECOT_USERS_DB = "/etc/dovecot/users.mkhost"
 
+# Virtual user password hash scheme, and its cost (doveadm pw -r: rounds for
+# SHA512-CRYPT and ARGON2ID, log2 of rounds for BLF-CRYPT; None: Dovecot
+# default). The cost is the CPU time of every login: both are best set with
+#
+#   mkhost.py calibrate
+#
+# Existing password hashes are left as they are; new ones use these settings.
+DOVECOT_PWD_SCHEME = "SHA512-CRYPT"
+DOVECOT_PWD_ROUNDS = None
+
+# Per-login CPU time budget (milliseconds) the password hash cost is
+# calibrated for.
+DOVECOT_PWD_BUDGET_MS = 50
+
+# Dovecot authentication cache size (None: no cache), and time to live.
+#
+# https://doc.dovecot.org/configuration_manual/authentication/caching/
+DOVECOT_AUTH_CACHE_SIZE = "10M"
+DOVECOT_AUTH_CACHE_TTL  = "1 hour"
+
+# Backend of the virtual users (Dovecot) and of the virtual mailbox and alias
+# maps (Postfix):
+#
+#   "files"  : DOVECOT_USERS_DB (passwd-file), POSTFIX_VIRTUAL_MAILBOX_MAP and
+#              POSTFIX_VIRTUAL_ALIAS_MAP (hash tables); every change rewrites,
+#              rebuilds (postmap) and reloads whole files
+#   "sqlite" : a single SQLite database (MAIL_DB), updated row by row and
+#              queried directly by Dovecot and Postfix; best for many users
+#
+# Switching from "files" to "sqlite" keeps the existing passwords.
+MAIL_BACKEND = "files"
+
+# SQLite database of virtual users, mailboxes and aliases (see MAIL_BACKEND).
+MAIL_DB = "/etc/mkhost/mail.sqlite"
+
 # Postfix virtual mailbox map file.
 #
 # http://www.postfix.org/postconf.5.html#virtual_mailbox_maps
@@ -99,9 +197,81 @@ POSTFIX_VIRTUAL_MAILBOX_MAP = "/etc/postfix/vmailbox.mkhost"
 # http://www.postfix.org/postconf.5.html#virtual_alias_maps
 POSTFIX_VIRTUAL_ALIAS_MAP = "/etc/postfix/valias.mkhost"
 
+# Whether Postfix postscreen(8) should screen inbound SMTP connections (port
+# 25): bots are dropped by a single postscreen process, before any smtpd
+# process is started for them. Enabling this moves port 25 from smtpd to
+# postscreen on the next run.
+#
+# http://www.postfix.org/POSTSCREEN_README.html
+POSTFIX_POSTSCREEN = False
+
+# DNS blocklists checked by postscreen (site=reply filter*weight), and the
+# weighted sum of listings above which a client is rejected. The reply filters
+# only count actual listings: Spamhaus answers 127.255.255.x to the queries it
+# refuses (e.g. coming through public resolvers, see RESOLVER_LOCAL).
+#
+# http://www.postfix.org/postconf.5.html#postscreen_dnsbl_sites
+POSTFIX_POSTSCREEN_DNSBL_SITES     = ["zen.spamhaus.org=127.0.0.[2..11]*2", "bl.spamcop.net=127.0.0.2*1"]
+POSTFIX_POSTSCREEN_DNSBL_THRESHOLD = 2
+
+# Max number of Postfix submission (port 587, authenticated users) processes.
+# Submission has its own process pool, not shared with inbound SMTP (port 25).
+# Set to 0 to disable submission.
+POSTFIX_SUBMISSION_MAXPROC = 20
+
+# Whether to install systemd drop-ins (/etc/systemd/system/<unit>.d/mkhost.conf)
+# for Postfix, Dovecot and OpenDKIM: open file and task limits sized from this
+# machine (memory, CPUs), CPU and IO weights, and CPU affinity (optional).
+# Enabling this (or changing the drop-ins later) restarts the running services
+# whose drop-in has changed (systemctl try-restart), on the next run.
+SYSTEMD_DROPINS = False
+
+# CPU and IO weights (1-10000, systemd default: 100) of the mail services, i.e.
+# their shares of CPU time and disk bandwidth when they compete for it: IMAP
+# and POP3 users come first, mail signing and delivery can wait a little.
+SYSTEMD_CPU_WEIGHT = {"postfix": 100, "dovecot": 200, "opendkim": 100}
+SYSTEMD_IO_WEIGHT  = {"postfix": 100, "dovecot": 200, "opendkim": 50}
+
+# CPUs the mail services are pinned to (systemd CPUAffinity syntax, e.g.
+# "0-3"); services not listed may run on any CPU.
+SYSTEMD_CPU_AFFINITY = {}
+
+# Whether to set up a local caching DNS resolver (unbound, on the loopback
+# interface) for this machine and Postfix: MX and DNS blocklist lookups are
+# answered from the cache. The system resolver (/etc/resolv.conf) is pointed at
+# it once it has answered a test query.
+RESOLVER_LOCAL = False
+
 # Directory where OpenDKIM will store domain keys.
 OPENDKIM_KEYS = "/etc/opendkim/mkhost/"
 
+# Directory where mkhost keeps its own state (digests, caches...).
+MKHOST_STATE_DIR = "/var/lib/mkhost/"
+
 # OpenDKIM config file
-OPENDKIM_CONF     = "/etc/opendkim.conf"
-OPENDKIM_KEYTABLE = "/etc/opendkim-keytable.mkhost"
+OPENDKIM_CONF         = "/etc/opendkim.conf"
+OPENDKIM_KEYTABLE     = "/etc/opendkim-keytable.mkhost"
+OPENDKIM_SIGNINGTABLE = "/etc/opendkim-signingtable.mkhost"
+
+# DKIM key algorithm(s). Every domain gets one key (and one signature per
+# message) for each algorithm listed:
+#
+#   ["rsa"]            : RSA only (works with every verifier)
+#   ["ed25519"]        : Ed25519 only (RFC 8463; much cheaper to sign, but not supported by all verifiers)
+#   ["rsa", "ed25519"] : dual signature; Ed25519 verifiers use the cheap one, the others fall back on RSA
+#
+# Dual signature requires OPENDKIM_TABLE_TYPE = "refile".
+OPENDKIM_KEY_ALGORITHMS = ["rsa"]
+
+# OpenDKIM milter socket (a Unix socket). It must be inside Postfix queue
+# directory (/var/spool/postfix), so that chrooted Postfix daemons can reach it.
+OPENDKIM_SOCKET = "/var/spool/postfix/opendkim/opendkim.sock"
+
+# OpenDKIM KeyTable and SigningTable lookup type:
+#
+#   "refile" : SigningTable is a regular expression file (*@domain); KeyTable is a flat file
+#   "db"     : both tables are compiled to indexed Berkeley DB hash tables (file + ".db"),
+#              for constant-time lookups with many domains
+#
+# http://www.opendkim.org/opendkim.conf.5.html
+OPENDKIM_TABLE_TYPE = "refile"
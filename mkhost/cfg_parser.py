@@ -1,51 +1,164 @@
+import hashlib
 import logging
+import os
+import os.path
+import pickle
 
-import mkhost.cfg
+import mkhost.addr_table
 import mkhost.common
+import mkhost.log
+
+# Given MAILBOXES and MAIL_FORWARDING (in the config file), returns the
+# address table (see mkhost.addr_table). The table is built once per run
+# context and rebuilt only if the config file has been reloaded.
+def get_addr_table(ctx):
+    src = (ctx.cfg.MAILBOXES, ctx.cfg.MAIL_FORWARDING)
+    if (ctx.addr_table is None) or any(x is not y for (x, y) in zip(src, ctx.addr_table_src)):
+        ctx.addr_table     = mkhost.addr_table.AddrTable.from_cfg(*src)
+        ctx.addr_table_src = src
+        mkhost.log.debug("get_addr_table: {} addresses, {} forwarding edges",
+                         len(ctx.addr_table), ctx.addr_table.num_edges())
+    return ctx.addr_table
 
 # Given MAIL_FORWARDING (in the config file), compute the outgoing addresses (those mapped to, but
 # not mapped from). Can include mailboxes and 3rd party addresses.
-def get_fwd_dst_addresses():
-    vals2     = map(mkhost.common.tolist, mkhost.cfg.MAIL_FORWARDING.values())
-    vals      = set(x for ys in vals2 for x in ys)
-    keys      = mkhost.cfg.MAIL_FORWARDING.keys()
-    outgoing  = vals.difference(keys)
-    logging.debug("get_fwd_dst_addresses: {}".format(outgoing))
+def get_fwd_dst_addresses(ctx):
+    table     = get_addr_table(ctx)
+    outgoing  = set(map(table.addr, table.outgoing()))
+    mkhost.log.debug("get_fwd_dst_addresses: {}", outgoing)
     return outgoing
 
 # Given MAILBOXES and MAIL_FORWARDING (in the config file), compute the
 # virtual alias domains (mailbox-less domains used for mail forwarding).
 #
 # http://www.postfix.org/postconf.5.html#virtual_alias_domains
-def get_alias_domains():
-    keydoms = mkhost.common.addr2dom(mkhost.cfg.MAIL_FORWARDING.keys())
-    aliased = keydoms.difference(mkhost.cfg.MAILBOXES.keys())
-    logging.debug("get_alias_domains: {}".format(aliased))
+def get_alias_domains(ctx):
+    keydoms = get_addr_table(ctx).source_domains()
+    aliased = keydoms.difference(ctx.cfg.MAILBOXES.keys())
+    mkhost.log.debug("get_alias_domains: {}", aliased)
     return aliased
 
 # Given MAILBOXES (in the config file), compute the virtual mailbox
 # domains (those which can contain mailboxes).
 #
 # http://www.postfix.org/postconf.5.html#virtual_mailbox_domains
-def get_mailbox_domains():
-    return set(mkhost.cfg.MAILBOXES.keys())
+def get_mailbox_domains(ctx):
+    return set(ctx.cfg.MAILBOXES.keys())
 
 # Given MAILBOXES and FORWARDING (in the config file), compute the
 # virtual mailbox set (hosted virtual mailboxes).
-def get_virtual_mailboxes():
-    mailboxes = set("{}@{}".format(x,d) for d, xs in mkhost.cfg.MAILBOXES.items() for x in xs)
-    logging.debug("get_virtual_mailboxes: {}".format(mailboxes))
+def get_virtual_mailboxes(ctx):
+    mailboxes = set("{}@{}".format(x,d) for d, xs in ctx.cfg.MAILBOXES.items() for x in xs)
+    mkhost.log.debug("get_virtual_mailboxes: {}", mailboxes)
     return mailboxes
 
-def validate():
-    if not mkhost.cfg.LOCAL_MAILBOX_BASE.endswith('/'):
+def validate(ctx):
+    if ctx.cfg.OPENDKIM_TABLE_TYPE not in ("refile", "db"):
+        raise Exception("OPENDKIM_TABLE_TYPE must be one of: refile, db")
+
+    if (not ctx.cfg.OPENDKIM_KEY_ALGORITHMS) or \
+       (not set(ctx.cfg.OPENDKIM_KEY_ALGORITHMS).issubset({"rsa", "ed25519"})):
+        raise Exception("OPENDKIM_KEY_ALGORITHMS must be a non-empty list of: rsa, ed25519")
+
+    if (len(ctx.cfg.OPENDKIM_KEY_ALGORITHMS) > 1) and (ctx.cfg.OPENDKIM_TABLE_TYPE != "refile"):
+        raise Exception("Multiple OPENDKIM_KEY_ALGORITHMS require OPENDKIM_TABLE_TYPE = \"refile\" (a signing table entry per key)")
+
+    if ctx.cfg.X509_KEY_TYPE not in (None, "ecdsa", "rsa"):
+        raise Exception("X509_KEY_TYPE must be one of: None, ecdsa, rsa")
+
+    if ctx.cfg.TLS_SESSION_CACHE_TYPE not in ("btree", "lmdb"):
+        raise Exception("TLS_SESSION_CACHE_TYPE must be one of: btree, lmdb")
+
+    for x in (ctx.cfg.SYSTEMD_CPU_WEIGHT, ctx.cfg.SYSTEMD_IO_WEIGHT):
+        if not set(x).issubset({"postfix", "dovecot", "opendkim"}) or \
+           not all(isinstance(w, int) and (1 <= w <= 10000) for w in x.values()):
+            raise Exception("SYSTEMD_CPU_WEIGHT and SYSTEMD_IO_WEIGHT: weights (1-10000) of: postfix, dovecot, opendkim")
+
+    if ctx.cfg.MAIL_STORAGE_FORMAT not in ("maildir", "sdbox", "mdbox"):
+        raise Exception("MAIL_STORAGE_FORMAT must be one of: maildir, sdbox, mdbox")
+
+    if ctx.cfg.MAIL_DELIVERY not in ("virtual", "lmtp"):
+        raise Exception("MAIL_DELIVERY must be one of: virtual, lmtp")
+
+    if ctx.cfg.MAIL_BACKEND not in ("files", "sqlite"):
+        raise Exception("MAIL_BACKEND must be one of: files, sqlite")
+
+    if ctx.cfg.DOVECOT_PWD_SCHEME not in ("SHA512-CRYPT", "BLF-CRYPT", "ARGON2ID"):
+        raise Exception("DOVECOT_PWD_SCHEME must be one of: SHA512-CRYPT, BLF-CRYPT, ARGON2ID")
+
+    if ctx.cfg.MAIL_MIGRATE_CONCURRENCY < 1:
+        raise Exception("MAIL_MIGRATE_CONCURRENCY must be at least 1")
+
+    if not ctx.cfg.LOCAL_MAILBOX_BASE.endswith('/'):
         raise Exception("LOCAL_MAILBOX_BASE must end with '/' (maildir-style delivery of local mail is enforced)")
 
     # check if all virtual domain mailboxes declared on the right hand side of MAIL_FORWARDING
     # are declared in MAILBOXES
-    outhosted = mkhost.common.filter_addr_in_domain(mkhost.cfg.MAILBOXES.keys(), get_fwd_dst_addresses())
-    # logging.debug("outhosted (1): {}".format(outhosted))
-    outhosted = outhosted.difference(get_virtual_mailboxes())
-    # logging.debug("outhosted (2): {}".format(outhosted))
+    table     = get_addr_table(ctx)
+    outhosted = set(table.addr(i) for i in table.outgoing()
+                    if (not table.is_mailbox(i)) and (table.domain(i) in ctx.cfg.MAILBOXES))
     if outhosted:
         raise Exception("Extra addresses on the right hand side in MAIL_FORWARDING: {}. They belong to MAILBOXES domains. Did you forget to declare them in MAILBOXES?".format(outhosted))
+
+##############################################################################
+# Compiled configuration cache: the address table of a validated configuration
+# is pickled to MKHOST_STATE_DIR, keyed by the configuration file (path, size,
+# mtime), the mkhost version and the code which validates and indexes it (this
+# module and mkhost.addr_table), so that new checks and table layouts apply to
+# existing caches. On a match, the configuration is neither validated nor
+# indexed again.
+#
+# (Python itself caches the compiled configuration file in __pycache__.)
+##############################################################################
+
+def cache_path(ctx):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "cfg.pickle")
+
+# Returns the digest of the validation and indexing code (source files).
+def code_digest():
+    h = hashlib.sha256()
+    for x in (__file__, mkhost.addr_table.__file__):
+        with open(x, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+# Returns the cache key of the current configuration file.
+def cache_key(ctx):
+    path = os.path.abspath(ctx.cfg.__file__)
+    st   = os.stat(path)
+    return (path, st.st_size, st.st_mtime_ns, mkhost.common.get_version(), code_digest())
+
+# Reads the cached address table of the given configuration (cache key).
+# Returns the table, or None if not cached.
+def read_cache(ctx, key):
+    try:
+        with open(cache_path(ctx), "rb") as f:
+            (cached_key, table) = pickle.load(f)
+        if cached_key == key:
+            return table
+    except FileNotFoundError:
+        pass
+    except (pickle.UnpicklingError, EOFError, ImportError, AttributeError, IndexError, KeyError, ValueError, TypeError) as e:
+        logging.warning("ignoring config cache {}: {}".format(cache_path(ctx), e))
+    return None
+
+def write_cache(ctx, key, table):
+    os.makedirs(ctx.cfg.MKHOST_STATE_DIR, mode=0o700, exist_ok=True)
+    with open(cache_path(ctx) + ".tmp", "wb") as f:
+        pickle.dump((key, table), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path(ctx) + ".tmp", cache_path(ctx))
+
+# Validates the configuration and builds its address table, unless both are
+# cached (see above). The cache is updated, except in dry run mode.
+def load(ctx):
+    key   = cache_key(ctx)
+    table = read_cache(ctx, key)
+    if table is not None:
+        mkhost.log.debug("config cache hit: {}", cache_path(ctx))
+        ctx.addr_table     = table
+        ctx.addr_table_src = (ctx.cfg.MAILBOXES, ctx.cfg.MAIL_FORWARDING)
+        return
+
+    validate(ctx)
+    if not ctx.dry_run:
+        write_cache(ctx, key, get_addr_table(ctx))
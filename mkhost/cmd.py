@@ -1,18 +1,22 @@
+import asyncio
 import functools
 import io
+import locale
 import logging
 import subprocess
 import sys
 import threading
 import time
+import weakref
 
-import mkhost.common
+import mkhost.log
 
 ##############################################################################
 # global variables
 ##############################################################################
 
-_subproc_running = False
+_async_sems      = weakref.WeakKeyDictionary()          # event loop => concurrency semaphore
+_async_term_lks  = weakref.WeakKeyDictionary()          # event loop => terminal lock (interactive commands)
 
 ##############################################################################
 # interactive and non-interactive system command execution functions
@@ -20,8 +24,8 @@ _subproc_running = False
 ##############################################################################
 
 # Continuously reads from the given stream and notifies the given handlers.
-# Returns when _subproc_running becomes false.
-def _stream_reader(lk, stream, handlers):
+# Returns when the given event (child process terminated) is set.
+def _stream_reader(lk, done, stream, handlers):
     while True:
         chunk = stream.read(1)
         if chunk:
@@ -30,7 +34,7 @@ def _stream_reader(lk, stream, handlers):
                     h(chunk)
         else:
             with lk:
-                if not _subproc_running:
+                if done.is_set():
                     break
             time.sleep(1)
 
@@ -63,7 +67,6 @@ def _extract_err_out_lines(proc_result, print_err=True, print_out=True):
 # cmdline must be a list.
 # Returns a pair: (stdout lines, stderr lines).
 def execute_cmd_interactive(cmdline):
-    global _subproc_running
     logging.info(" ".join(cmdline))
 
     # start the child process
@@ -77,18 +80,18 @@ def execute_cmd_interactive(cmdline):
                stderr=subprocess.PIPE,
                universal_newlines=True)
 
-    # shared lock + flag
-    lk = threading.Lock()
-    _subproc_running = True
+    # shared lock + flag (this child process only)
+    lk   = threading.Lock()
+    done = threading.Event()
 
     # stdout
     out_buffer = io.StringIO()
     out_reader = threading.Thread(target=_stream_reader, name='stdout-reader', daemon=True,
-                     args=(lk, proc.stdout, [functools.partial(_stream_writer, sys.stdout), out_buffer.write]))
+                     args=(lk, done, proc.stdout, [functools.partial(_stream_writer, sys.stdout), out_buffer.write]))
     # stderr
     err_buffer = io.StringIO()
     err_reader = threading.Thread(target=_stream_reader, name='stderr-reader', daemon=True,
-                     args=(lk, proc.stderr, [functools.partial(_stream_writer, sys.stderr), err_buffer.write]))
+                     args=(lk, done, proc.stderr, [functools.partial(_stream_writer, sys.stderr), err_buffer.write]))
 
     # start the threads
     for t in (err_reader, out_reader):
@@ -97,7 +100,7 @@ def execute_cmd_interactive(cmdline):
     # wait for the child process to terminate
     proc.wait()
     with lk:
-        _subproc_running = False
+        done.set()
 
     # join the reader threads
     for t in (err_reader, out_reader):
@@ -112,6 +115,17 @@ def execute_cmd_interactive(cmdline):
     # logging.debug("out_lines: {}".format(out_lines))
     return (out_lines, err_lines)
 
+# Asks the user to confirm a destructive step, on the terminal (interactive
+# mode); in batch mode, every step is confirmed (see apt-get --yes).
+# Returns True if confirmed.
+def confirm(ctx, question):
+    if ctx.non_interactive:
+        return True
+    try:
+        return input("{} [y/N] ".format(question)).strip().lower() in ("y", "yes")
+    except EOFError:
+        return False
+
 # Executes a system command in a non-interactive way (batch).
 # cmdline must be a list.
 # Returns a pair: (stdout lines, stderr lines).
@@ -135,8 +149,106 @@ def execute_cmd_batch(cmdline, input=None):
 # Executes a system command.
 # cmdline must be a list.
 # Returns a pair: (stdout lines, stderr lines).
-def execute_cmd(cmdline):
-    if mkhost.common.get_non_interactive():
+def execute_cmd(ctx, cmdline):
+    if ctx.non_interactive:
         return execute_cmd_batch(cmdline)
     else:
         return execute_cmd_interactive(cmdline)
+
+##############################################################################
+# asynchronous system command execution functions (asyncio).
+#
+# The number of concurrently running batch commands is bounded by a semaphore
+# (max_concurrency of the run context, see mkhost.context) shared by all the
+# commands on the event loop.
+# Their command lines are logged at detail level (see mkhost.log), like the
+# other per-item events: callers log a summary.
+# Interactive commands are serialized on the terminal: in interactive mode
+# (the default, without --batch), commands only overlap if they are known not
+# to prompt, and are run in batch mode regardless (see the batch argument).
+##############################################################################
+
+# Returns the value for the given event loop from the given dictionary;
+# creates it with the given factory if missing.
+def _loop_local(d, factory):
+    loop = asyncio.get_running_loop()
+    x    = d.get(loop)
+    if x is None:
+        x = d[loop] = factory()
+    return x
+
+# Executes a system command asynchronously, in a non-interactive way (batch).
+# cmdline must be a list; timeout (if not None) is in seconds.
+# Returns a pair: (stdout lines, stderr lines).
+async def execute_cmd_batch_async(ctx, cmdline, input=None, timeout=None):
+    encoding = locale.getpreferredencoding(False)
+
+    async with _loop_local(_async_sems, lambda: asyncio.Semaphore(ctx.max_concurrency)):
+        logging.log(mkhost.log.detail_level(ctx), " ".join(cmdline))      # fanned out: per-item detail
+
+        proc = await asyncio.create_subprocess_exec(
+                   *cmdline,
+                   stdin=(subprocess.DEVNULL if input is None else subprocess.PIPE),
+                   stdout=subprocess.PIPE,
+                   stderr=subprocess.PIPE)
+
+        try:
+            (out, err) = await asyncio.wait_for(
+                             proc.communicate(None if input is None else input.encode(encoding)), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise subprocess.TimeoutExpired(cmd=" ".join(cmdline), timeout=timeout)
+
+    proc_result = subprocess.CompletedProcess(
+                      cmdline, proc.returncode, out.decode(encoding), err.decode(encoding))
+
+    if proc_result.returncode:
+        e = subprocess.CalledProcessError(
+                returncode=proc_result.returncode, cmd=" ".join(cmdline),
+                output=proc_result.stdout, stderr=proc_result.stderr)
+        _extract_err_out_lines(e)
+        raise e
+
+    return _extract_err_out_lines(proc_result)
+
+# Executes a system command asynchronously, in an interactive way.
+# Interactive commands are run one at a time (they share the terminal).
+# cmdline must be a list.
+# Returns a pair: (stdout lines, stderr lines).
+async def execute_cmd_interactive_async(cmdline):
+    async with _loop_local(_async_term_lks, asyncio.Lock):
+        return await asyncio.get_running_loop().run_in_executor(None, execute_cmd_interactive, cmdline)
+
+# Executes a system command asynchronously.
+# cmdline must be a list; timeout (if not None) is in seconds and applies to
+# batch mode only.
+# Returns a pair: (stdout lines, stderr lines).
+#
+# Params:
+#   batch : if True, run the command in batch mode even in interactive mode
+#           (for commands which never prompt: they can overlap)
+async def execute_cmd_async(ctx, cmdline, timeout=None, batch=False):
+    if batch or ctx.non_interactive:
+        return await execute_cmd_batch_async(ctx, cmdline, timeout=timeout)
+    else:
+        return await execute_cmd_interactive_async(cmdline)
+
+# Runs the given awaitables concurrently, in a new event loop, and waits for
+# all of them to complete. Raises the first error (if any).
+# Returns a list of results.
+def run_async(*aws):
+    async def gather():
+        return await asyncio.gather(*aws, return_exceptions=True)
+
+    results = asyncio.run(gather())
+    for x in results:
+        if isinstance(x, BaseException):
+            raise x
+    return results
+
+# Executes the given system commands concurrently (see execute_cmd_async;
+# in interactive mode, they run one at a time unless batch is True).
+# Returns a list of pairs: (stdout lines, stderr lines).
+def run_many(ctx, cmdlines, timeout=None, batch=False):
+    return run_async(*(execute_cmd_async(ctx, x, timeout=timeout, batch=batch) for x in cmdlines))
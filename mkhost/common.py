@@ -1,52 +1,22 @@
-import datetime
 import logging
+import os
+import os.path
 import re
 
-import mkhost.dns_log
-
 ##############################################################################
 # Common settings
 ##############################################################################
 
 _version_major   = 0
 _version_minor   = 4
-_dry_run         = True
-_verbose         = False
-_non_interactive = False
-_run_ts          = datetime.datetime.now(datetime.timezone.utc)     # timestamp of this run
+
+# Run settings (dry run, batch mode...) belong to the run context (see
+# mkhost.context).
 
 # Returns the version number as a pair (major, minor)
 def get_version():
     return (_version_major, _version_minor)
 
-def get_dry_run():
-    return _dry_run
-
-def set_dry_run(b):
-    global _dry_run
-    _dry_run = bool(b)
-    logging.debug("_dry_run: {}".format(_dry_run))
-
-def get_non_interactive():
-    return _non_interactive
-
-def set_non_interactive(b):
-    global _non_interactive
-    _non_interactive = bool(b)
-    logging.debug("_non_interactive: {}".format(_non_interactive))
-
-def get_verbose():
-    return _verbose
-
-def set_verbose(b):
-    global _verbose
-    _verbose = bool(b)
-    logging.debug("_verbose: {}".format(_verbose))
-
-# Returns the timestamp of this run as a timezone-aware, UTC datetime object.
-def get_run_ts():
-    return _run_ts
-
 ##############################################################################
 # Common constants
 ##############################################################################
@@ -58,25 +28,48 @@ re_comment = re.compile(
 re_mkhost_header = re.compile(
     '^# Generated by mkhost ([0-9]+)\.([0-9]+) at [0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{6}\+[0-9]{2}:[0-9]{2}$', re.ASCII)
 
-##############################################################################
-# Common variables
-##############################################################################
-
-_dns_log         = mkhost.dns_log.DNSLog()
-
 ##############################################################################
 # Common functions
 ##############################################################################
 
-def add_dns_record(record):
-    _dns_log.add_record(record)
-
 # Generates mkhost header string.
-def mkhost_header():
+def mkhost_header(ctx):
     return "# Generated by mkhost {}.{} at {}".format(
         _version_major,
         _version_minor,
-        get_run_ts().isoformat())
+        ctx.run_ts.isoformat())
+
+# Returns the lines of the given text, but the mkhost header (timestamp).
+def strip_header(text):
+    return [x for x in text.splitlines() if not re_mkhost_header.match(x)]
+
+# Returns True if the given file differs from the given text (the header
+# timestamp aside).
+def file_changed(path, text):
+    try:
+        with open(path) as f:
+            return strip_header(f.read()) != strip_header(text)
+    except FileNotFoundError:
+        return True
+
+# Replaces the given file with the given text, atomically, if changed (see
+# file_changed). The parent directory is created if missing.
+# Returns True if the file has been written.
+#
+# Params:
+#   mode : file permissions
+def write_file(ctx, path, text, mode=0o644):
+    if not file_changed(path, text):
+        return False
+
+    logging.info("writing {}".format(path))
+    if not ctx.dry_run:
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(text)
+        os.replace(path + ".tmp", path)
+    return True
 
 # Promote x to list.
 def tolist(x):
@@ -95,5 +88,6 @@ def addr2dom(addr):
 # to any of the given domains.
 def filter_addr_in_domain(domains, addresses):
     xs = set(filter(lambda x: addr2dom(x) in domains, addresses))
-    logging.debug("filter_addr_in_domain: {} + {} => {}".format(domains, addresses, xs))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("filter_addr_in_domain: {} + {} => {}".format(domains, addresses, xs))
     return xs
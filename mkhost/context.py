@@ -0,0 +1,55 @@
+import datetime
+import importlib.util
+import os
+
+import mkhost.cfg
+import mkhost.dns_log
+
+##############################################################################
+# Run context: the state of a run, i.e. its settings (dry run, batch
+# mode...), its timestamp, its DNS log, the command executor settings and the
+# configuration (settings and derived address table).
+#
+# The context is passed explicitly, as the first argument (ctx), to every
+# function which reads the configuration or the state of the run: the stages
+# of a run (see mkhost.journal.run), the watch loop (see mkhost.watch.watch)
+# and the helpers they call. The configuration is read from ctx.cfg, never
+# from the mkhost.cfg module directly: several runs, each with its own
+# context and configuration, can be carried out concurrently in a single
+# process, e.g. the plans of several configurations, in parallel:
+#
+#   ctxs = [RunContext(cfg=load_cfg(x), non_interactive=True) for x in paths]
+#   with concurrent.futures.ThreadPoolExecutor() as pool:
+#       plans = list(pool.map(lambda c: mkhost.plan.make_plan(c, doveconf, letsencrypt_home), ctxs))
+#
+# A context is not shared by concurrent runs; it can be reused by successive
+# ones (see watch mode).
+##############################################################################
+
+class RunContext:
+    def __init__(self, cfg=None, dry_run=True, verbose=False, non_interactive=False, log_detail=False,
+                 max_concurrency=None):
+        self.cfg             = cfg or mkhost.cfg    # configuration module (see load_cfg)
+        self.dry_run         = dry_run
+        self.verbose         = verbose
+        self.non_interactive = non_interactive
+        self.log_detail      = log_detail       # per-item events at INFO level (see mkhost.log)
+        self.run_ts          = datetime.datetime.now(datetime.timezone.utc)    # timestamp of this run
+        self.dns_log         = mkhost.dns_log.DNSLog()
+
+        # command executor: max number of concurrent asynchronous commands
+        self.max_concurrency = max(1, int(max_concurrency or min(32, (os.cpu_count() or 1) + 4)))
+
+        # configuration model (see mkhost.cfg_parser and mkhost.storage)
+        self.addr_table      = None     # AddrTable built from the configuration
+        self.addr_table_src  = None     # (MAILBOXES, MAIL_FORWARDING) objects the table was built from
+        self.storage_format  = None     # storage format mail is currently stored in (cached)
+
+# Loads the given configuration file (see mkhost/cfg.py) as a new module, for
+# a run context.
+# Returns the module.
+def load_cfg(path):
+    spec   = importlib.util.spec_from_file_location(mkhost.cfg.__name__, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
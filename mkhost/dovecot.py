@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import os.path
@@ -5,18 +6,29 @@ import re
 import secrets
 import shutil
 import string
+import subprocess
 import tempfile
 
 import mkhost.common
-import mkhost.cfg
 import mkhost.cfg_parser
+import mkhost.cmd
 import mkhost.letsencrypt
+import mkhost.log
+import mkhost.maildb
+import mkhost.postfix
+import mkhost.storage
 import mkhost.unix
 
 re_users = re.compile(
     '^([^:]+):\{([-\w]+)\}\$(\w+)\$[^:]*:(\d*):(\d*)::::$', re.ASCII)
 
-pwd_hash_cmd = ["doveadm", "pw", "-s", "SHA512-CRYPT"]
+# Returns the doveadm command which hashes a new password with the given
+# scheme and cost (default: DOVECOT_PWD_SCHEME and DOVECOT_PWD_ROUNDS; cost
+# None: Dovecot default).
+def pwd_hash_cmd(ctx, scheme=None, rounds=None):
+    if scheme is None:
+        (scheme, rounds) = (ctx.cfg.DOVECOT_PWD_SCHEME, ctx.cfg.DOVECOT_PWD_ROUNDS)
+    return ["doveadm", "pw", "-s", scheme] + (["-r", str(rounds)] if rounds else [])
 
 # generate a new password
 def gen_pwd():
@@ -24,34 +36,66 @@ def gen_pwd():
     return ''.join(secrets.choice(alphabet) for i in range(18))
 
 # generate a new user password
-def gen_pwd_hash(username):
+def gen_pwd_hash(ctx, username):
     # TODO check what password schemes are available: doveadm pw -l
-    if mkhost.common.get_non_interactive():
+    if ctx.non_interactive:
         pwd = gen_pwd()
         logging.info("New password for {}: {}".format(username, pwd))
-        return mkhost.cmd.execute_cmd_batch(pwd_hash_cmd, input=(pwd + os.linesep + pwd + os.linesep))[0][0]
+        return mkhost.cmd.execute_cmd_batch(pwd_hash_cmd(ctx), input=(pwd + os.linesep + pwd + os.linesep))[0][0]
         # TODO clear error message if number of output lines != 1
     else:
         logging.info("New password for {}".format(username))
-        return mkhost.cmd.execute_cmd_interactive(pwd_hash_cmd)[0][0]
+        return mkhost.cmd.execute_cmd_interactive(pwd_hash_cmd(ctx))[0][0]
         # TODO clear error message if number of output lines != 1
 
-# Generates Dovecot configuration and writes it to the given configuration file
-# (which must be the main Dovecot configuration file).
+# Returns the list of protocols to enable: DOVECOT_PROTOCOLS, plus LMTP if
+# Dovecot delivers virtual mail over LMTP.
+def protocols(ctx):
+    xs = list(ctx.cfg.DOVECOT_PROTOCOLS)
+    if (mkhost.storage.delivery_agent(ctx, mkhost.storage.current_format(ctx)) == "lmtp") and ("lmtp" not in xs):
+        xs.append("lmtp")
+    return xs
+
+# Splits the given Dovecot configuration text into: (text before the mkhost
+# section, mkhost section). The mkhost section starts with the mkhost header
+# block and extends to the end of file; it is empty if not found.
+def split_config(text):
+    lines = text.splitlines(keepends=True)
+    for (i, line) in enumerate(lines):
+        m = mkhost.common.re_mkhost_header.match(line.rstrip())
+        if m:
+            logging.info("Found mkhost {}.{} dovecot configuration header".format(m.group(1), m.group(2)))
+            j = (i - 1) if ((i > 0) and lines[i - 1].startswith('#')) else i
+            while (j > 0) and mkhost.common.re_blank.match(lines[j - 1]):
+                j -= 1
+            return ("".join(lines[:j]), "".join(lines[j:]))
+    return (text, "")
+
+# Generates the main Dovecot configuration file: the existing configuration,
+# with the mkhost section appended (or replaced, if it has changed).
+# Returns the new file text, or None if the file is already up to date.
 #
 # Params:
 #   doveconf         : path to the main Dovecot configuration file
 #   letsencrypt_home : Let's Encrypt home dir
-def write_config(doveconf, letsencrypt_home):
+def gen_config(ctx, doveconf, letsencrypt_home):
     with open(doveconf) as f:
-        for line in f:
-            m = mkhost.common.re_mkhost_header.match(line)
-            if m:
-                mver = (int(m.group(1)), int(m.group(2)))
-                logging.info("Found mkhost {}.{} dovecot configuration header".format(mver[0], mver[1]))
-                if (mkhost.common.get_version() <= mver):
-                    return
+        (user_text, old_section) = split_config(f.read())
+
+    new_section = gen_section(ctx, letsencrypt_home) + os.linesep
+
+    # compare everything but the header (timestamp) and the surrounding blank lines
+    if mkhost.common.strip_header(old_section.strip()) == mkhost.common.strip_header(new_section.strip()):
+        return None
+
+    return user_text + new_section
 
+# Generates the mkhost section of the main Dovecot configuration file.
+# Returns the configuration string.
+#
+# Params:
+#   letsencrypt_home : Let's Encrypt home dir
+def gen_section(ctx, letsencrypt_home):
     configuration = """
 ########################################################################
 {}
@@ -77,11 +121,22 @@ verbose_ssl       = yes
 verbose_proctitle = yes
 
 protocols    = {}
-""".format(mkhost.common.mkhost_header(),
-           " ".join(mkhost.cfg.DOVECOT_PROTOCOLS))
+""".format(mkhost.common.mkhost_header(ctx),
+           " ".join(protocols(ctx)))
+
+    # Authentication cache: the passdb and userdb lookups of recent logins are
+    # cached; passwords are verified (see DOVECOT_PWD_ROUNDS) by the auth
+    # worker processes, in parallel.
+    if ctx.cfg.DOVECOT_AUTH_CACHE_SIZE:
+        configuration += """
+auth_cache_size                        = {}
+auth_cache_ttl                         = {}
+auth_cache_verify_password_with_worker = yes
+""".format(ctx.cfg.DOVECOT_AUTH_CACHE_SIZE,
+           ctx.cfg.DOVECOT_AUTH_CACHE_TTL)
 
     # Listen on the loopback address only
-    if mkhost.cfg.DOVECOT_LOOPBACK_ONLY:
+    if ctx.cfg.DOVECOT_LOOPBACK_ONLY:
         logging.info("Dovecot will listen on IPv4 and IPv6 loopback addresses only")
         configuration += """
 listen = 127.0.0.1, ::1
@@ -104,9 +159,30 @@ userdb {{
   driver          = passwd
   override_fields = mail=maildir:{}
 }}
-""".format(os.path.join(mkhost.cfg.LOCAL_MAILBOX_BASE, '%u/'))
+""".format(os.path.join(ctx.cfg.LOCAL_MAILBOX_BASE, '%u/'))
 
-    configuration += """
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        configuration += """
+########################################################################
+# Authentication for SQL users.
+#
+# Virtual user credentials are in {} (see {}).
+########################################################################
+
+passdb {{
+  driver = sql
+  args   = {}
+}}
+
+userdb {{
+  driver = sql
+  args   = {}
+""".format(ctx.cfg.MAIL_DB,
+           mkhost.maildb.dovecot_conf_path(ctx),
+           mkhost.maildb.dovecot_conf_path(ctx),
+           mkhost.maildb.dovecot_conf_path(ctx))
+    else:
+        configuration += """
 ########################################################################
 # Authentication for passwd-file users.
 #
@@ -115,26 +191,28 @@ userdb {{
 
 passdb {{
   driver = passwd-file
-  args   = scheme=SHA512-CRYPT username_format=%u {}
+  args   = scheme={} username_format=%u {}
 }}
 
 userdb {{
   driver = passwd-file
   args   = username_format=%u {}
+""".format(ctx.cfg.DOVECOT_USERS_DB,
+           ctx.cfg.DOVECOT_PWD_SCHEME,
+           ctx.cfg.DOVECOT_USERS_DB,
+           ctx.cfg.DOVECOT_USERS_DB)
 
-  # Default fields that can be overridden by passwd-file
+    configuration += """
+  # Default fields that can be overridden by the user database
   default_fields  = uid={} gid={} home={} quota_rule=*:storage=1M
 
-  # Override fields from passwd-file
+  # Override fields from the user database
   override_fields = home={}
 }}
-""".format(mkhost.cfg.DOVECOT_USERS_DB,
-           mkhost.cfg.DOVECOT_USERS_DB,
-           mkhost.cfg.DOVECOT_USERS_DB,
-           mkhost.cfg.VIRTUAL_MAIL_USER,
-           mkhost.cfg.VIRTUAL_MAIL_USER,
-           os.path.join(mkhost.cfg.VIRTUAL_MAILBOX_BASE, '%d/%n/'),
-           os.path.join(mkhost.cfg.VIRTUAL_MAILBOX_BASE, '%d/%n/'))
+""".format(ctx.cfg.VIRTUAL_MAIL_USER,
+           ctx.cfg.VIRTUAL_MAIL_USER,
+           os.path.join(ctx.cfg.VIRTUAL_MAILBOX_BASE, '%d/%n/'),
+           os.path.join(ctx.cfg.VIRTUAL_MAILBOX_BASE, '%d/%n/'))
 
     configuration += """
 ########################################################################
@@ -142,8 +220,9 @@ userdb {{
 ########################################################################
 
 mail_home     = {}
-mail_location = maildir:~/mail/
-""".format(os.path.join(mkhost.cfg.VIRTUAL_MAILBOX_BASE, '%d/%n/'))
+mail_location = {}
+""".format(os.path.join(ctx.cfg.VIRTUAL_MAILBOX_BASE, '%d/%n/'),
+           mkhost.storage.LOCATIONS[mkhost.storage.current_format(ctx)])
 
     configuration += """
 namespace inbox {
@@ -171,47 +250,129 @@ namespace inbox {
     special_use = \All
   }
 }
+"""
 
+    configuration += """
 ########################################################################
 # User authentication service for Postfix
 ########################################################################
 
-service auth {
-  unix_listener /var/spool/postfix/private/auth {
+service auth {{
+  unix_listener /var/spool/postfix/private/auth {{
     group = postfix
     mode  = 0660
     user  = postfix
-  }
-}
-"""
+  }}
+
+  # user lookups of the local delivery agent (run as the virtual mail user)
+  unix_listener auth-userdb {{
+    group = {}
+    mode  = 0600
+    user  = {}
+  }}
+}}
+""".format(ctx.cfg.VIRTUAL_MAIL_USER,
+           ctx.cfg.VIRTUAL_MAIL_USER)
+
+    if mkhost.storage.delivery_agent(ctx, mkhost.storage.current_format(ctx)) == "lmtp":
+        configuration += """
+########################################################################
+# Mail delivery service for Postfix (LMTP)
+########################################################################
+
+# Strip address extensions (user+ext@domain), like Postfix does.
+recipient_delimiter = +
+
+service lmtp {{
+  unix_listener {} {{
+    group = postfix
+    mode  = 0600
+    user  = postfix
+  }}
+}}
+""".format(os.path.join(mkhost.postfix.QUEUE_DIR, mkhost.postfix.LMTP_SOCKET))
 
     configuration += """
 ########################################################################
 # SSL settings
 ########################################################################
 
-ssl      = required
-ssl_cert = <{}
-ssl_key  = <{}
-""".format(mkhost.letsencrypt.cert_path(letsencrypt_home),
-           mkhost.letsencrypt.key_path(letsencrypt_home))
+ssl                       = required
+ssl_cert                  = <{}
+ssl_key                   = <{}
+ssl_min_protocol          = TLSv1.2
+ssl_prefer_server_ciphers = yes
+""".format(mkhost.letsencrypt.cert_path(ctx, letsencrypt_home),
+           mkhost.letsencrypt.key_path(ctx, letsencrypt_home))
+
+    # Login processes in high-performance mode: each one serves many
+    # connections (instead of one), so that TLS sessions are cached in memory
+    # and resumed by repeat clients, and no process is forked per login.
+    #
+    # https://doc.dovecot.org/admin_manual/login_processes/#high-performance-mode
+    for x in protocols(ctx):
+        if x in ("imap", "pop3"):
+            configuration += """
+service {}-login {{
+  service_count     = 0
+  process_min_avail = {}
+}}
+""".format(x, os.cpu_count() or 1)
+
+    return configuration
+
+# Generates Dovecot configuration and writes it to the given configuration file
+# (which must be the main Dovecot configuration file). The file is replaced
+# atomically.
+# Returns True if the file has been written.
+#
+# Params:
+#   doveconf         : path to the main Dovecot configuration file
+#   letsencrypt_home : Let's Encrypt home dir
+def write_config(ctx, doveconf, letsencrypt_home):
+    text = gen_config(ctx, doveconf, letsencrypt_home)
+    if text is None:
+        return False
 
-    # overwrite the configuration file
-    if not mkhost.common.get_dry_run():
+    logging.debug(text)
+    if not ctx.dry_run:
         logging.info("writing configuration to {}".format(doveconf))
-        with open(doveconf, "a") as f:
-            print(configuration, file=f)
+        with tempfile.NamedTemporaryFile(mode="wt", prefix=".mkhost-", dir=os.path.dirname(doveconf), delete=False) as f:
+            f.write(text)
+        shutil.copymode(doveconf, f.name)
+        os.replace(f.name, doveconf)
 
-    logging.debug(configuration)
+    return True
 
-# Generates and writes out user database file (mkhost.cfg.DOVECOT_USERS_DB).
-def write_users_db():
-    vboxes = mkhost.cfg_parser.get_virtual_mailboxes()
+# Reads the password hashes of the user database file (mkhost.cfg.DOVECOT_USERS_DB).
+# Returns a dictionary: username => password hash.
+def read_users_db(ctx):
+    hashes = {}
+    try:
+        with open(ctx.cfg.DOVECOT_USERS_DB) as f:
+            for line in map(lambda x: x.rstrip(), f):
+                if re_users.match(line):
+                    hashes[line.split(':')[0]] = line.split(':')[1]
+    except FileNotFoundError:
+        pass
+    return hashes
+
+# Generates user database file (mkhost.cfg.DOVECOT_USERS_DB).
+# Returns a list of lines.
+#
+# Params:
+#   pwd_hash : function which returns a password hash for the given (new) username;
+#              default: gen_pwd_hash
+def gen_users_db(ctx, pwd_hash=None):
+    pwd_hash = pwd_hash or functools.partial(gen_pwd_hash, ctx)
+    vboxes   = mkhost.cfg_parser.get_virtual_mailboxes(ctx)
 
     # Parse the existing user db file, filter users
     old_lines = []
+    ev_keep   = mkhost.log.Events(ctx, "dovecot.user.keep",   "[dovecot] user already exists: {}", "[dovecot] kept {} existing users")
+    ev_delete = mkhost.log.Events(ctx, "dovecot.user.delete", "[dovecot] delete user: {}",         "[dovecot] deleted {} users")
     try:
-        with open(mkhost.cfg.DOVECOT_USERS_DB) as f:
+        with open(ctx.cfg.DOVECOT_USERS_DB) as f:
             for line in map(lambda x: x.rstrip(), f):
                 if mkhost.common.re_comment.match(line):
                     old_lines.append(line)
@@ -224,39 +385,73 @@ def write_users_db():
                         username = m.group(1)
 
                         if username in vboxes:
-                            logging.info("[dovecot] user already exists: {}".format(username))
+                            ev_keep.add(username)
                             old_lines.append(line)
                             vboxes.remove(username)
                         else:
-                            logging.info("[dovecot] delete user: {}".format(username))
+                            ev_delete.add(username)
                     else:
-                        logging.warning("{}: invalid line: {}".format(mkhost.cfg.DOVECOT_USERS_DB, line))
+                        logging.warning("{}: invalid line: {}".format(ctx.cfg.DOVECOT_USERS_DB, line))
     except FileNotFoundError:
-        logging.warning("dovecot user db file does not exist: {}".format(mkhost.cfg.DOVECOT_USERS_DB))
+        logging.warning("dovecot user db file does not exist: {}".format(ctx.cfg.DOVECOT_USERS_DB))
+
+    ev_keep.close()
+    ev_delete.close()
+
+    lines = old_lines
+    if vboxes:
+        lines.append(mkhost.common.mkhost_header(ctx))
+        with mkhost.log.Events(ctx, "dovecot.user.create", "[dovecot] create user: {}", "[dovecot] created {} users") as ev:
+            for x in vboxes:
+                ev.add(x)
+                lines.append("{}:{}::::::".format(x,pwd_hash(x)))
+
+    return lines
+
+# Generates and writes out user database file (mkhost.cfg.DOVECOT_USERS_DB).
+def write_users_db(ctx):
+    lines = gen_users_db(ctx)
 
     # create new user db file
     with tempfile.NamedTemporaryFile(mode="wt", prefix="mkhost-", delete=True) as f:
         logging.debug("temp file: {}".format(f.name))
-        if old_lines:
-            print(os.linesep.join(old_lines), file=f)
-        if vboxes:
-            print(mkhost.common.mkhost_header(), file=f)
-            for x in vboxes:
-                logging.info("create user: {}".format(x))
-                print("{}:{}::::::".format(x,gen_pwd_hash(x)), file=f)
+        if lines:
+            print(os.linesep.join(lines), file=f)
 
         # overwrite old user db file
-        if not mkhost.common.get_dry_run():
+        if not ctx.dry_run:
             f.flush()
-            shutil.copyfile(f.name, mkhost.cfg.DOVECOT_USERS_DB)
+            shutil.copyfile(f.name, ctx.cfg.DOVECOT_USERS_DB)
+            flush_auth_cache(ctx)
+
+# Flushes Dovecot authentication cache (after users have been created or
+# deleted), if enabled and Dovecot is running.
+def flush_auth_cache(ctx):
+    if ctx.cfg.DOVECOT_AUTH_CACHE_SIZE and not ctx.dry_run:
+        try:
+            mkhost.cmd.execute_cmd_batch(["doveadm", "auth", "cache", "flush"])
+        except (FileNotFoundError, subprocess.CalledProcessError) as e:
+            logging.warning("cannot flush dovecot authentication cache: {}".format(e))
+
+# Returns the list of packages required by Dovecot setup.
+def packages(ctx):
+    pkgs = ["dovecot-imapd"]
+    if "lmtp" in protocols(ctx):
+        pkgs.append("dovecot-lmtpd")
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        pkgs.append("dovecot-sqlite")
+    return pkgs
 
 # Installs and configures Dovecot.
 #
 # Params:
 #   doveconf         : path to dovecot configuration file
 #   letsencrypt_home : Let's Encrypt home dir
-def install(doveconf, letsencrypt_home):
-    mkhost.unix.install_pkgs(["dovecot-imapd"])
+def install(ctx, doveconf, letsencrypt_home):
+    mkhost.unix.install_pkgs(ctx, packages(ctx))
 
-    write_config(doveconf, letsencrypt_home)
-    write_users_db()
+    write_config(ctx, doveconf, letsencrypt_home)
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        mkhost.maildb.write_dovecot_conf(ctx)    # users: see mkhost.postfix.install
+    else:
+        write_users_db(ctx)
@@ -0,0 +1,138 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import os.path
+
+import mkhost.common
+import mkhost.log
+
+##############################################################################
+# Run journal and single-instance lock.
+#
+# A run is a sequence of stages (packages, certificate, DKIM keys, Dovecot,
+# Postfix...). Every completed stage is recorded in the journal (in
+# MKHOST_STATE_DIR), together with the digest of its inputs: configuration
+# file, mkhost version and command line arguments. If a run fails, the next
+# one skips the stages completed since, up to the first incomplete or
+# invalidated (inputs changed) stage, and resumes from there. The journal is
+# removed once every stage has completed: the next run is a full one.
+#
+# The DNS records logged by a stage are recorded too, and logged again when
+# the stage is skipped, so that the list of DNS changes is always complete.
+#
+# An exclusive lock (fcntl) on a file in MKHOST_STATE_DIR keeps runs from
+# overlapping (generated files and maps are written to temporary files which
+# two runs would share).
+##############################################################################
+
+_lock_fds = {}      # lock file path => file descriptor (held until exit)
+
+def lock_path(ctx):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "mkhost.lock")
+
+def journal_path(ctx):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "journal.json")
+
+# Takes the exclusive lock of MKHOST_STATE_DIR, or raises an error if another
+# mkhost process holds it. The lock is held until this process exits.
+def lock(ctx):
+    if lock_path(ctx) in _lock_fds:
+        return
+
+    os.makedirs(ctx.cfg.MKHOST_STATE_DIR, mode=0o700, exist_ok=True)
+    fd = os.open(lock_path(ctx), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        pid = os.read(fd, 32).decode(errors="replace").strip()
+        os.close(fd)
+        raise Exception("another mkhost run is in progress (pid {}), see: {}".format(pid or "unknown", lock_path(ctx)))
+
+    os.ftruncate(fd, 0)
+    os.write(fd, "{}\n".format(os.getpid()).encode())
+    _lock_fds[lock_path(ctx)] = fd
+    mkhost.log.debug("[journal] lock acquired: {}", lock_path(ctx))
+
+# Returns the digest of the inputs of a stage: the configuration file, the
+# mkhost version, the stage name and the given arguments.
+def inputs_digest(ctx, name, args):
+    h = hashlib.sha256()
+    with open(ctx.cfg.__file__, "rb") as f:
+        h.update(f.read())
+    h.update(repr((mkhost.common.get_version(), name, args)).encode())
+    return h.hexdigest()
+
+# Reads the journal of the previous (incomplete) run.
+# Returns a list of completed stages: {"name", "digest", "dns"}.
+def read_journal(ctx):
+    try:
+        with open(journal_path(ctx)) as f:
+            return json.load(f)["stages"]
+    except FileNotFoundError:
+        return []
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning("ignoring run journal {}: {}".format(journal_path(ctx), e))
+        return []
+
+def write_journal(ctx, stages):
+    os.makedirs(ctx.cfg.MKHOST_STATE_DIR, mode=0o700, exist_ok=True)
+    with open(journal_path(ctx) + ".tmp", "w") as f:
+        json.dump({"stages": stages}, f, indent=1)
+    os.replace(journal_path(ctx) + ".tmp", journal_path(ctx))
+
+def remove_journal(ctx):
+    try:
+        os.remove(journal_path(ctx))
+    except FileNotFoundError:
+        pass
+
+# Runs the given stages in order, in the given run context (see
+# mkhost.context), skipping those completed by the previous (incomplete) run
+# with the same inputs, up to the first incomplete or invalidated one. The
+# journal is updated after every stage and removed at the end, except in dry
+# run mode.
+#
+# Params:
+#   ctx    : run context (configuration and settings) of the stages
+#   stages : list of (name, function, args); every function is called with
+#            the run context and args; args are part of the stage inputs
+#            digest
+#   resume : if False, ignore the journal (run every stage)
+def run(ctx, stages, resume=True):
+    done = read_journal(ctx) if resume else []
+    if done:
+        logging.info("[journal] previous run incomplete: {} stages completed ({})".format(
+            len(done), ", ".join(x["name"] for x in done)))
+
+    dry_run   = ctx.dry_run
+    completed = []
+    resuming  = True
+    for (name, fn, args) in stages:
+        digest = inputs_digest(ctx, name, args)
+        i      = len(completed)
+        if resuming and (i < len(done)) and (done[i]["name"] == name) and (done[i]["digest"] == digest):
+            logging.info("[journal] skip {} (completed by the previous run)".format(name))
+            for x in done[i]["dns"]:
+                ctx.dns_log.add_record(x)
+            completed.append(done[i])
+            continue
+        if resuming and (i < len(done)):
+            logging.info("[journal] {}: inputs changed since the previous run".format(name))
+        resuming = False
+
+        logging.info("setup {}...".format(name))
+        dns_records = len(ctx.dns_log)
+        fn(ctx, *args)
+        completed.append({"name"   : name,
+                          "digest" : digest,
+                          "dns"    : ctx.dns_log.records[dns_records:]})
+        if not dry_run:
+            write_journal(ctx, completed)
+
+    if not dry_run:
+        remove_journal(ctx)
@@ -1,26 +1,212 @@
+import datetime
+import logging
+import os
 import os.path
+import ssl
+import subprocess
 
-import mkhost.cfg
+import mkhost.cfg_parser
 import mkhost.cmd
-import mkhost.common
 import mkhost.unix
 
-def cert_path(letsencrypt_home):
+def cert_path(ctx, letsencrypt_home):
     return os.path.join(
-        letsencrypt_home, "live", "{}.{}".format(mkhost.cfg.MY_HOST_NAME, mkhost.cfg.MY_HOST_DOMAIN), "cert.pem")
+        letsencrypt_home, "live", "{}.{}".format(ctx.cfg.MY_HOST_NAME, ctx.cfg.MY_HOST_DOMAIN), "cert.pem")
 
-def key_path(letsencrypt_home):
+def key_path(ctx, letsencrypt_home):
     return os.path.join(
-        letsencrypt_home, "live", "{}.{}".format(mkhost.cfg.MY_HOST_NAME, mkhost.cfg.MY_HOST_DOMAIN), "privkey.pem")
-
-# Installs Let's Encrypt's certificate.
-def install():
-    mkhost.unix.install_pkgs(["certbot", "python3-certbot-apache"])
-    mkhost.cmd.execute_cmd(
-        ["certbot"] + \
-        (["certonly", "--dry-run"] if mkhost.common.get_dry_run() else ["run"]) + \
-        (["--non-interactive", "--agree-tos"] if mkhost.common.get_non_interactive() else []) + \
-        ["--email", "{}".format(mkhost.cfg.X509_EMAIL)] + \
-        ["--apache", "--redirect", "--domain", "{}.{}".format(mkhost.cfg.MY_HOST_NAME, mkhost.cfg.MY_HOST_DOMAIN)])
-
-# TODO implement renew/certonly
+        letsencrypt_home, "live", "{}.{}".format(ctx.cfg.MY_HOST_NAME, ctx.cfg.MY_HOST_DOMAIN), "privkey.pem")
+
+# Returns the list of DNS names the certificate must cover: the FQDN of this
+# machine first, then the mail hostnames of all the mailbox domains (if
+# X509_MAIL_HOST_PREFIX is set).
+def cert_names(ctx):
+    names = ["{}.{}".format(ctx.cfg.MY_HOST_NAME, ctx.cfg.MY_HOST_DOMAIN)]
+    if ctx.cfg.X509_MAIL_HOST_PREFIX:
+        for d in sorted(mkhost.cfg_parser.get_mailbox_domains(ctx)):
+            x = "{}.{}".format(ctx.cfg.X509_MAIL_HOST_PREFIX, d)
+            if x not in names:
+                names.append(x)
+    return names
+
+# Subject public key algorithms (openssl x509 -text) => key types.
+KEY_ALGORITHMS = {
+    "id-ecPublicKey" : "ecdsa",
+    "rsaEncryption"  : "rsa",
+}
+
+# Reads the given PEM certificate file with a single openssl x509 -text call:
+# its expiry date, its names and its key type (the algorithm of its subject
+# public key info).
+# Returns a dictionary like ssl.SSLSocket.getpeercert ("notAfter" and
+# "subjectAltName" only) plus "keyType" ("ecdsa", "rsa" or None), or None if
+# the file does not exist or cannot be decoded.
+def read_cert(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        (out_lines, _) = mkhost.cmd.execute_cmd_batch(["openssl", "x509", "-in", path, "-noout", "-text"])
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning("cannot decode certificate {}: {}".format(path, e))
+        return None
+
+    cert = {"subjectAltName": (), "keyType": None}
+    san  = False
+    for x in map(str.strip, out_lines):
+        (k, _, v) = x.partition(":")
+        if san:
+            cert["subjectAltName"] = tuple(tuple(y.strip().partition(":")[::2]) for y in x.split(","))
+            san = False
+        elif k == "X509v3 Subject Alternative Name":
+            san = True
+        elif k.strip() == "Not After":
+            cert["notAfter"] = v.strip()
+        elif k == "Public Key Algorithm":
+            cert["keyType"] = KEY_ALGORITHMS.get(v.strip())
+    if "notAfter" not in cert:
+        logging.warning("cannot decode certificate {}: no expiry date".format(path))
+        return None
+    return cert
+
+# Returns True if the given DNS name is covered by the given certificate
+# SAN names (wildcards included).
+def name_covered(name, san_names):
+    return (name in san_names) or ("*." + name.partition('.')[2] in san_names)
+
+# Checks the current certificate: it must exist, be valid for at least
+# X509_RENEW_DAYS days more and cover all the required names (see cert_names).
+# Returns a pair: (True if the certificate is fine, reason).
+#
+# Params:
+#   letsencrypt_home : Let's Encrypt home dir
+#   cert             : the current certificate (see read_cert), or None
+def cert_state(ctx, letsencrypt_home, cert):
+    if cert is None:
+        return (False, "no certificate: {}".format(cert_path(ctx, letsencrypt_home)))
+
+    not_after = datetime.datetime.fromtimestamp(ssl.cert_time_to_seconds(cert["notAfter"]), datetime.timezone.utc)
+    if not_after - ctx.run_ts < datetime.timedelta(days=ctx.cfg.X509_RENEW_DAYS):
+        return (False, "certificate expires at {}".format(not_after.isoformat()))
+
+    san_names = set(v.lower() for (k, v) in cert.get("subjectAltName", ()) if k == "DNS")
+    missing   = [x for x in cert_names(ctx) if not name_covered(x.lower(), san_names)]
+    if missing:
+        return (False, "certificate does not cover: {}".format(" ".join(missing)))
+
+    if ctx.cfg.X509_KEY_TYPE and (cert["keyType"] != ctx.cfg.X509_KEY_TYPE):
+        return (False, "certificate key type is {}, not {} (X509_KEY_TYPE)".format(cert["keyType"], ctx.cfg.X509_KEY_TYPE))
+
+    return (True, "certificate valid until {}".format(not_after.isoformat()))
+
+# Returns the path of the certbot deploy hook installed by mkhost.
+def deploy_hook_path(letsencrypt_home):
+    return os.path.join(letsencrypt_home, "renewal-hooks", "deploy", "mkhost.sh")
+
+# Generates certbot deploy hook script. The hook reloads the TLS consumers
+# (Postfix and Dovecot) only, and only if the certificate or the key has
+# actually changed since the last reload.
+# Returns the script text.
+def gen_deploy_hook(ctx, letsencrypt_home):
+    return """#!/bin/sh
+# certbot deploy hook installed by mkhost: reloads Postfix and Dovecot if the
+# certificate of {name} has changed. Do not edit.
+set -e
+
+case "$RENEWED_LINEAGE" in
+    ""|*/live/{name}) ;;
+    *) exit 0 ;;
+esac
+
+cert='{cert}'
+key='{key}'
+state='{state}'
+
+digest=$(cat "$cert" "$key" | sha256sum)
+if [ -f "$state" ] && [ "$(cat "$state")" = "$digest" ]; then
+    exit 0
+fi
+
+systemctl reload postfix
+systemctl reload dovecot
+
+mkdir -p "$(dirname "$state")"
+echo "$digest" > "$state"
+""".format(name=cert_names(ctx)[0],
+           cert=cert_path(ctx, letsencrypt_home),
+           key=key_path(ctx, letsencrypt_home),
+           state=os.path.join(ctx.cfg.MKHOST_STATE_DIR, "tls.sha256"))
+
+# Writes out certbot deploy hook script (see gen_deploy_hook), if changed.
+def write_deploy_hook(ctx, letsencrypt_home):
+    path = deploy_hook_path(letsencrypt_home)
+    text = gen_deploy_hook(ctx, letsencrypt_home)
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                logging.debug("[letsencrypt] deploy hook up to date: {}".format(path))
+                return
+    except FileNotFoundError:
+        pass
+
+    logging.info("[letsencrypt] write deploy hook to {}".format(path))
+    if not ctx.dry_run:
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        os.chmod(path, 0o755)
+
+# Returns the list of packages required by Let's Encrypt setup.
+def packages():
+    return ["certbot", "openssl", "python3-certbot-apache"]
+
+# Returns the certbot command line (a list). The certificate is replaced
+# straight away if X509_KEY_TYPE is set and the key type of the current
+# certificate differs.
+#
+# Params:
+#   letsencrypt_home : Let's Encrypt home dir
+#   cert             : the current certificate (see read_cert), or None
+def certbot_cmd(ctx, letsencrypt_home, cert):
+    names    = cert_names(ctx)
+    key_type = cert and cert["keyType"]
+    wanted   = ctx.cfg.X509_KEY_TYPE or key_type
+    return ["certbot"] + \
+        (["certonly", "--dry-run"] if ctx.dry_run else ["run"]) + \
+        (["--non-interactive", "--agree-tos"] if ctx.non_interactive else []) + \
+        ["--email", "{}".format(ctx.cfg.X509_EMAIL)] + \
+        ["--apache", "--redirect", "--cert-name", names[0], "--expand"] + \
+        (["--key-type", wanted] if wanted else []) + \
+        (["--elliptic-curve", "secp256r1"] if (wanted == "ecdsa") else []) + \
+        (["--force-renewal"] if (key_type not in (None, wanted)) else []) + \
+        [y for x in names for y in ("--domain", x)]
+
+# Installs Let's Encrypt's certificate, unless the current one is still fine
+# (see cert_state).
+#
+# Params:
+#   letsencrypt_home : Let's Encrypt home dir
+def install(ctx, letsencrypt_home):
+    mkhost.unix.install_pkgs(ctx, packages())
+
+    cert         = read_cert(cert_path(ctx, letsencrypt_home))
+    (ok, reason) = cert_state(ctx, letsencrypt_home, cert)
+    if ok:
+        logging.info("[letsencrypt] skip certbot: {}".format(reason))
+    else:
+        logging.info("[letsencrypt] {}".format(reason))
+        mkhost.cmd.execute_cmd(ctx, certbot_cmd(ctx, letsencrypt_home, cert))
+
+    write_deploy_hook(ctx, letsencrypt_home)
+
+# Renews Let's Encrypt's certificate (if due), without re-configuring
+# anything else. Postfix and Dovecot are reloaded by the deploy hook (see
+# gen_deploy_hook), if the certificate has changed.
+#
+# Params:
+#   letsencrypt_home : Let's Encrypt home dir
+def renew(ctx, letsencrypt_home):
+    write_deploy_hook(ctx, letsencrypt_home)
+    mkhost.cmd.execute_cmd(ctx,
+        ["certbot", "renew", "--cert-name", cert_names(ctx)[0]] + \
+        (["--dry-run"] if ctx.dry_run else []) + \
+        (["--non-interactive"] if ctx.non_interactive else []))
@@ -0,0 +1,77 @@
+import logging
+
+##############################################################################
+# Lazy, structured logging helpers.
+#
+# Messages are formatted (str.format) only when a log record is actually
+# emitted, so that large collections can be logged on hot paths at no cost
+# when the log level is off. Per-item events (one per mailbox, mapping...) are
+# counted and summarized in a single INFO line; the items themselves are
+# logged at DEBUG level, or at INFO level in detail mode (see
+# mkhost.context.RunContext.log_detail).
+#
+# Structured event data is attached to the log records: record.event (event
+# name), record.count (summaries only) and record.fields (the event
+# arguments).
+##############################################################################
+
+# A log message with deferred str.format() formatting.
+class Fmt:
+    __slots__ = ("fmt", "args", "kwargs")
+
+    def __init__(self, fmt, *args, **kwargs):
+        self.fmt    = fmt
+        self.args   = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return self.fmt.format(*self.args, **self.kwargs)
+
+# Formats a count with a space as the thousands separator: 12 034.
+def fmt_count(n):
+    return "{:,}".format(n).replace(",", " ")
+
+def debug(fmt, *args, **kwargs):
+    logging.debug(Fmt(fmt, *args, **kwargs))
+
+def info(fmt, *args, **kwargs):
+    logging.info(Fmt(fmt, *args, **kwargs))
+
+# Returns the log level of per-item events (of the given run context).
+def detail_level(ctx):
+    return logging.INFO if ctx.log_detail else logging.DEBUG
+
+# Counts events of a kind and logs a summary line at INFO level when closed,
+# e.g. "[postfix] created 12 034 mailboxes". Each single event is logged at
+# detail level (see detail_level).
+#
+# Usage:
+#   with Events(ctx, "postfix.mailbox.create", "[postfix] create mailbox: {}", "[postfix] created {} mailboxes") as ev:
+#       for x in ...:
+#           ev.add(x)
+class Events:
+    def __init__(self, ctx, event, item_fmt, summary_fmt):
+        self.event       = event
+        self.item_fmt    = item_fmt
+        self.summary_fmt = summary_fmt
+        self.count       = 0
+        self.level       = detail_level(ctx)
+
+    # Records an event; args are the format arguments (and event fields).
+    def add(self, *args):
+        self.count += 1
+        if logging.getLogger().isEnabledFor(self.level):
+            logging.log(self.level, Fmt(self.item_fmt, *args), extra={"event": self.event, "fields": args})
+
+    # Logs the summary line (if any event has been recorded).
+    def close(self):
+        if self.count:
+            logging.info(Fmt(self.summary_fmt, fmt_count(self.count)),
+                         extra={"event": self.event, "count": self.count, "fields": ()})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
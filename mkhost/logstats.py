@@ -0,0 +1,281 @@
+import glob
+import gzip
+import json
+import logging
+import math
+import os
+import os.path
+import re
+
+import mkhost.cfg_parser
+import mkhost.common
+import mkhost.log
+
+##############################################################################
+# Mail log analyzer: delivery delays, deferral reasons, TLS usage and
+# authentication failures, per managed domain (mailbox and alias domains).
+#
+# The log (and its rotated files, gzipped or not) is streamed line by line.
+# Postfix queue IDs are correlated across lines (sender domain, inbound TLS),
+# and so are smtp/smtpd process IDs (TLS handshake => queue ID). Memory use is
+# bounded: delays go to a fixed histogram, correlation tables and deferral
+# reasons are capped.
+#
+# The log position (inode, byte offset) is saved in MKHOST_STATE_DIR, so that
+# every run only reads the lines logged since the previous one.
+##############################################################################
+
+MAX_PENDING = 100000    # max number of queue IDs / process IDs being correlated
+MAX_REASONS = 50        # max number of distinct deferral reasons per domain
+
+# Delay histogram bucket upper bounds (seconds): 10 ms to about 7 days, each
+# 25 % above the previous one.
+DELAY_BUCKETS = [0.01 * 1.25 ** k for k in range(93)]
+
+re_line      = re.compile(r'^\S+(?: +\d+ \S+)? \S+ (postfix(?:-\w+)?/[\w/-]+|dovecot)\[?(\d*)\]?: (.*)$')
+re_queue_id  = re.compile(r'^([0-9A-F]{6,}|[0-9B-DF-HJ-NP-TV-Zb-df-hj-np-tv-z]{10,}): (.*)$')
+re_from      = re.compile(r'^from=<([^>]*)>')
+re_delivery  = re.compile(r'^to=<([^>]*)>,.* delay=([\d.]+),.* status=(\w+)(?: \((.*)\))?$')
+re_tls       = re.compile(r'^(\w+) TLS connection established (from|to) ')
+re_sasl_fail = re.compile(r'SASL \S+ authentication failed:.*?(?:sasl_username=(\S+))?$')
+re_dovecot   = re.compile(r'auth failed.*user=<([^>]*)>')
+re_reason    = re.compile(r'\d+(?:\.\d+)+|\[[^\]]*\]|<[^>]*>|\b[0-9A-F]{8,}\b')
+
+# Returns the bucket index of the given delay (seconds).
+def delay_bucket(delay):
+    if delay <= DELAY_BUCKETS[0]:
+        return 0
+    return min(len(DELAY_BUCKETS) - 1, math.ceil(math.log(delay / DELAY_BUCKETS[0], 1.25)))
+
+# Returns the p-th percentile of the given histogram (bucket upper bound).
+def hist_percentile(hist, p):
+    n    = sum(hist)
+    rank = max(1, math.ceil(p / 100 * n))
+    acc  = 0
+    for (i, x) in enumerate(hist):
+        acc += x
+        if acc >= rank:
+            return DELAY_BUCKETS[i]
+    return None
+
+# Normalizes a deferral reason: drops addresses, numbers and queue IDs, so
+# that the same reason is counted once.
+def norm_reason(reason):
+    return re_reason.sub("*", reason)[:120]
+
+# Statistics of a domain, for one direction (inbound or outbound mail).
+class DomainStats:
+    def __init__(self):
+        self.sent     = 0
+        self.tls      = 0
+        self.deferred = 0
+        self.bounced  = 0
+        self.delays   = [0] * len(DELAY_BUCKETS)
+        self.reasons  = {}
+
+    def add_reason(self, reason):
+        reason = norm_reason(reason)
+        if (reason in self.reasons) or (len(self.reasons) < MAX_REASONS):
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        else:
+            self.reasons["(other)"] = self.reasons.get("(other)", 0) + 1
+
+    def to_json(self):
+        x = {"sent": self.sent, "tls": self.tls, "deferred": self.deferred, "bounced": self.bounced}
+        if self.sent:
+            x.update({"delay_p{}".format(p): round(hist_percentile(self.delays, p), 3) for p in (50, 90, 99)})
+        if self.reasons:
+            x["deferral_reasons"] = dict(sorted(self.reasons.items(), key=lambda kv: -kv[1])[:10])
+        return x
+
+# Mail log analyzer state.
+class LogStats:
+    def __init__(self, domains):
+        self.domains       = domains
+        self.inbound       = {}     # domain => DomainStats (mail to the domain)
+        self.outbound      = {}     # domain => DomainStats (mail from the domain, to other domains)
+        self.auth_failures = {}     # domain => count
+        self.queue         = {}     # queue ID => [sender domain, inbound TLS]
+        self.tls_pids      = {}     # smtp(d) process ID => TLS protocol (last connection)
+        self.lines         = 0
+
+    def _domain(self, addr):
+        d = mkhost.common.addr2dom(addr).lower()
+        return d if d in self.domains else None
+
+    @staticmethod
+    def _put(d, key, value):
+        d[key] = value
+        if len(d) > MAX_PENDING:
+            del d[next(iter(d))]    # the oldest one
+
+    def _auth_failure(self, user):
+        d = self._domain(user or "") or "(other)"
+        self.auth_failures[d] = self.auth_failures.get(d, 0) + 1
+
+    def add_line(self, line):
+        self.lines += 1
+        m = re_line.match(line)
+        if not m:
+            return
+        (prog, pid, msg) = m.groups()
+
+        if prog == "dovecot":
+            m = re_dovecot.search(msg)
+            if m:
+                self._auth_failure(m.group(1))
+            return
+
+        m = re_tls.match(msg)
+        if m:
+            self._put(self.tls_pids, (prog, pid), m.group(1))
+            return
+
+        m = re_sasl_fail.search(msg)
+        if m and msg.startswith("warning:"):
+            self._auth_failure(m.group(1))
+            return
+
+        m = re_queue_id.match(msg)
+        if not m:
+            if msg.startswith("disconnect from"):
+                self.tls_pids.pop((prog, pid), None)
+            return
+        (qid, rest) = m.groups()
+
+        if rest.startswith("client="):
+            self._put(self.queue, qid, [None, (prog, pid) in self.tls_pids])
+        elif rest.startswith("from="):
+            m = re_from.match(rest)
+            entry = self.queue.setdefault(qid, [None, False])
+            entry[0] = self._domain(m.group(1)) if m else None
+        elif rest == "removed":
+            self.queue.pop(qid, None)
+        else:
+            m = re_delivery.match(rest)
+            if m:
+                self._delivery(qid, prog, pid, *m.groups())
+
+    def _delivery(self, qid, prog, pid, rcpt, delay, status, reason):
+        (sender_dom, inbound_tls) = self.queue.get(qid, (None, False))
+        rcpt_dom = self._domain(rcpt)
+        if rcpt_dom:
+            (stats, tls) = (self.inbound.setdefault(rcpt_dom, DomainStats()), inbound_tls)
+        elif sender_dom:
+            (stats, tls) = (self.outbound.setdefault(sender_dom, DomainStats()), prog.endswith("/smtp") and ((prog, pid) in self.tls_pids))
+        else:
+            return
+
+        if status == "sent":
+            stats.sent += 1
+            stats.delays[delay_bucket(float(delay))] += 1
+            if tls:
+                stats.tls += 1
+        elif status == "deferred":
+            stats.deferred += 1
+            stats.add_reason(reason or status)
+        elif status == "bounced":
+            stats.bounced += 1
+            stats.add_reason(reason or status)
+
+    def to_json(self):
+        return {
+            "lines"         : self.lines,
+            "inbound"       : {k: v.to_json() for (k, v) in sorted(self.inbound.items())},
+            "outbound"      : {k: v.to_json() for (k, v) in sorted(self.outbound.items())},
+            "auth_failures" : dict(sorted(self.auth_failures.items())),
+        }
+
+##############################################################################
+# Log files
+##############################################################################
+
+def state_path(ctx):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "logstats.json")
+
+def read_state(ctx):
+    try:
+        with open(state_path(ctx)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.warning("ignoring log position {}: {}".format(state_path(ctx), e))
+        return {}
+
+def write_state(ctx, state):
+    os.makedirs(ctx.cfg.MKHOST_STATE_DIR, mode=0o700, exist_ok=True)
+    with open(state_path(ctx) + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path(ctx) + ".tmp", state_path(ctx))
+
+# Returns the rotated files of the given log, oldest first (e.g. mail.log.3.gz,
+# mail.log.2.gz, mail.log.1).
+def rotated_files(path):
+    def rank(x):
+        m = re.match(re.escape(path) + r'\.(\d+)(?:\.gz)?$', x)
+        return int(m.group(1)) if m else None
+    return sorted((x for x in glob.glob(glob.escape(path) + ".*") if rank(x) is not None), key=rank, reverse=True)
+
+# Returns the list of (path, start offset) to read, given the saved log
+# position: the whole log with its rotated files, the rest of the log, or
+# the rest of the rotated log (same inode) followed by the whole new log.
+def files_to_read(path, state):
+    inode = state.get("inode")
+    if inode is None:
+        return [(x, 0) for x in rotated_files(path)] + [(path, 0)]
+
+    st = os.stat(path)
+    if (st.st_ino == inode) and (st.st_size >= state["offset"]):
+        return [(path, state["offset"])]
+
+    for x in rotated_files(path):
+        if (not x.endswith(".gz")) and (os.stat(x).st_ino == inode):
+            return [(x, state["offset"]), (path, 0)]
+
+    logging.warning("[logstats] log rotated (and compressed) since the last run: some lines are skipped")
+    return [(path, 0)]
+
+# Streams the lines of the given log file from the given offset.
+# Yields (line, offset after the line); an incomplete last line is left out.
+def read_lines(path, offset):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            yield (line.decode(errors="replace").rstrip("\n"), offset)
+
+# Analyzes the given mail log (and its rotated files) from the saved position,
+# and writes the statistics (JSON) to the given stream. The position is saved,
+# except in dry run mode.
+#
+# Params:
+#   path     : mail log file
+#   out      : output stream
+#   from_all : if True, ignore the saved position (read all the rotated files)
+def report(ctx, path, out, from_all=False):
+    domains = set(x.lower() for x in mkhost.cfg_parser.get_mailbox_domains(ctx).union(mkhost.cfg_parser.get_alias_domains(ctx)))
+    stats   = LogStats(domains)
+    state   = {} if from_all else read_state(ctx)
+
+    # restore the queue IDs still in flight at the end of the previous run
+    for (qid, entry) in state.get("queue", {}).items():
+        stats.queue[qid] = entry
+
+    offset = 0
+    for (x, start) in files_to_read(path, state):
+        logging.info("[logstats] reading {} from offset {}".format(x, mkhost.log.fmt_count(start)))
+        offset = start
+        for (line, offset) in read_lines(x, start):
+            stats.add_line(line)
+
+    mkhost.log.info("[logstats] {} lines, {} queue IDs in flight",
+                    mkhost.log.fmt_count(stats.lines), mkhost.log.fmt_count(len(stats.queue)))
+    if not ctx.dry_run:
+        write_state(ctx, {"inode": os.stat(path).st_ino, "offset": offset, "queue": stats.queue})
+
+    json.dump(stats.to_json(), out, indent=2)
+    out.write(os.linesep)
@@ -0,0 +1,220 @@
+import functools
+import grp
+import logging
+import os
+import os.path
+import sqlite3
+
+import mkhost.cfg_parser
+import mkhost.common
+import mkhost.dovecot
+import mkhost.log
+
+##############################################################################
+# SQLite backend (MAIL_BACKEND = "sqlite"): a single database of virtual users
+# (password hashes), mailboxes and aliases, queried directly by Dovecot
+# (driver = sql) and Postfix (sqlite: lookup tables, through proxymap).
+#
+# Changes are applied as row-level upserts and deletes, in a single
+# transaction per table: nothing is rewritten, rebuilt (postmap) or reloaded.
+#
+# https://doc.dovecot.org/configuration_manual/authentication/sql/
+# http://www.postfix.org/sqlite_table.5.html
+##############################################################################
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailbox (
+  address  TEXT PRIMARY KEY,
+  password TEXT NOT NULL,
+  maildir  TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS alias (
+  source TEXT NOT NULL,
+  target TEXT NOT NULL,
+  PRIMARY KEY (source, target)
+) WITHOUT ROWID;
+"""
+
+# Returns the path of the Dovecot SQL configuration file (passdb and userdb).
+def dovecot_conf_path(ctx):
+    return ctx.cfg.DOVECOT_USERS_DB + ".sql.conf.ext"
+
+# Returns the path of the Postfix sqlite lookup table definition which
+# replaces the given (hash) map.
+def postfix_cf_path(map_path):
+    return map_path + ".sqlite.cf"
+
+# Returns the Postfix lookup table of the given map: sqlite (through proxymap,
+# as chrooted daemons cannot reach the database), or hash.
+def postfix_map(ctx, map_path):
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        return "proxy:sqlite:{}".format(postfix_cf_path(map_path))
+    return "hash:{}".format(map_path)
+
+# Generates the Dovecot SQL configuration file.
+# Returns a list of lines.
+def gen_dovecot_conf(ctx):
+    return [
+        mkhost.common.mkhost_header(ctx),
+        "driver              = sqlite",
+        "connect             = {}".format(ctx.cfg.MAIL_DB),
+        "default_pass_scheme = {}".format(ctx.cfg.DOVECOT_PWD_SCHEME),
+        "password_query      = SELECT address AS user, password FROM mailbox WHERE address = '%u'",
+        "user_query          = SELECT address AS user FROM mailbox WHERE address = '%u'",
+        "iterate_query       = SELECT address AS user FROM mailbox",
+    ]
+
+# Generates the Postfix sqlite lookup table definitions.
+# Returns a dictionary: path => list of lines.
+def gen_postfix_cfs(ctx):
+    query = {
+        ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP : "SELECT maildir FROM mailbox WHERE address = '%s'",
+        ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP   : "SELECT target FROM alias WHERE source = '%s'",
+    }
+    return {postfix_cf_path(k): [mkhost.common.mkhost_header(ctx),
+                                 "dbpath = {}".format(ctx.cfg.MAIL_DB),
+                                 "query  = {}".format(v)] for (k, v) in query.items()}
+
+# Writes the Dovecot SQL configuration file (readable by root only, like the
+# database itself is readable by root and Postfix only).
+def write_dovecot_conf(ctx):
+    return mkhost.common.write_file(ctx, dovecot_conf_path(ctx), os.linesep.join(gen_dovecot_conf(ctx)) + os.linesep, mode=0o600)
+
+# Writes the Postfix sqlite lookup table definitions.
+# Returns True if any file has been written.
+def write_postfix_cfs(ctx):
+    return any([mkhost.common.write_file(ctx, k, os.linesep.join(v) + os.linesep) for (k, v) in gen_postfix_cfs(ctx).items()])
+
+##############################################################################
+# Database
+##############################################################################
+
+# Opens the mail database; creates it (root:postfix, mode 0640) if missing.
+# In dry run mode, the database is opened read-only.
+# Returns a connection, or None (dry run mode and no database yet).
+def connect(ctx):
+    if ctx.dry_run:
+        if not os.path.isfile(ctx.cfg.MAIL_DB):
+            return None
+        return sqlite3.connect("file:{}?mode=ro".format(ctx.cfg.MAIL_DB), uri=True)
+
+    exists = os.path.isfile(ctx.cfg.MAIL_DB)
+    if not exists:
+        logging.info("[maildb] create database: {}".format(ctx.cfg.MAIL_DB))
+        os.makedirs(os.path.dirname(ctx.cfg.MAIL_DB), mode=0o755, exist_ok=True)
+    conn = sqlite3.connect(ctx.cfg.MAIL_DB)
+    if not exists:
+        conn.executescript(SCHEMA)
+        os.chown(ctx.cfg.MAIL_DB, 0, grp.getgrnam("postfix").gr_gid)
+        os.chmod(ctx.cfg.MAIL_DB, 0o640)
+    return conn
+
+# Reads the mailbox table.
+# Returns a dictionary: address => (password hash, maildir).
+def read_mailboxes(conn):
+    if conn is None:
+        return {}
+    return {x[0]: (x[1], x[2]) for x in conn.execute("SELECT address, password, maildir FROM mailbox")}
+
+# Reads the alias table.
+# Returns a set of pairs: (source, target).
+def read_aliases(conn):
+    if conn is None:
+        return set()
+    return set(conn.execute("SELECT source, target FROM alias"))
+
+# Given the current mailbox rows, computes the target rows: the virtual
+# mailboxes (MAILBOXES). Existing password hashes are kept; new mailboxes
+# get the password hash of the Dovecot passwd-file (DOVECOT_USERS_DB), if
+# any (switch from the "files" backend), or a new one.
+# Returns a dictionary: address => (password hash, maildir).
+#
+# Params:
+#   pwd_hash : function which returns a password hash for the given (new)
+#              username; default: mkhost.dovecot.gen_pwd_hash
+def gen_mailboxes(ctx, old_rows, pwd_hash=None):
+    pwd_hash    = pwd_hash or functools.partial(mkhost.dovecot.gen_pwd_hash, ctx)
+    file_hashes = None
+    rows        = {}
+    for x in sorted(mkhost.cfg_parser.get_virtual_mailboxes(ctx)):
+        (user, domain) = mkhost.common.parse_addr(x)
+        maildir = "{}/{}/mail/".format(domain, user)
+        if x in old_rows:
+            rows[x] = (old_rows[x][0], maildir)
+        else:
+            if file_hashes is None:
+                file_hashes = mkhost.dovecot.read_users_db(ctx)
+            rows[x] = (file_hashes.get(x) or pwd_hash(x), maildir)
+    return rows
+
+# Given MAIL_FORWARDING (in the config file), computes the target alias rows.
+# Returns a set of pairs: (source, target).
+def gen_aliases(ctx):
+    table = mkhost.cfg_parser.get_addr_table(ctx)
+    return set((table.addr(table.source(si)), table.addr(y))
+               for si in range(table.num_sources()) for y in table.targets(si))
+
+# Dumps the given rows as text lines (passwords left out), e.g. for plan diffs.
+# Returns a list of lines.
+def dump(mailboxes, aliases):
+    return ["mailbox {} {}".format(k, v[1]) for (k, v) in sorted(mailboxes.items())] + \
+           ["alias {} {}".format(k, v) for (k, v) in sorted(aliases)]
+
+# Upserts and deletes mailbox rows, so that the mailbox table matches
+# MAILBOXES (in the config file).
+#
+# Params:
+#   pwd_hash : function which returns a password hash for the given (new)
+#              username; default: mkhost.dovecot.gen_pwd_hash
+def sync_mailboxes(ctx, pwd_hash=None):
+    conn = connect(ctx)
+    try:
+        old_rows = read_mailboxes(conn)
+        new_rows = gen_mailboxes(ctx, old_rows, pwd_hash)
+        upserts  = sorted((k, v[0], v[1]) for (k, v) in new_rows.items() if old_rows.get(k) != v)
+        deletes  = sorted((k,) for k in old_rows if k not in new_rows)
+
+        with mkhost.log.Events(ctx, "maildb.mailbox.upsert", "[maildb] upsert mailbox: {}", "[maildb] upserted {} mailboxes") as ev:
+            for x in upserts:
+                ev.add(x[0])
+        with mkhost.log.Events(ctx, "maildb.mailbox.delete", "[maildb] delete mailbox: {}", "[maildb] deleted {} mailboxes") as ev:
+            for x in deletes:
+                ev.add(x[0])
+
+        if (conn is not None) and not ctx.dry_run:
+            with conn:
+                conn.executemany("INSERT INTO mailbox (address, password, maildir) VALUES (?, ?, ?) "
+                                 "ON CONFLICT (address) DO UPDATE SET password = excluded.password, maildir = excluded.maildir",
+                                 upserts)
+                conn.executemany("DELETE FROM mailbox WHERE address = ?", deletes)
+            if upserts or deletes:
+                mkhost.dovecot.flush_auth_cache(ctx)
+    finally:
+        if conn is not None:
+            conn.close()
+
+# Inserts and deletes alias rows, so that the alias table matches
+# MAIL_FORWARDING (in the config file).
+def sync_aliases(ctx):
+    conn = connect(ctx)
+    try:
+        old_rows = read_aliases(conn)
+        new_rows = gen_aliases(ctx)
+        inserts  = sorted(new_rows.difference(old_rows))
+        deletes  = sorted(old_rows.difference(new_rows))
+
+        with mkhost.log.Events(ctx, "maildb.alias.create", "[maildb] create alias: {} => {}", "[maildb] created {} aliases") as ev:
+            for x in inserts:
+                ev.add(*x)
+        with mkhost.log.Events(ctx, "maildb.alias.delete", "[maildb] delete alias: {} => {}", "[maildb] deleted {} aliases") as ev:
+            for x in deletes:
+                ev.add(*x)
+
+        if (conn is not None) and not ctx.dry_run:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO alias (source, target) VALUES (?, ?)", inserts)
+                conn.executemany("DELETE FROM alias WHERE source = ? AND target = ?", deletes)
+    finally:
+        if conn is not None:
+            conn.close()
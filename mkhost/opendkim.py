@@ -1,4 +1,4 @@
-import copy
+import base64
 import logging
 import os.path
 import pathlib
@@ -6,56 +6,173 @@ import re
 import shutil
 import tempfile
 
-import mkhost.cfg
 import mkhost.cfg_parser
+import mkhost.cmd
 import mkhost.common
+import mkhost.log
 import mkhost.unix
 
+# Debian: opendkim.service starts the daemon with the options of this file
+# (e.g. -p $SOCKET, which overrides Socket in opendkim.conf), through a unit
+# override generated by the script below.
+OPENDKIM_DEFAULTS = "/etc/default/opendkim"
+OPENDKIM_GENERATE = "/lib/opendkim/opendkim.service.generate"
+
 re_key_value = re.compile(
     '^(\w+)\s+(\S+)\s*$', re.ASCII)
+re_selector = re.compile(
+    '[0-9]{14}(?:-(\w+))?', re.ASCII)
 
-OPENDKIM_CONFIG = {
-    "AllowSHA1Only"    : False,
-    "KeyTable"         : mkhost.cfg.OPENDKIM_KEYTABLE,
-    "LogResults"       : True,
-    "LogWhy"           : True,
-    "Mode"             : "sv",
-    "RequireSafeKeys"  : True,
-    "SyslogSuccess"    : True,
-}
+# Given a table file path, returns OpenDKIM table reference: type and path.
+#
+# Params:
+#   refile : whether this table can be a regular expression file
+def table_ref(ctx, path, refile=False):
+    if ctx.cfg.OPENDKIM_TABLE_TYPE == "db":
+        return "db:{}.db".format(path)
+    elif refile:
+        return "refile:{}".format(path)
+    else:
+        return path
 
-def gen_selector():
-    return mkhost.common.get_run_ts().strftime("%Y%m%d%H%M%S")
+# Returns OpenDKIM settings managed by mkhost (see gen_conf), from the
+# configuration of the current run.
+# Returns a dictionary: setting => value.
+def opendkim_config(ctx):
+    return {
+        "AllowSHA1Only"      : False,
+        "KeyTable"           : table_ref(ctx, ctx.cfg.OPENDKIM_KEYTABLE),
+        "LogResults"         : True,
+        "LogWhy"             : True,
+        "Mode"               : "sv",
+        "MultipleSignatures" : (len(ctx.cfg.OPENDKIM_KEY_ALGORITHMS) > 1),
+        "RequireSafeKeys"    : True,
+        "SigningTable"       : table_ref(ctx, ctx.cfg.OPENDKIM_SIGNINGTABLE, refile=True),
+        "Socket"             : "local:{}".format(ctx.cfg.OPENDKIM_SOCKET),
+        "SyslogSuccess"      : True,
+        "UMask"              : "007",
+        "UserID"             : "opendkim",
+    }
 
-# Generates and writes out OpenDKIM keytable file (mkhost.cfg.OPENDKIM_KEYTABLE).
-def write_keytable():
-    selector = gen_selector()
-    domains  = mkhost.cfg_parser.get_mailbox_domains()
+# Given a key algorithm, returns the selector of the key generated by this run.
+# RSA selectors are just timestamps; the other ones are suffixed with the
+# algorithm name.
+def gen_selector(ctx, algorithm="rsa"):
+    ts = ctx.run_ts.strftime("%Y%m%d%H%M%S")
+    return ts if (algorithm == "rsa") else "{}-{}".format(ts, algorithm)
+
+# Returns the selectors of the keys found under OPENDKIM_KEYS (the latest one,
+# if a domain has several keys of the same algorithm).
+# Returns a dictionary: (domain, key algorithm) => selector.
+def current_selectors(ctx):
+    selectors = {}
+    try:
+        domains = os.listdir(ctx.cfg.OPENDKIM_KEYS)
+    except FileNotFoundError:
+        return selectors
+    for d in domains:
+        domain_dir = os.path.join(ctx.cfg.OPENDKIM_KEYS, d)
+        if os.path.isdir(domain_dir):
+            for x in os.listdir(domain_dir):
+                m = re_selector.fullmatch(x[:-len(".private")]) if x.endswith(".private") else None
+                if m:
+                    k = (d, m.group(1) or "rsa")
+                    selectors[k] = max(selectors.get(k, ""), m.group(0))
+    return selectors
 
-    # create new config file
+# Returns the selector of the key of the given domain and algorithm: the
+# current one (see current_selectors), or the one generated by this run.
+def key_selector(ctx, selectors, domain, algorithm):
+    return selectors.get((domain, algorithm)) or gen_selector(ctx, algorithm)
+
+# Given a domain and a selector, returns the name of the key (in the keytable).
+def key_name(domain, selector):
+    return "{}._domainkey.{}".format(selector, domain)
+
+# Generates OpenDKIM keytable file (mkhost.cfg.OPENDKIM_KEYTABLE): a key per
+# mailbox domain and key algorithm.
+# Returns a list of lines.
+def gen_keytable(ctx):
+    domains   = mkhost.cfg_parser.get_mailbox_domains(ctx)
+    selectors = current_selectors(ctx)
+    lines     = []
+
+    ev       = mkhost.log.Events(ctx, "opendkim.keytable.add", "opendkim keytable: {}", "opendkim keytable: {} domains")
+
+    for d in sorted(domains):
+        ev.add(d)
+        for alg in ctx.cfg.OPENDKIM_KEY_ALGORITHMS:
+            selector = key_selector(ctx, selectors, d, alg)
+            pk_path  = os.path.join(ctx.cfg.OPENDKIM_KEYS, d, "{}.private".format(selector))     # private key file
+            lines.append("{:<40} {}:{}:{}".format(key_name(d, selector), d, selector, pk_path))
+            # TODO: fix column alignment; check the length of the longest domain
+
+    ev.close()
+    return lines
+
+# Generates OpenDKIM signing table file (mkhost.cfg.OPENDKIM_SIGNINGTABLE): every
+# mailbox domain is signed with its own key(s).
+# Returns a list of lines.
+def gen_signingtable(ctx):
+    domains   = mkhost.cfg_parser.get_mailbox_domains(ctx)
+    selectors = current_selectors(ctx)
+    pattern   = "{}" if (ctx.cfg.OPENDKIM_TABLE_TYPE == "db") else "*@{}"
+    return ["{:<40} {}".format(pattern.format(d), key_name(d, key_selector(ctx, selectors, d, alg)))
+            for d in sorted(domains) for alg in ctx.cfg.OPENDKIM_KEY_ALGORITHMS]
+
+# Returns db_load command line (a list), which compiles a Berkeley DB hash table.
+def db_load_cmd(path):
+    return ["db_load", "-T", "-t", "hash", path]
+
+# Compiles the given table file (lines of: key value) to an indexed Berkeley DB
+# hash table: path + ".db". The table is replaced atomically.
+def compile_table(path, lines):
+    db_path  = "{}.db".format(path)
+    tmp_path = "{}.mkhost-tmp".format(db_path)
+    pairs    = [x.split(None, 1) for x in lines]
+
+    logging.info("compile opendkim table {} to {}".format(path, db_path))
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    mkhost.cmd.execute_cmd_batch(db_load_cmd(tmp_path),
+                                 input="".join("{}\n{}\n".format(k, v) for (k, v) in pairs))
+    os.replace(tmp_path, db_path)
+
+# Writes out the given lines to an OpenDKIM table file; compiles it if
+# OPENDKIM_TABLE_TYPE is "db".
+def write_table(ctx, path, lines):
+    # create new table file
     with tempfile.NamedTemporaryFile(mode="wt", prefix="mkhost-", delete=True) as f:
         logging.debug("temp file: {}".format(f.name))
-        for d in domains:
-            logging.info("opendkim keytable: {}".format(d))
-            pk_path  = os.path.join(mkhost.cfg.OPENDKIM_KEYS, d, "{}.private".format(selector))     # private key file
-            key_name = d                                                                            # key name is just the domain name
-            print("{:<40} {}:{}:{}".format(key_name, d, selector, pk_path), file=f)
-            # TODO: fix column alignment; check the length of the longest domain
+        for x in lines:
+            print(x, file=f)
 
-        # overwrite the old config file
-        if not mkhost.common.get_dry_run():
+        # overwrite the old table file
+        if not ctx.dry_run:
             f.flush()
-            logging.info("write opendkim keytable to {}".format(mkhost.cfg.OPENDKIM_KEYTABLE))
-            shutil.copyfile(f.name, mkhost.cfg.OPENDKIM_KEYTABLE)
+            logging.info("write opendkim table to {}".format(path))
+            shutil.copyfile(f.name, path)
+            if ctx.cfg.OPENDKIM_TABLE_TYPE == "db":
+                compile_table(path, lines)
+
+# Generates and writes out OpenDKIM keytable file (mkhost.cfg.OPENDKIM_KEYTABLE).
+def write_keytable(ctx):
+    write_table(ctx, ctx.cfg.OPENDKIM_KEYTABLE, gen_keytable(ctx))
+
+# Generates and writes out OpenDKIM signing table file (mkhost.cfg.OPENDKIM_SIGNINGTABLE).
+def write_signingtable(ctx):
+    write_table(ctx, ctx.cfg.OPENDKIM_SIGNINGTABLE, gen_signingtable(ctx))
 
-# Generates and writes out OpenDKIM config file (mkhost.cfg.OPENDKIM_CONF).
-def write_conf():
-    new_cfg   = copy.deepcopy(OPENDKIM_CONFIG)
+# Generates OpenDKIM config file (mkhost.cfg.OPENDKIM_CONF).
+# Returns a list of lines.
+def gen_conf(ctx):
+    all_cfg   = opendkim_config(ctx)
+    new_cfg   = dict(all_cfg)
     old_lines = []
 
     try:
         # Parse the existing configuration file
-        with open(mkhost.cfg.OPENDKIM_CONF) as f:
+        with open(ctx.cfg.OPENDKIM_CONF) as f:
             for line in map(lambda x: x.rstrip(), f):
                 if mkhost.common.re_comment.match(line):
                     old_lines.append(line)
@@ -69,53 +186,113 @@ def write_conf():
                         val = m.group(2)
 
                         # logging.debug("opendkim: {} => {}".format(key,val))
-                        if (key not in OPENDKIM_CONFIG) or (str(OPENDKIM_CONFIG[key]) == val):
-                            logging.debug("opendkim save: {} => {}".format(key,val))
+                        if (key not in all_cfg) or (str(all_cfg[key]) == val):
+                            mkhost.log.debug("opendkim save: {} => {}", key, val)
                             old_lines.append(line)
                             new_cfg.pop(key,None)
                         else:
-                            logging.debug("opendkim drop: {} => {}".format(key,val))
+                            mkhost.log.debug("opendkim drop: {} => {}", key, val)
                     else:
-                        logging.warning("{}: invalid line: {}".format(mkhost.cfg.OPENDKIM_CONF, line))
+                        logging.warning("{}: invalid line: {}".format(ctx.cfg.OPENDKIM_CONF, line))
     except FileNotFoundError:
-        logging.warning("OpenDKIM config file does not exist: {}".format(mkhost.cfg.OPENDKIM_CONF))
+        logging.warning("OpenDKIM config file does not exist: {}".format(ctx.cfg.OPENDKIM_CONF))
 
-    # create new config file
-    with tempfile.NamedTemporaryFile(mode="wt", prefix="mkhost-", delete=True) as f:
-        logging.debug("temp file: {}".format(f.name))
-        if old_lines:
-            print(os.linesep.join(old_lines), file=f)
-        if new_cfg:
-            print(mkhost.common.mkhost_header(), file=f)
-            for x,y in new_cfg.items():
-                logging.info("opendkim  new: {} => {}".format(x,y))
-                print("{:<24} {}".format(x,y), file=f)
-
-        # overwrite the old config file
-        if not mkhost.common.get_dry_run():
-            f.flush()
-            logging.info("write opendkim config to {}".format(mkhost.cfg.OPENDKIM_CONF))
-            shutil.copyfile(f.name, mkhost.cfg.OPENDKIM_CONF)
+    lines = old_lines
+    if new_cfg:
+        lines.append(mkhost.common.mkhost_header(ctx))
+        for x,y in new_cfg.items():
+            logging.info("opendkim  new: {} => {}".format(x,y))
+            lines.append("{:<24} {}".format(x,y))
+
+    return lines
+
+# Generates and writes out OpenDKIM config file (mkhost.cfg.OPENDKIM_CONF), if
+# changed.
+# Returns True if the file has been written.
+def write_conf(ctx):
+    lines = gen_conf(ctx)
+    return mkhost.common.write_file(ctx, ctx.cfg.OPENDKIM_CONF, (os.linesep.join(lines) + os.linesep) if lines else "")
+
+# Generates OpenDKIM defaults file (see OPENDKIM_DEFAULTS): the existing one,
+# with the socket of the configuration (OPENDKIM_SOCKET).
+# Returns the file text, or None if there is no defaults file (not Debian).
+def gen_defaults(ctx):
+    try:
+        with open(OPENDKIM_DEFAULTS) as f:
+            lines = [x.rstrip() for x in f if not x.startswith("SOCKET=")]
+    except FileNotFoundError:
+        return None
+    return os.linesep.join(lines + ["SOCKET=local:{}".format(ctx.cfg.OPENDKIM_SOCKET)]) + os.linesep
+
+# Writes out OpenDKIM defaults file (see gen_defaults), if changed, and
+# regenerates the opendkim.service override from it.
+# Returns True if the file has been written.
+def write_defaults(ctx):
+    text = gen_defaults(ctx)
+    if (text is None) or not mkhost.common.write_file(ctx, OPENDKIM_DEFAULTS, text):
+        return False
+
+    if not ctx.dry_run:
+        if os.path.isfile(OPENDKIM_GENERATE):
+            mkhost.cmd.execute_cmd(ctx, [OPENDKIM_GENERATE])
+        mkhost.cmd.execute_cmd(ctx, ["systemctl", "daemon-reload"])
+    return True
+
+# Returns opendkim-genkey command line (a list).
+def genkey_cmd(domain, selector, directory):
+    return ["opendkim-genkey", "-a", "-r", "-d", domain, "-s", selector, "-D", directory]
+
+# Returns the command line (a list) which generates an Ed25519 private key file.
+def ed25519_genkey_cmd(path):
+    return ["openssl", "genpkey", "-algorithm", "ed25519", "-out", path]
+
+# Returns the command line (a list) which prints the (PEM) public key of the
+# given private key file.
+def ed25519_pubkey_cmd(path):
+    return ["openssl", "pkey", "-in", path, "-pubout"]
+
+# Given a domain name and a selector, generates an Ed25519 key pair in the
+# given directory: selector.private (private key) and selector.txt (DNS record),
+# as opendkim-genkey does for RSA.
+async def ed25519_genkey_async(ctx, domain, selector, directory):
+    pk_path = os.path.join(directory, "{}.private".format(selector))
+    await mkhost.cmd.execute_cmd_batch_async(ctx, ed25519_genkey_cmd(pk_path))
+    os.chmod(pk_path, 0o600)
+
+    # the raw public key is the last 32 bytes of the DER-encoded SubjectPublicKeyInfo
+    pem    = (await mkhost.cmd.execute_cmd_batch_async(ctx, ed25519_pubkey_cmd(pk_path)))[0]
+    der    = base64.b64decode("".join(x for x in pem if not x.startswith("-----")))
+    pubkey = base64.b64encode(der[-32:]).decode("ascii")
+
+    with open(os.path.join(directory, "{}.txt".format(selector)), "w") as f:
+        print('{}._domainkey.{}.\tIN\tTXT\t( "v=DKIM1; k=ed25519; s=email; "\n\t  "p={}" )  ; ----- DKIM key {} for {}'.format(
+            selector, domain, pubkey, selector, domain), file=f)
 
 # Given a domain name, generates a selector, a public-private key pair
-# and writes them to a file.
-def genkey(domain):
-    selector = gen_selector()
-    logging.info("opendkim-genkey selector: {}; domain: {}".format(selector, domain))
+# and writes them to a file (asynchronously).
+#
+# Params:
+#   algorithm : key algorithm: rsa or ed25519
+#   ev        : mkhost.log.Events the new key is recorded in
+async def genkey_async(ctx, domain, algorithm, ev):
+    selector = gen_selector(ctx, algorithm)
+    ev.add(selector, domain, algorithm)
 
-    if not mkhost.common.get_dry_run():
-        domain_dir = os.path.join(mkhost.cfg.OPENDKIM_KEYS, domain)
+    if not ctx.dry_run:
+        domain_dir = os.path.join(ctx.cfg.OPENDKIM_KEYS, domain)
         os.makedirs(domain_dir, mode=0o755, exist_ok=True)
 
     try:
         tempdir = tempfile.mkdtemp(prefix="mkhost-")
         logging.debug("tempdir: {}".format(tempdir))
-        mkhost.cmd.execute_cmd([
-            "opendkim-genkey", "-a", "-r", "-d", domain, "-s", selector, "-D", tempdir])
+        if algorithm == "ed25519":
+            await ed25519_genkey_async(ctx, domain, selector, tempdir)
+        else:
+            await mkhost.cmd.execute_cmd_async(ctx, genkey_cmd(domain, selector, tempdir), batch=True)
 
-        if not mkhost.common.get_dry_run():
+        if not ctx.dry_run:
             dns_rec_file = os.path.join(tempdir, "{}.txt".format(selector))
-            mkhost.common.add_dns_record(pathlib.Path(dns_rec_file).read_text())
+            ctx.dns_log.add_record(pathlib.Path(dns_rec_file).read_text())
             shutil.move(dns_rec_file, domain_dir)
             shutil.move(os.path.join(tempdir, "{}.private".format(selector)), domain_dir)
     except shutil.Error as e:
@@ -125,19 +302,49 @@ def genkey(domain):
         shutil.rmtree(tempdir, ignore_errors=True)
         raise
 
-# Installs and configures OpenDKIM.
-def install():
-    mkhost.unix.install_pkgs(["opendkim", "opendkim-tools"])
+# Returns the list of packages required by OpenDKIM setup.
+def packages(ctx):
+    return ["opendkim", "opendkim-tools"] + (["db-util"] if (ctx.cfg.OPENDKIM_TABLE_TYPE == "db") else [])
 
-    domains = mkhost.cfg_parser.get_alias_domains()
-    logging.info("alias_domains: {}".format(domains))
-    for d in domains:
-        genkey(d)
+# Generates keys for the domains which have none yet (per key algorithm; the
+# existing keys are kept, see current_selectors); writes out the key table,
+# the signing table and the configuration file.
+# Returns True if the configuration file has been written.
+#
+# Params:
+#   new_domains : if not None, only generate keys for these domains (e.g. the
+#                 domains just added, see mkhost.watch)
+def setup_keys(ctx, new_domains=None):
+    alias_domains = mkhost.cfg_parser.get_alias_domains(ctx)
+    mkhost.log.debug("alias_domains: {}", alias_domains)
 
-    domains = mkhost.cfg_parser.get_mailbox_domains()
-    logging.info("mailbox_domains: {}".format(domains))
-    for d in domains:
-        genkey(d)
+    mailbox_domains = mkhost.cfg_parser.get_mailbox_domains(ctx)
+    mkhost.log.debug("mailbox_domains: {}", mailbox_domains)
+
+    logging.info("opendkim: {} alias domains, {} mailbox domains".format(
+        mkhost.log.fmt_count(len(alias_domains)), mkhost.log.fmt_count(len(mailbox_domains))))
+
+    # generate the missing keys concurrently
+    selectors = current_selectors(ctx)
+    domains   = alias_domains.union(mailbox_domains)
+    if new_domains is not None:
+        domains.intersection_update(new_domains)
+    with mkhost.log.Events(ctx, "opendkim.genkey", "opendkim-genkey selector: {}; domain: {}; algorithm: {}",
+                           "opendkim-genkey: {} new keys") as ev:
+        mkhost.cmd.run_async(*(genkey_async(ctx, d, x, ev)
+                               for d in sorted(domains)
+                               for x in ctx.cfg.OPENDKIM_KEY_ALGORITHMS
+                               if (d, x) not in selectors))
+
+    write_keytable(ctx)
+    write_signingtable(ctx)
+    return write_conf(ctx)
 
-    write_keytable()
-    write_conf()
+# Installs and configures OpenDKIM; restarts it if its configuration (or its
+# socket) has changed.
+def install(ctx):
+    mkhost.unix.install_pkgs(ctx, packages(ctx))
+    changed = setup_keys(ctx)
+    changed = write_defaults(ctx) or changed
+    if changed and not ctx.dry_run:
+        mkhost.cmd.execute_cmd(ctx, ["systemctl", "restart", "opendkim"])
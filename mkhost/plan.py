@@ -0,0 +1,305 @@
+import difflib
+import grp
+import logging
+import os
+import os.path
+import subprocess
+import time
+
+import mkhost.cfg_parser
+import mkhost.cmd
+import mkhost.common
+import mkhost.dovecot
+import mkhost.letsencrypt
+import mkhost.maildb
+import mkhost.opendkim
+import mkhost.postfix
+import mkhost.resolver
+import mkhost.storage
+import mkhost.systemd
+import mkhost.unix
+
+# Plan of changes to be applied to this machine: unified diffs of the target
+# files and a list of commands to be run.
+class Plan:
+    def __init__(self):
+        # A list of unified diffs (strings).
+        self.diffs = []
+        # A list of command lines (lists).
+        self.commands = []
+
+    # Compares the given file with its new text; records a diff, if any.
+    # Returns True if the file would change.
+    def add_file(self, path, new_text):
+        try:
+            with open(path) as f:
+                old_text = f.read()
+            fromfile = path
+        except FileNotFoundError:
+            old_text = ""
+            fromfile = os.devnull
+
+        return self.add_text(fromfile, path, old_text, new_text)
+
+    # Compares 2 texts; records a diff, if any.
+    # Returns True if the texts differ.
+    def add_text(self, fromfile, tofile, old_text, new_text):
+        if old_text == new_text:
+            return False
+
+        self.diffs.append("".join(difflib.unified_diff(
+            old_text.splitlines(keepends=True),
+            new_text.splitlines(keepends=True),
+            fromfile=fromfile,
+            tofile=tofile)))
+        return True
+
+    def add_cmd(self, cmdline):
+        self.commands.append(cmdline)
+
+    def __bool__(self):
+        return bool(self.diffs or self.commands)
+
+    def __str__(self):
+        lines = self.diffs + ["Planned commands: {}".format(len(self.commands))]
+        lines.extend("  {}".format(" ".join(x)) for x in self.commands)
+        return os.linesep.join(lines)
+
+# Joins the given lines into a file text.
+def lines2text(lines):
+    return (os.linesep.join(lines) + os.linesep) if lines else ""
+
+# Reads the current (non-default) Postfix configuration with a single postconf call.
+# Returns a dictionary.
+def read_postconf():
+    try:
+        out_lines = mkhost.cmd.execute_cmd_batch(["postconf", "-n"])[0]
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        logging.warning("cannot read Postfix configuration: {}".format(e))
+        return {}
+
+    conf = {}
+    for x in out_lines:
+        (key, _, val) = x.partition('=')
+        conf[key.strip()] = val.strip()
+    return conf
+
+def plan_pkgs(ctx, plan):
+    installed = mkhost.unix.get_installed_pkgs()
+    pkgs      = mkhost.resolver.packages(ctx) + \
+                mkhost.letsencrypt.packages() + \
+                mkhost.opendkim.packages(ctx) + \
+                mkhost.dovecot.packages(ctx)  + \
+                mkhost.postfix.packages(ctx)
+    missing   = [x for x in pkgs if x not in installed]
+    if missing:
+        plan.add_cmd(mkhost.unix.apt_get_cmd(ctx, "install", *missing))
+
+def plan_resolver(ctx, plan):
+    if not ctx.cfg.RESOLVER_LOCAL:
+        saved = mkhost.resolver.saved_resolv_conf_path(ctx)
+        if os.path.isfile(saved) and not os.path.islink(mkhost.resolver.RESOLV_CONF):
+            with open(saved) as f:
+                plan.add_file(mkhost.resolver.RESOLV_CONF, f.read())
+        return
+
+    text = lines2text(mkhost.resolver.gen_conf(ctx))
+    if mkhost.common.file_changed(mkhost.resolver.UNBOUND_CONF, text):
+        plan.add_file(mkhost.resolver.UNBOUND_CONF, text)
+        plan.add_cmd(["systemctl", "restart", "unbound"])
+    if not os.path.islink(mkhost.resolver.RESOLV_CONF):
+        plan.add_file(mkhost.resolver.RESOLV_CONF, mkhost.resolver.gen_resolv_conf())
+
+def plan_systemd(ctx, plan):
+    if not ctx.cfg.SYSTEMD_DROPINS:
+        return
+
+    changed = []
+    for (x, (path, text)) in sorted(mkhost.systemd.gen_dropins(ctx).items()):
+        if mkhost.common.file_changed(path, text):
+            plan.add_file(path, text)
+            changed.append(mkhost.systemd.UNITS[x][1])
+    if changed:
+        plan.add_cmd(["systemctl", "daemon-reload"])
+        plan.add_cmd(["systemctl", "try-restart"] + changed)
+
+def plan_letsencrypt(ctx, plan, letsencrypt_home):
+    cert         = mkhost.letsencrypt.read_cert(mkhost.letsencrypt.cert_path(ctx, letsencrypt_home))
+    (ok, reason) = mkhost.letsencrypt.cert_state(ctx, letsencrypt_home, cert)
+    if not ok:
+        logging.info("[letsencrypt] {}".format(reason))
+        plan.add_cmd(mkhost.letsencrypt.certbot_cmd(ctx, letsencrypt_home, cert))
+
+    plan.add_file(mkhost.letsencrypt.deploy_hook_path(letsencrypt_home), mkhost.letsencrypt.gen_deploy_hook(ctx, letsencrypt_home))
+
+def plan_opendkim(ctx, plan):
+    domains   = mkhost.cfg_parser.get_alias_domains(ctx).union(mkhost.cfg_parser.get_mailbox_domains(ctx))
+    selectors = mkhost.opendkim.current_selectors(ctx)
+    for d in sorted(domains):
+        domain_dir = os.path.join(ctx.cfg.OPENDKIM_KEYS, d)
+        for alg in ctx.cfg.OPENDKIM_KEY_ALGORITHMS:
+            if (d, alg) in selectors:
+                continue
+            selector = mkhost.opendkim.gen_selector(ctx, alg)
+            if alg == "ed25519":
+                pk_path = os.path.join(domain_dir, "{}.private".format(selector))
+                plan.add_cmd(mkhost.opendkim.ed25519_genkey_cmd(pk_path))
+                plan.add_cmd(mkhost.opendkim.ed25519_pubkey_cmd(pk_path))
+            else:
+                plan.add_cmd(mkhost.opendkim.genkey_cmd(d, selector, domain_dir))
+
+    for (path, lines) in ((ctx.cfg.OPENDKIM_KEYTABLE,     mkhost.opendkim.gen_keytable(ctx)),
+                          (ctx.cfg.OPENDKIM_SIGNINGTABLE, mkhost.opendkim.gen_signingtable(ctx))):
+        if plan.add_file(path, lines2text(lines)) and (ctx.cfg.OPENDKIM_TABLE_TYPE == "db"):
+            plan.add_cmd(mkhost.opendkim.db_load_cmd("{}.db".format(path)))
+
+    changed = plan.add_file(ctx.cfg.OPENDKIM_CONF, lines2text(mkhost.opendkim.gen_conf(ctx)))
+    text    = mkhost.opendkim.gen_defaults(ctx)
+    if (text is not None) and plan.add_file(mkhost.opendkim.OPENDKIM_DEFAULTS, text):
+        plan.add_cmd([mkhost.opendkim.OPENDKIM_GENERATE])
+        plan.add_cmd(["systemctl", "daemon-reload"])
+        changed = True
+    if changed:
+        plan.add_cmd(["systemctl", "restart", "opendkim"])
+
+def plan_dovecot(ctx, plan, doveconf, letsencrypt_home):
+    try:
+        text = mkhost.dovecot.gen_config(ctx, doveconf, letsencrypt_home)
+        if text is not None:
+            plan.add_file(doveconf, text)
+    except FileNotFoundError:
+        logging.warning("dovecot configuration file does not exist: {}".format(doveconf))
+
+    def pwd_hash(username):
+        plan.add_cmd(mkhost.dovecot.pwd_hash_cmd(ctx))
+        return "<new password hash>"
+
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        lines = mkhost.maildb.gen_dovecot_conf(ctx)
+        if mkhost.common.file_changed(mkhost.maildb.dovecot_conf_path(ctx), lines2text(lines)):
+            plan.add_file(mkhost.maildb.dovecot_conf_path(ctx), lines2text(lines))
+        plan_maildb(ctx, plan, pwd_hash)
+    else:
+        plan.add_file(ctx.cfg.DOVECOT_USERS_DB, lines2text(mkhost.dovecot.gen_users_db(ctx, pwd_hash)))
+
+# Diffs the rows of the mail database (SQLite backend), dumped as text.
+def plan_maildb(ctx, plan, pwd_hash):
+    conn = mkhost.maildb.connect(ctx)
+    try:
+        old_mailboxes = mkhost.maildb.read_mailboxes(conn)
+        old_aliases   = mkhost.maildb.read_aliases(conn)
+    finally:
+        if conn is not None:
+            conn.close()
+
+    plan.add_text(ctx.cfg.MAIL_DB if (conn is not None) else os.devnull, ctx.cfg.MAIL_DB,
+                  lines2text(mkhost.maildb.dump(old_mailboxes, old_aliases)),
+                  lines2text(mkhost.maildb.dump(mkhost.maildb.gen_mailboxes(ctx, old_mailboxes, pwd_hash),
+                                                mkhost.maildb.gen_aliases(ctx))))
+
+def plan_postfix(ctx, plan, letsencrypt_home):
+    try:
+        mkhost.unix.get_user_info(ctx.cfg.VIRTUAL_MAIL_USER)
+    except KeyError:
+        plan.add_cmd(['useradd', '--system', '--user-group', '--no-create-home', ctx.cfg.VIRTUAL_MAIL_USER])
+
+    if not os.path.isdir(ctx.cfg.VIRTUAL_MAILBOX_BASE):
+        plan.add_cmd(['mkdir', ctx.cfg.VIRTUAL_MAILBOX_BASE])
+
+    (missing, removed) = mkhost.postfix.diff_vmail_dirs(ctx)
+    for x in sorted(missing):
+        if mkhost.storage.current_format(ctx) == "maildir":
+            plan.add_cmd(['mkdir', os.path.join(mkhost.postfix.vmail_home(ctx, x), "mail", "{cur,new,tmp}")])
+        else:
+            plan.add_cmd(['mkdir', mkhost.postfix.vmail_home(ctx, x)])
+    for x in sorted(removed):
+        plan.add_cmd(['mv', mkhost.postfix.vmail_home(ctx, x), os.path.join(ctx.cfg.VIRTUAL_MAILBOX_ARCHIVE, mkhost.common.addr2dom(x))])
+
+    try:
+        dkim_members = grp.getgrnam("opendkim").gr_mem
+    except KeyError:
+        dkim_members = []
+    if "postfix" not in dkim_members:
+        plan.add_cmd(['usermod', '--append', '--groups', 'opendkim', 'postfix'])
+
+    if not os.path.isdir(os.path.dirname(ctx.cfg.OPENDKIM_SOCKET)):
+        plan.add_cmd(['mkdir', os.path.dirname(ctx.cfg.OPENDKIM_SOCKET)])
+
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        for (path, lines) in mkhost.maildb.gen_postfix_cfs(ctx).items():
+            if mkhost.common.file_changed(path, lines2text(lines)):
+                plan.add_file(path, lines2text(lines))
+    else:
+        for (path, lines) in ((ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP, mkhost.postfix.gen_vmailbox_map(ctx)),
+                              (ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP,   mkhost.postfix.gen_valias_map(ctx))):
+            if plan.add_file(path, lines2text(lines)) or not os.path.isfile(path + ".db"):
+                plan.add_cmd(["postmap", path])
+
+    # model postconf edits on top of the current configuration
+    old_conf = read_postconf()
+    new_conf = dict(old_conf)
+    for (key, value) in mkhost.postfix.postconf_settings(ctx, letsencrypt_home):
+        if value is None:
+            if key in new_conf:
+                del new_conf[key]
+                plan.add_cmd(mkhost.postfix.postconf_del_cmd(key))
+        elif new_conf.get(key) != value:
+            new_conf[key] = value
+            plan.add_cmd(mkhost.postfix.postconf_set_cmd(key, value))
+
+    plan.add_text("postconf -n", "postconf -n",
+                  lines2text(["{} = {}".format(k, v) for (k, v) in sorted(old_conf.items())]),
+                  lines2text(["{} = {}".format(k, v) for (k, v) in sorted(new_conf.items())]))
+
+    # model master.cf edits the same way
+    (old_master, old_params) = mkhost.postfix.read_master()
+    new_master = dict(old_master)
+    for (service, entry) in mkhost.postfix.master_settings(ctx):
+        if entry is None:
+            if service in new_master:
+                del new_master[service]
+                plan.add_cmd(mkhost.postfix.master_del_cmd(service))
+        elif new_master.get(service) != mkhost.postfix.master_norm(entry):
+            new_master[service] = mkhost.postfix.master_norm(entry)
+            plan.add_cmd(mkhost.postfix.master_set_cmd(service, entry))
+
+    plan.add_text("postconf -M", "postconf -M",
+                  lines2text([v for (k, v) in sorted(old_master.items())]),
+                  lines2text([v for (k, v) in sorted(new_master.items())]))
+
+    # ... and their parameters (gone with a deleted entry)
+    new_params = {k: v for (k, v) in old_params.items() if k.rsplit('/', 1)[0] in new_master}
+    for (key, value) in mkhost.postfix.master_params(ctx):
+        if new_params.get(key) != value:
+            new_params[key] = value
+            plan.add_cmd(mkhost.postfix.master_param_set_cmd(key, value))
+
+    plan.add_text("postconf -P", "postconf -P",
+                  lines2text(["{} = {}".format(k, v) for (k, v) in sorted(old_params.items())]),
+                  lines2text(["{} = {}".format(k, v) for (k, v) in sorted(new_params.items())]))
+
+# Builds the plan of changes, without applying any of them.
+# Returns a Plan object.
+#
+# Params:
+#   doveconf         : path to the main Dovecot configuration file
+#   letsencrypt_home : Let's Encrypt home dir
+def make_plan(ctx, doveconf, letsencrypt_home):
+    t0   = time.monotonic()
+    plan = Plan()
+
+    if mkhost.storage.current_format(ctx) != ctx.cfg.MAIL_STORAGE_FORMAT:
+        logging.warning("virtual mail is stored in {}, not {} (MAIL_STORAGE_FORMAT): run the migrate command".format(
+            mkhost.storage.current_format(ctx), ctx.cfg.MAIL_STORAGE_FORMAT))
+
+    plan_pkgs(ctx, plan)
+    plan_resolver(ctx, plan)
+    plan_letsencrypt(ctx, plan, letsencrypt_home)
+    plan_opendkim(ctx, plan)
+    plan_dovecot(ctx, plan, doveconf, letsencrypt_home)
+    plan_postfix(ctx, plan, letsencrypt_home)
+    plan_systemd(ctx, plan)
+
+    logging.info("plan computed in {:.3f}s: {} file(s) to change, {} command(s) to run".format(
+        time.monotonic() - t0, len(plan.diffs), len(plan.commands)))
+    return plan
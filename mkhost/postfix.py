@@ -1,13 +1,17 @@
-import copy
+import concurrent.futures
 import logging
 import os
 import re
 import shutil
 import tempfile
 
-import mkhost.cfg
+import mkhost.cfg_parser
+import mkhost.cmd
 import mkhost.common
 import mkhost.letsencrypt
+import mkhost.log
+import mkhost.maildb
+import mkhost.storage
 import mkhost.unix
 
 re_valias    = re.compile(
@@ -15,34 +19,147 @@ re_valias    = re.compile(
 re_vmailbox  = re.compile(
     '^([^@]+)@([^@]+?)\s+(\S+)$', re.ASCII)
 
-def postconf_del(key):
-    mkhost.cmd.execute_cmd(["postconf", "-v", "-#", "{}".format(key)])
+# Postfix queue directory (chroot jail of the Postfix daemons).
+QUEUE_DIR = "/var/spool/postfix"
 
-def postconf_get(key):
-    return mkhost.cmd.execute_cmd(["postconf", "-h", "{}".format(key)])[0][0]
+# Postfix master process configuration file.
+MASTER_CF = "/etc/postfix/master.cf"
 
-def postconf_set(key, value):
-    mkhost.cmd.execute_cmd(["postconf", "-v", "-e", "{}={}".format(key,value)])
+# Dovecot LMTP socket, relative to Postfix queue directory, and the
+# corresponding Postfix transport.
+LMTP_SOCKET    = "private/dovecot-lmtp"
+LMTP_TRANSPORT = "lmtp:unix:{}".format(LMTP_SOCKET)
 
-def postconf_set_multiple(key, values):
+# Milter timeouts: fail fast (see milter_default_action) rather than stall
+# every message on a slow milter reply. Postfix defaults: 30s, 30s, 300s.
+MILTER_CONNECT_TIMEOUT = "10s"
+MILTER_COMMAND_TIMEOUT = "10s"
+MILTER_CONTENT_TIMEOUT = "30s"
+
+# Returns OpenDKIM milter address, as seen by the (chrooted) Postfix daemons.
+def opendkim_milter(ctx):
+    sock = os.path.abspath(ctx.cfg.OPENDKIM_SOCKET)
+    if os.path.commonpath([sock, QUEUE_DIR]) == QUEUE_DIR:
+        sock = os.path.relpath(sock, QUEUE_DIR)
+    return "unix:{}".format(sock)
+
+def postconf_del_cmd(key):
+    return ["postconf", "-v", "-#", "{}".format(key)]
+
+def postconf_del(ctx, key):
+    mkhost.cmd.execute_cmd(ctx, postconf_del_cmd(key))
+
+def postconf_get(ctx, key):
+    return mkhost.cmd.execute_cmd(ctx, ["postconf", "-h", "{}".format(key)])[0][0]
+
+def postconf_set_cmd(key, value):
+    return ["postconf", "-v", "-e", "{}={}".format(key,value)]
+
+def postconf_set(ctx, key, value):
+    mkhost.cmd.execute_cmd(ctx, postconf_set_cmd(key, value))
+
+def postconf_set_multiple(ctx, key, values):
     if values:
-        postconf_set(key, ' '.join(filter(bool, values)))
+        postconf_set(ctx, key, ' '.join(filter(bool, values)))
     else:
-        postconf_del(key)
-
-# Basic Postfix configuration settings using postconf.
+        postconf_del(ctx, key)
+
+def master_del_cmd(service):
+    return ["postconf", "-v", "-MX", "{}".format(service)]
+
+def master_set_cmd(service, entry):
+    return ["postconf", "-v", "-M", "{}={}".format(service, entry)]
+
+def master_param_set_cmd(key, value):
+    return ["postconf", "-v", "-P", "{}={}".format(key, value)]
+
+# Splits the given master.cf service entry fields into the fields proper and
+# the -o parameters ("-o name=value" or "-o { name = value }").
+# Returns a pair of lists: (fields, "name=value" strings).
+def split_master_fields(fields):
+    out    = []
+    params = []
+    i      = 0
+    while i < len(fields):
+        if (fields[i] == "-o") and (i + 1 < len(fields)):
+            j = i + 1
+            if fields[j].startswith("{"):
+                while (j < len(fields) - 1) and not fields[j].endswith("}"):
+                    j += 1
+            params.append(" ".join(fields[i + 1:j + 1]).strip("{} "))
+            i = j + 1
+        else:
+            out.append(fields[i])
+            i += 1
+    return (out, params)
+
+# Given a master.cf service entry, returns it whitespace normalized, without
+# its -o parameters (see read_master).
+def master_norm(entry):
+    return " ".join(split_master_fields(entry.split())[0])
+
+# Reads the current Postfix master.cf file (no subprocess is involved): the
+# service entries and their parameters (-o options), as postconf -M and -P
+# would print them.
+# Returns a pair of dictionaries: (service/type => entry (see master_norm),
+# service/type/parameter => value).
+def read_master():
+    logical = []
+    try:
+        with open(MASTER_CF) as f:
+            for x in map(lambda x: x.rstrip(), f):
+                if mkhost.common.re_comment.match(x) or mkhost.common.re_blank.match(x):
+                    continue
+                if x[0].isspace() and logical:
+                    logical[-1] += " " + x.strip()      # continuation line
+                else:
+                    logical.append(x.strip())
+    except FileNotFoundError as e:
+        logging.warning("cannot read Postfix master.cf: {}".format(e))
+        return ({}, {})
+
+    entries = {}
+    params  = {}
+    for x in logical:
+        (fields, options) = split_master_fields(x.split())
+        if len(fields) < 8:
+            continue
+        service = "{}/{}".format(fields[0], fields[1])
+        entries[service] = " ".join(fields)
+        for y in options:
+            (key, _, val) = y.partition('=')
+            params["{}/{}".format(service, key.strip())] = val.strip()
+    return (entries, params)
+
+# Basic Postfix configuration settings.
+# Returns a list of pairs: (key, value), where value None means "delete".
 #
 # Params:
 #   letsencrypt_home : Let's Encrypt home dir
-def postconf_all(letsencrypt_home):
+def postconf_settings(ctx, letsencrypt_home):
+    settings = []
+
+    # local counterparts of the module-level postconf_* functions: record instead of execute
+    def postconf_set(key, value):
+        settings.append((key, str(value)))
+
+    def postconf_del(key):
+        settings.append((key, None))
+
+    def postconf_set_multiple(key, values):
+        if values:
+            postconf_set(key, ' '.join(filter(bool, sorted(values))))
+        else:
+            postconf_del(key)
+
     postconf_set('biff',                         'no')
     postconf_set('broken_sasl_auth_clients',     'no')
     postconf_set('delay_warning_time',           '4h')
     postconf_set('inet_interfaces',              'all')
     postconf_set('lmtp_sasl_auth_enable',        'no')
     postconf_set('milter_default_action',        'accept')  # see: https://wiki.debian.org/opendkim#Postfix_integration
-    postconf_set('mydomain',                     mkhost.cfg.MY_HOST_DOMAIN)
-    postconf_set('myhostname',                   "{}.{}".format(mkhost.cfg.MY_HOST_NAME, mkhost.cfg.MY_HOST_DOMAIN))
+    postconf_set('mydomain',                     ctx.cfg.MY_HOST_DOMAIN)
+    postconf_set('myhostname',                   "{}.{}".format(ctx.cfg.MY_HOST_NAME, ctx.cfg.MY_HOST_DOMAIN))
     postconf_del('mynetworks')
     postconf_set('mynetworks_style',             'host')
     postconf_set('myorigin',                     '$myhostname')
@@ -62,23 +179,44 @@ def postconf_all(letsencrypt_home):
     # TODO: make this a cfg setting
     postconf_set('smtpd_sasl_auth_enable',       'yes')
     postconf_set('smtpd_tls_auth_only',          'yes')
-    postconf_set('smtpd_tls_cert_file',          mkhost.letsencrypt.cert_path(letsencrypt_home))
-    postconf_set('smtpd_tls_key_file',           mkhost.letsencrypt.key_path(letsencrypt_home))
+    postconf_set('smtpd_tls_cert_file',          mkhost.letsencrypt.cert_path(ctx, letsencrypt_home))
+    postconf_set('smtpd_tls_key_file',           mkhost.letsencrypt.key_path(ctx, letsencrypt_home))
     postconf_set('smtpd_tls_loglevel',           '1')
     postconf_set('smtpd_tls_mandatory_ciphers',  'high')
+    postconf_set('smtpd_tls_mandatory_protocols', '!SSLv2, !SSLv3, !TLSv1, !TLSv1.1')
+    postconf_set('tls_preempt_cipherlist',       'yes')
     postconf_set('smtpd_tls_security_level',     'may')
     postconf_set('smtpd_tls_wrappermode',        'no')
     postconf_set('smtpd_sasl_path',              'private/auth')
     postconf_set('smtpd_sasl_security_options',  'noanonymous noplaintext')
     postconf_set('smtpd_sasl_tls_security_options', 'noanonymous')
 
+    # TLS session caches (server and client side): repeat clients and servers
+    # resume their sessions instead of a full handshake
+    #
+    # http://www.postfix.org/TLS_README.html#server_tls_cache
+    # http://www.postfix.org/TLS_README.html#client_tls_cache
+    for x in ('smtpd', 'smtp'):
+        postconf_set('{}_tls_session_cache_database'.format(x),
+                     '{}:${{data_directory}}/{}_scache'.format(ctx.cfg.TLS_SESSION_CACHE_TYPE, x))
+        postconf_set('{}_tls_session_cache_timeout'.format(x),
+                     '{}s'.format(ctx.cfg.TLS_SESSION_CACHE_TIMEOUT))
+
     # The SASL plug-in type that the Postfix SMTP server should use for authentication.
     # The available types are listed with the "postconf -a" command.
     # http://www.postfix.org/postconf.5.html#smtpd_sasl_type
     # TODO: check if dovecot is available! error if not.
     postconf_set('smtpd_sasl_type',              'dovecot')
 
-    # TODO milter
+    # OpenDKIM milter, over a Unix socket inside Postfix chroot
+    #
+    # http://www.postfix.org/MILTER_README.html
+    postconf_set('smtpd_milters',                opendkim_milter(ctx))
+    postconf_set('non_smtpd_milters',            '$smtpd_milters')
+    postconf_set('milter_protocol',              '6')
+    postconf_set('milter_connect_timeout',       MILTER_CONNECT_TIMEOUT)
+    postconf_set('milter_command_timeout',       MILTER_COMMAND_TIMEOUT)
+    postconf_set('milter_content_timeout',       MILTER_CONTENT_TIMEOUT)
 
     # The directory where local(8) UNIX-style mailboxes are kept. The default setting depends on the system type.
     # Specify a name ending in / for maildir-style delivery.
@@ -88,43 +226,183 @@ def postconf_all(letsencrypt_home):
     # Postfix will not create it.
     #
     # http://www.postfix.org/postconf.5.html#mail_spool_directory
-    postconf_set('mail_spool_directory', mkhost.cfg.LOCAL_MAILBOX_BASE)
+    postconf_set('mail_spool_directory', ctx.cfg.LOCAL_MAILBOX_BASE)
 
     # virtual alias domains
     #
     # http://www.postfix.org/postconf.5.html#virtual_alias_domains
-    postconf_set_multiple('virtual_alias_domains', mkhost.cfg_parser.get_alias_domains())
+    postconf_set_multiple('virtual_alias_domains', mkhost.cfg_parser.get_alias_domains(ctx))
 
     # http://www.postfix.org/postconf.5.html#virtual_alias_maps
-    postconf_set('virtual_alias_maps', "hash:{}".format(mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP))
+    postconf_set('virtual_alias_maps', mkhost.maildb.postfix_map(ctx, ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP))
 
     # virtual mailbox base (aka directory where virtual mail is stored)
     #
     # http://www.postfix.org/postconf.5.html#virtual_mailbox_base
-    postconf_set('virtual_mailbox_base', mkhost.cfg.VIRTUAL_MAILBOX_BASE)
+    postconf_set('virtual_mailbox_base', ctx.cfg.VIRTUAL_MAILBOX_BASE)
 
     # virtual mailbox domains
     #
     # http://www.postfix.org/postconf.5.html#virtual_mailbox_domains
-    postconf_set_multiple('virtual_mailbox_domains', mkhost.cfg_parser.get_mailbox_domains())
+    postconf_set_multiple('virtual_mailbox_domains', mkhost.cfg_parser.get_mailbox_domains(ctx))
 
     # http://www.postfix.org/postconf.5.html#virtual_mailbox_maps
-    postconf_set('virtual_mailbox_maps', "hash:{}".format(mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP))
+    postconf_set('virtual_mailbox_maps', mkhost.maildb.postfix_map(ctx, ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP))
 
     # virtual mail ownership
-    (vm_uid, vm_gid) = mkhost.unix.get_user_info(mkhost.cfg.VIRTUAL_MAIL_USER)
+    try:
+        (vm_uid, vm_gid) = mkhost.unix.get_user_info(ctx.cfg.VIRTUAL_MAIL_USER)
+    except KeyError:
+        # in dry run mode, the user might not have been created (yet)
+        if not ctx.dry_run:
+            raise
+        (vm_uid, vm_gid) = ("<uid of {}>".format(ctx.cfg.VIRTUAL_MAIL_USER),
+                            "<gid of {}>".format(ctx.cfg.VIRTUAL_MAIL_USER))
     postconf_set('virtual_minimum_uid', vm_uid)
     postconf_set('virtual_uid_maps', "static:{}".format(vm_uid))
     postconf_set('virtual_gid_maps', "static:{}".format(vm_gid))
 
-# Generates and writes out virtual alias map file (mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP).
-def write_valias_map():
-    mfwd = copy.deepcopy(mkhost.cfg.MAIL_FORWARDING)
+    # postscreen(8): clients which talk before their turn (greet) or which are
+    # listed in the DNS blocklists (weighted sum of the listings) are rejected;
+    # the others are allowlisted (cached), and handed over to smtpd
+    #
+    # http://www.postfix.org/POSTSCREEN_README.html
+    if ctx.cfg.POSTFIX_POSTSCREEN:
+        postconf_set('postscreen_access_list',      'permit_mynetworks')
+        postconf_set('postscreen_greet_action',     'enforce')
+        postconf_set('postscreen_dnsbl_action',     'enforce')
+        postconf_set_multiple('postscreen_dnsbl_sites', ctx.cfg.POSTFIX_POSTSCREEN_DNSBL_SITES)
+        postconf_set('postscreen_dnsbl_threshold',  ctx.cfg.POSTFIX_POSTSCREEN_DNSBL_THRESHOLD)
+    else:
+        for key in ('postscreen_access_list', 'postscreen_greet_action', 'postscreen_dnsbl_action',
+                    'postscreen_dnsbl_sites', 'postscreen_dnsbl_threshold'):
+            postconf_del(key)
+
+    # virtual mail delivery: Postfix virtual(8) writes maildirs only, other
+    # storage formats are delivered by Dovecot LDA (see master_settings), unless
+    # Dovecot LMTP delivers all of them
+    #
+    # http://www.postfix.org/postconf.5.html#virtual_transport
+    # https://doc.dovecot.org/configuration_manual/howto/postfix_dovecot_lmtp/
+    agent = mkhost.storage.delivery_agent(ctx, mkhost.storage.current_format(ctx))
+    if agent == "lmtp":
+        postconf_set('virtual_transport',                   LMTP_TRANSPORT)
+        postconf_del('dovecot_destination_recipient_limit')
+    elif agent == "lda":
+        postconf_set('virtual_transport',                   'dovecot')
+        postconf_set('dovecot_destination_recipient_limit', '1')
+    else:
+        postconf_del('virtual_transport')
+        postconf_del('dovecot_destination_recipient_limit')
+
+    return settings
+
+# Applies basic Postfix configuration settings using postconf.
+#
+# Params:
+#   letsencrypt_home : Let's Encrypt home dir
+def postconf_all(ctx, letsencrypt_home):
+    for (key, value) in postconf_settings(ctx, letsencrypt_home):
+        if value is None:
+            postconf_del(ctx, key)
+        else:
+            postconf_set(ctx, key, value)
+
+
+# Postfix master.cf service entries.
+# Returns a list of pairs: (service/type, entry), where entry None means "delete".
+#
+# http://www.postfix.org/master.5.html
+def master_settings(ctx):
+    settings = []
+
+    # SMTP server (port 25), behind postscreen(8) if enabled: postscreen (a
+    # single process) handles all the inbound connections and drops the bots,
+    # before handing the others over to smtpd processes; DNS blocklist lookups
+    # and STARTTLS are delegated to dnsblog(8) and tlsproxy(8)
+    #
+    # http://www.postfix.org/POSTSCREEN_README.html
+    if ctx.cfg.POSTFIX_POSTSCREEN:
+        settings.append(("smtp/inet",      "smtp inet n - y - 1 postscreen"))
+        settings.append(("smtpd/pass",     "smtpd pass - - y - - smtpd"))
+        settings.append(("dnsblog/unix",   "dnsblog unix - - y - 0 dnsblog"))
+        settings.append(("tlsproxy/unix",  "tlsproxy unix - - y - 0 tlsproxy"))
+    else:
+        settings.append(("smtp/inet",      "smtp inet n - y - - smtpd"))
+        settings.append(("smtpd/pass",     None))
+        settings.append(("dnsblog/unix",   None))
+        settings.append(("tlsproxy/unix",  None))
+
+    # Mail submission (port 587), for authenticated users only, with its own
+    # process limit: inbound mail floods cannot starve it (see master_params)
+    #
+    # http://www.postfix.org/SASL_README.html#server_submission
+    if ctx.cfg.POSTFIX_SUBMISSION_MAXPROC:
+        settings.append(("submission/inet", "submission inet n - y - {} smtpd".format(ctx.cfg.POSTFIX_SUBMISSION_MAXPROC)))
+    else:
+        settings.append(("submission/inet", None))
+
+    # Dovecot local delivery agent, run as the virtual mail user
+    #
+    # https://doc.dovecot.org/configuration_manual/howto/dovecot_lda_postfix/
+    if mkhost.storage.delivery_agent(ctx, mkhost.storage.current_format(ctx)) == "lda":
+        settings.append(("dovecot/unix",
+                         "dovecot unix - n n - - pipe flags=DRhu user={}:{} "
+                         "argv=/usr/lib/dovecot/dovecot-lda -f ${{sender}} -a ${{original_recipient}} -d ${{user}}@${{nexthop}}".format(
+                             ctx.cfg.VIRTUAL_MAIL_USER, ctx.cfg.VIRTUAL_MAIL_USER)))
+    else:
+        settings.append(("dovecot/unix", None))
+
+    return settings
+
+# Postfix master.cf service parameters (-o options of the services enabled in
+# master_settings).
+# Returns a list of pairs: (service/type/parameter, value).
+#
+# http://www.postfix.org/postconf.1.html
+def master_params(ctx):
+    params = []
+
+    if ctx.cfg.POSTFIX_SUBMISSION_MAXPROC:
+        for (key, value) in (('syslog_name',                  'postfix/submission'),
+                             ('smtpd_tls_security_level',     'encrypt'),
+                             ('smtpd_tls_auth_only',          'yes'),
+                             ('smtpd_sasl_auth_enable',       'yes'),
+                             ('smtpd_client_restrictions',    'permit_sasl_authenticated,reject'),
+                             ('smtpd_relay_restrictions',     'permit_sasl_authenticated,reject'),
+                             ('smtpd_recipient_restrictions', 'permit_sasl_authenticated,reject')):
+            params.append(("submission/inet/{}".format(key), value))
+
+    return params
+
+# Applies Postfix master.cf service entries and their parameters using
+# postconf; unchanged ones are left as they are.
+def master_all(ctx):
+    (old_entries, _) = read_master()
+    for (service, entry) in master_settings(ctx):
+        if entry is None:
+            if service in old_entries:
+                mkhost.cmd.execute_cmd(ctx, master_del_cmd(service))
+        elif old_entries.get(service) != master_norm(entry):
+            mkhost.cmd.execute_cmd(ctx, master_set_cmd(service, entry))
+
+    # (read after the entries: a replaced entry loses its parameters)
+    (_, old_params) = read_master()
+    for (key, value) in master_params(ctx):
+        if old_params.get(key) != value:
+            mkhost.cmd.execute_cmd(ctx, master_param_set_cmd(key, value))
+
+# Generates virtual alias map file (mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP).
+# Returns a list of lines.
+def gen_valias_map(ctx):
+    table = mkhost.cfg_parser.get_addr_table(ctx)
+    found = bytearray(table.num_sources())     # source index => 1 if the mapping already exists
 
     # Parse the existing virtual alias map file
     old_lines = []
+    ev_delete = mkhost.log.Events(ctx, "postfix.mapping.delete", "[postfix] delete mapping: {}", "[postfix] deleted {} mappings")
     try:
-        with open(mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP) as f:
+        with open(ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP) as f:
             for line in map(lambda x: x.rstrip(), f):
                 if mkhost.common.re_comment.match(line):
                     old_lines.append(line)
@@ -139,64 +417,75 @@ def write_valias_map():
                         taddr1 = m.group(3)         # 1st target address
                         taddrs = list(filter(bool, map(lambda x: x.strip(), m.group(4).split(','))))
 
-                        # logging.debug("suser  : {}#".format(suser))
-                        # logging.debug("sdom   : {}#".format(sdom))
-                        # logging.debug("taddr1 : {}#".format(taddr1))
-                        # logging.debug("taddrs : {}#".format(taddrs))
-
                         saddr = "{}@{}".format(suser, sdom)     # source address
                         taddrs.insert(0,taddr1)
-                        # logging.debug("taddrs : {}#".format(taddrs))
 
-                        if (saddr in mfwd):
-                            # logging.debug("mapping already exists: {}".format(saddr))
-                            mto = mkhost.common.tolist(mfwd[saddr])
-                            # logging.debug("mto: {}".format(mto))
+                        sid = table.lookup(saddr)
+                        si  = -1 if (sid is None) else table.source_index(sid)
 
-                            # taddrs_set = set(taddrs)
-                            # mto_set    = set(mto)
-                            # logging.debug("taddrs_set: {}".format(taddrs_set))
-                            # logging.debug("   mto_set: {}".format(mto_set))
+                        if (si >= 0) and not found[si]:
+                            mto = list(map(table.addr, table.targets(si)))
 
                             if (len(taddrs) == len(mto)) and (set(taddrs) == set(mto)):
-                                logging.debug("[postfix] mapping already exists: {} => {}".format(saddr, mto))
+                                mkhost.log.debug("[postfix] mapping already exists: {} => {}", saddr, mto)
                                 old_lines.append(line)
-                                del mfwd[saddr]
+                                found[si] = 1
                             else:
-                                logging.info("[postfix] delete mapping: {} => {}".format(saddr, taddrs))
+                                ev_delete.add("{} => {}".format(saddr, taddrs))
                         else:
-                            logging.info("[postfix] delete mapping: {}".format(saddr))
+                            ev_delete.add(saddr)
                     else:
-                        logging.warning("{}: invalid line: {}".format(mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP, line))
+                        logging.warning("{}: invalid line: {}".format(ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP, line))
     except FileNotFoundError:
-        logging.warning("Postfix virtual alias map file does not exist: {}".format(mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP))
+        logging.warning("Postfix virtual alias map file does not exist: {}".format(ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP))
+
+    ev_delete.close()
+
+    lines = old_lines
+    if 0 in found:
+        lines.append(mkhost.common.mkhost_header(ctx))
+        with mkhost.log.Events(ctx, "postfix.mapping.create", "[postfix] create mapping: {} => {}", "[postfix] created {} mappings") as ev:
+            for si in range(table.num_sources()):
+                if not found[si]:
+                    x  = table.addr(table.source(si))
+                    ys = list(map(table.addr, table.targets(si)))
+                    ev.add(x, ys)
+                    lines.append("{}    {}".format(x, ", ".join(ys)))
+
+    return lines
+
+# Generates and writes out virtual alias map file (mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP).
+# Rebuilds the lookup table with postmap, unless postmap is False.
+# Returns True if the file has been written.
+def write_valias_map(ctx, postmap=True):
+    lines = gen_valias_map(ctx)
 
     # create new virtual alias map file
     with tempfile.NamedTemporaryFile(mode="wt", prefix="mkhost-", delete=True) as f:
         logging.debug("temp file: {}".format(f.name))
-        if old_lines:
-            print(os.linesep.join(old_lines), file=f)
-        if mfwd:
-            print(mkhost.common.mkhost_header(), file=f)
-            for x in mfwd:
-                ys = mkhost.common.tolist(mfwd[x])
-                logging.info("create mapping: {} => {}".format(x, ys))
-                print("{}    {}".format(x, ", ".join(ys)), file=f)
+        if lines:
+            print(os.linesep.join(lines), file=f)
 
         # overwrite old user db file
-        if not mkhost.common.get_dry_run():
+        if not ctx.dry_run:
             f.flush()
-            shutil.copyfile(f.name, mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP)
-            mkhost.cmd.execute_cmd(["postmap", mkhost.cfg.POSTFIX_VIRTUAL_ALIAS_MAP])
+            shutil.copyfile(f.name, ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP)
+            if postmap:
+                mkhost.cmd.execute_cmd(ctx, ["postmap", ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP])
+            return True
 
-# Generates and writes out virtual mailbox map file (mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP).
-def write_vmailbox_map():
-    vboxes = mkhost.cfg_parser.get_virtual_mailboxes()
+    return False
+
+# Generates virtual mailbox map file (mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP).
+# Returns a list of lines.
+def gen_vmailbox_map(ctx):
+    vboxes = mkhost.cfg_parser.get_virtual_mailboxes(ctx)
 
     # Parse the existing virtual mailbox map file
     old_lines = []
+    ev_delete = mkhost.log.Events(ctx, "postfix.mailbox.delete", "[postfix] delete mailbox: {}@{}", "[postfix] deleted {} mailboxes")
     try:
-        with open(mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP) as f:
+        with open(ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP) as f:
             for line in map(lambda x: x.rstrip(), f):
                 if mkhost.common.re_comment.match(line):
                     old_lines.append(line)
@@ -215,54 +504,219 @@ def write_vmailbox_map():
                         # logging.debug("path     : {}#".format(path))
 
                         # TODO: make the 2nd lookup more effective?...
-                        if (domain in mkhost.cfg.MAILBOXES) and (username in mkhost.cfg.MAILBOXES[domain]):
-                            logging.debug("[postfix] mailbox already exists: {}@{}".format(username, domain))
+                        if (domain in ctx.cfg.MAILBOXES) and (username in ctx.cfg.MAILBOXES[domain]):
+                            mkhost.log.debug("[postfix] mailbox already exists: {}@{}", username, domain)
                             old_lines.append(line)
                             vboxes.remove("{}@{}".format(username, domain))
                         else:
-                            logging.info("[postfix] delete mailbox: {}@{}".format(username, domain))
+                            ev_delete.add(username, domain)
                     else:
-                        logging.warning("{}: invalid line: {}".format(mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP, line))
+                        logging.warning("{}: invalid line: {}".format(ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP, line))
     except FileNotFoundError:
-        logging.warning("Postfix virtual mailbox map file does not exist: {}".format(mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP))
+        logging.warning("Postfix virtual mailbox map file does not exist: {}".format(ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP))
+
+    ev_delete.close()
+
+    lines = old_lines
+    if vboxes:
+        lines.append(mkhost.common.mkhost_header(ctx))
+        with mkhost.log.Events(ctx, "postfix.mailbox.create", "[postfix] create mailbox: {}@{}", "[postfix] created {} mailboxes") as ev:
+            for x in vboxes:
+                xp = mkhost.common.parse_addr(x)
+                ev.add(xp[0], xp[1])
+                lines.append("{}@{}    {}/{}/mail/".format(xp[0],xp[1],xp[1],xp[0]))
+
+    return lines
+
+# Generates and writes out virtual mailbox map file (mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP).
+# Rebuilds the lookup table with postmap, unless postmap is False.
+# Returns True if the file has been written.
+def write_vmailbox_map(ctx, postmap=True):
+    lines = gen_vmailbox_map(ctx)
 
     # create new virtual mailbox map file
     with tempfile.NamedTemporaryFile(mode="wt", prefix="mkhost-", delete=True) as f:
         logging.debug("temp file: {}".format(f.name))
-        if old_lines:
-            print(os.linesep.join(old_lines), file=f)
-        if vboxes:
-            print(mkhost.common.mkhost_header(), file=f)
-            for x in vboxes:
-                xp = mkhost.common.parse_addr(x)
-                logging.info("[postfix] create mailbox: {}@{}".format(xp[0],xp[1]))
-                print("{}@{}    {}/{}/mail/".format(xp[0],xp[1],xp[1],xp[0]), file=f)
+        if lines:
+            print(os.linesep.join(lines), file=f)
 
         # overwrite old user db file
-        if not mkhost.common.get_dry_run():
+        if not ctx.dry_run:
             f.flush()
-            shutil.copyfile(f.name, mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP)
-            mkhost.cmd.execute_cmd(["postmap", mkhost.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP])
+            shutil.copyfile(f.name, ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP)
+            if postmap:
+                mkhost.cmd.execute_cmd(ctx, ["postmap", ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP])
+            return True
+
+    return False
 
 # Creates a system user for owning virtual mail files.
-def setup_vmail_user():
-    mkhost.unix.add_system_user(mkhost.cfg.VIRTUAL_MAIL_USER)
+def setup_vmail_user(ctx):
+    mkhost.unix.add_system_user(ctx, ctx.cfg.VIRTUAL_MAIL_USER)
 
 # Creates virtual mail dir(s).
-def setup_vmail_dirs():
-    if not os.path.isdir(mkhost.cfg.VIRTUAL_MAILBOX_BASE):
-        (vm_uid, vm_gid) = mkhost.unix.get_user_info(mkhost.cfg.VIRTUAL_MAIL_USER)
-        if not mkhost.common.get_dry_run():
-            mkhost.unix.makedir(mkhost.cfg.VIRTUAL_MAILBOX_BASE, vm_uid, vm_gid)
+def setup_vmail_dirs(ctx):
+    if not os.path.isdir(ctx.cfg.VIRTUAL_MAILBOX_BASE):
+        (vm_uid, vm_gid) = mkhost.unix.get_user_info(ctx.cfg.VIRTUAL_MAIL_USER)
+        if not ctx.dry_run:
+            mkhost.unix.makedir(ctx.cfg.VIRTUAL_MAILBOX_BASE, vm_uid, vm_gid)
+
+# Given a virtual mailbox address, returns its home directory (under
+# VIRTUAL_MAILBOX_BASE). Mail is stored in the "mail" maildir of the home
+# directory (see mail_location in Dovecot configuration).
+def vmail_home(ctx, addr):
+    (user, domain) = mkhost.common.parse_addr(addr)
+    return os.path.join(ctx.cfg.VIRTUAL_MAILBOX_BASE, domain, user)
+
+# Scans VIRTUAL_MAILBOX_BASE for virtual mailbox home directories
+# (domain/user). Returns a set of addresses.
+def scan_vmail_dirs(ctx):
+    addrs = set()
+    try:
+        with os.scandir(ctx.cfg.VIRTUAL_MAILBOX_BASE) as ds:
+            for d in ds:
+                if d.is_dir(follow_symlinks=False):
+                    with os.scandir(d.path) as us:
+                        addrs.update("{}@{}".format(u.name, d.name) for u in us if u.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        pass
+    return addrs
+
+# Returns True if the maildir of the given virtual mailbox is complete (mail,
+# mail/cur, mail/new and mail/tmp directories), or if mail is not stored in
+# maildir format (created by Dovecot on first delivery).
+def vmail_dir_complete(ctx, addr):
+    if mkhost.storage.current_format(ctx) != "maildir":
+        return True
+    maildir = os.path.join(vmail_home(ctx, addr), "mail")
+    return all(os.path.isdir(os.path.join(maildir, x)) for x in ("cur", "new", "tmp"))
+
+# Compares the virtual mailboxes declared in MAILBOXES with those on disk.
+# Returns a pair of sets of addresses: (missing or incomplete on disk, removed
+# from MAILBOXES).
+def diff_vmail_dirs(ctx):
+    wanted   = mkhost.cfg_parser.get_virtual_mailboxes(ctx)
+    existing = scan_vmail_dirs(ctx)
+    missing  = wanted.difference(existing)
+    missing.update(x for x in wanted.intersection(existing) if not vmail_dir_complete(ctx, x))
+    return (missing, existing.difference(wanted))
+
+# Creates a directory (mode 0700) owned by the given uid and gid, unless it
+# already exists.
+def _mkdir_owned(path, uid, gid):
+    if os.path.isdir(path):
+        return
+    os.mkdir(path, mode=0o700)
+    os.chown(path, uid, gid)
+
+# Creates the home directory and the (empty) maildir of a virtual mailbox, or
+# whatever is missing of them. Other storage formats are created by Dovecot
+# on first delivery.
+def create_vmail_dir(ctx, addr, uid, gid):
+    home    = vmail_home(ctx, addr)
+    maildir = os.path.join(home, "mail")
+    _mkdir_owned(home, uid, gid)
+    if mkhost.storage.current_format(ctx) != "maildir":
+        return
+    _mkdir_owned(maildir, uid, gid)
+    for x in ("cur", "new", "tmp"):
+        _mkdir_owned(os.path.join(maildir, x), uid, gid)
+
+# Moves the home directory of a removed virtual mailbox to
+# VIRTUAL_MAILBOX_ARCHIVE/domain/user.timestamp
+def archive_vmail_dir(ctx, addr):
+    (user, domain) = mkhost.common.parse_addr(addr)
+    dst_dir = os.path.join(ctx.cfg.VIRTUAL_MAILBOX_ARCHIVE, domain)
+    os.makedirs(dst_dir, mode=0o700, exist_ok=True)
+    shutil.move(vmail_home(ctx, addr), os.path.join(
+        dst_dir, "{}.{}".format(user, ctx.run_ts.strftime("%Y%m%d%H%M%S"))))
+
+# Provisions virtual mailbox directories: creates the maildirs of new
+# mailboxes (and completes the incomplete ones) and moves the removed ones to
+# VIRTUAL_MAILBOX_ARCHIVE, once confirmed (interactive mode). File system
+# operations are run in a thread pool.
+#
+# Params:
+#   archive : if False, leave the removed mailboxes in place (watch mode)
+def provision_vmail_dirs(ctx, archive=True):
+    (missing, removed) = diff_vmail_dirs(ctx)
+    if ctx.dry_run:
+        mkhost.log.info("[postfix] maildirs to create: {}, to archive: {}",
+                        mkhost.log.fmt_count(len(missing)), mkhost.log.fmt_count(len(removed) if archive else 0))
+        return
+
+    if removed and not archive:
+        logging.info("[postfix] {} maildirs removed from MAILBOXES left in place; run mkhost.py to archive them".format(
+            len(removed)))
+        removed = set()
+    elif removed and not mkhost.cmd.confirm(ctx, "Archive the maildirs of {} mailboxes removed from MAILBOXES ({}) to {}?".format(
+            len(removed), " ".join(sorted(removed)[:5]) + (" ..." if len(removed) > 5 else ""), ctx.cfg.VIRTUAL_MAILBOX_ARCHIVE)):
+        logging.info("[postfix] {} maildirs removed from MAILBOXES left in place (not confirmed)".format(len(removed)))
+        removed = set()
+
+    (vm_uid, vm_gid) = mkhost.unix.get_user_info(ctx.cfg.VIRTUAL_MAIL_USER)
+
+    # domain directories first (shared by mailboxes)
+    for d in sorted(mkhost.common.addr2dom(missing)):
+        _mkdir_owned(os.path.join(ctx.cfg.VIRTUAL_MAILBOX_BASE, d), vm_uid, vm_gid)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ctx.max_concurrency) as pool:
+        with mkhost.log.Events(ctx, "postfix.maildir.create", "[postfix] create maildir: {}", "[postfix] created {} maildirs") as ev:
+            for (x, f) in [(x, pool.submit(create_vmail_dir, ctx, x, vm_uid, vm_gid)) for x in sorted(missing)]:
+                f.result()
+                ev.add(x)
+        with mkhost.log.Events(ctx, "postfix.maildir.archive", "[postfix] archive maildir: {}", "[postfix] archived {} maildirs") as ev:
+            for (x, f) in [(x, pool.submit(archive_vmail_dir, ctx, x)) for x in sorted(removed)]:
+                f.result()
+                ev.add(x)
+
+# Creates OpenDKIM milter socket directory (inside Postfix chroot), owned by
+# OpenDKIM user and Postfix group. Postfix user joins OpenDKIM group, so that
+# it can connect to the socket (see UMask in OpenDKIM configuration).
+def setup_milter_dir(ctx):
+    sock_dir = os.path.dirname(ctx.cfg.OPENDKIM_SOCKET)
+    mkhost.unix.add_user_to_group(ctx, "postfix", "opendkim")
+    if not os.path.isdir(sock_dir):
+        logging.info("[postfix] create milter socket directory: {}".format(sock_dir))
+        if not ctx.dry_run:
+            (dkim_uid, _) = mkhost.unix.get_user_info("opendkim")
+            (_, pf_gid)   = mkhost.unix.get_user_info("postfix")
+            mkhost.unix.makedir(sock_dir, dkim_uid, pf_gid)
+            os.chmod(sock_dir, 0o750)
+
+# Returns the list of packages required by Postfix setup.
+def packages(ctx):
+    pkgs = ["postfix"]
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        pkgs.append("postfix-sqlite")
+    if ctx.cfg.TLS_SESSION_CACHE_TYPE == "lmdb":
+        pkgs.append("postfix-lmdb")
+    return pkgs
 
 # Installs and configures Postfix.
 #
 # Params:
 #   letsencrypt_home : Let's Encrypt home dir
-def install(letsencrypt_home):
-    mkhost.unix.install_pkgs(["postfix"])
-    setup_vmail_user()
-    setup_vmail_dirs()
-    write_vmailbox_map()
-    write_valias_map()
-    postconf_all(letsencrypt_home)
+def install(ctx, letsencrypt_home):
+    mkhost.unix.install_pkgs(ctx, packages(ctx))
+    setup_vmail_user(ctx)
+    setup_vmail_dirs(ctx)
+    provision_vmail_dirs(ctx)
+    setup_milter_dir(ctx)
+
+    if ctx.cfg.MAIL_BACKEND == "sqlite":
+        # virtual users (Dovecot), mailboxes and aliases: database rows
+        mkhost.maildb.write_postfix_cfs(ctx)
+        mkhost.maildb.sync_mailboxes(ctx)
+        mkhost.maildb.sync_aliases(ctx)
+    else:
+        # rebuild both lookup tables concurrently
+        maps = []
+        if write_vmailbox_map(ctx, postmap=False):
+            maps.append(ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP)
+        if write_valias_map(ctx, postmap=False):
+            maps.append(ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP)
+        mkhost.cmd.run_many(ctx, [["postmap", x] for x in maps], batch=True)
+
+    postconf_all(ctx, letsencrypt_home)
+    master_all(ctx)
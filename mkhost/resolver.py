@@ -0,0 +1,182 @@
+import logging
+import os
+import os.path
+import random
+import shutil
+import socket
+import struct
+import time
+
+import mkhost.cmd
+import mkhost.common
+import mkhost.postfix
+import mkhost.unix
+
+##############################################################################
+# Local caching DNS resolver (unbound), listening on the loopback interface:
+# MX lookups (and DNS blocklist lookups, see postscreen) are answered from
+# the cache, and popular entries are refreshed before they expire (prefetch).
+#
+# The system resolver (/etc/resolv.conf) points at it, and so does Postfix
+# (a copy of resolv.conf inside Postfix chroot jail), once it has answered a
+# test query. The original resolv.conf is saved (in MKHOST_STATE_DIR) and
+# restored once RESOLVER_LOCAL is turned off.
+#
+# https://unbound.docs.nlnetlabs.nl/en/latest/manpages/unbound.conf.html
+##############################################################################
+
+UNBOUND_CONF = "/etc/unbound/unbound.conf.d/mkhost.conf"
+RESOLV_CONF  = "/etc/resolv.conf"
+
+# Returns the path of the saved original system resolver configuration.
+def saved_resolv_conf_path(ctx):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "resolv.conf.orig")
+
+# Returns True if the IPv6 loopback address (::1) is configured on this
+# machine.
+def has_ipv6_loopback():
+    try:
+        with open("/proc/net/if_inet6") as f:
+            return any(x.split()[0] == "0" * 31 + "1" for x in f if x.strip())
+    except FileNotFoundError:
+        return False
+
+# Returns the resolver settings tuned to this machine: one thread per CPU (at
+# most 8), and about 3% of the memory for the caches (at most 768 MB).
+# Returns a dictionary: setting => value.
+def settings():
+    threads = min(8, os.cpu_count() or 1)
+    slabs   = 1 << (threads - 1).bit_length()       # power of 2, >= threads
+    msg_mb  = max(4, min(256, mkhost.unix.mem_size() // (96 << 20)))
+    return {
+        "num-threads"            : threads,
+        "msg-cache-slabs"        : slabs,
+        "rrset-cache-slabs"      : slabs,
+        "infra-cache-slabs"      : slabs,
+        "key-cache-slabs"        : slabs,
+        "msg-cache-size"         : "{}m".format(msg_mb),
+        "rrset-cache-size"       : "{}m".format(2 * msg_mb),
+        "outgoing-range"         : 8192,
+        "num-queries-per-thread" : 4096,
+        "so-reuseport"           : "yes",
+        "prefetch"               : "yes",
+        "prefetch-key"           : "yes",
+        "serve-expired"          : "yes",
+    }
+
+# Generates unbound configuration file.
+# Returns a list of lines.
+def gen_conf(ctx):
+    lines = [mkhost.common.mkhost_header(ctx),
+             "server:",
+             "    interface: 127.0.0.1"]
+    if has_ipv6_loopback():
+        lines.append("    interface: ::1")
+    lines.extend("    {}: {}".format(k, v) for (k, v) in settings().items())
+    return lines
+
+# Generates the system resolver configuration: the existing one (search
+# domains, options...), with the local resolver as the only name server.
+# Returns the file text.
+def gen_resolv_conf():
+    try:
+        with open(RESOLV_CONF) as f:
+            lines = [x.rstrip() for x in f if not x.startswith("nameserver")]
+    except FileNotFoundError:
+        lines = []
+    return os.linesep.join(lines + ["nameserver 127.0.0.1"]) + os.linesep
+
+# Sends a test query (SOA record of the root zone, over UDP) to the local
+# resolver, until it answers or the given number of attempts is reached (the
+# resolver may have just been restarted).
+# Returns True if the local resolver has answered the query (NOERROR).
+#
+# Params:
+#   attempts : max number of queries
+#   timeout  : time to wait for an answer to each query, in seconds
+def test_query(attempts=5, timeout=1.0):
+    qid   = random.getrandbits(16)
+    query = struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0) + b"\x00" + struct.pack("!HH", 6, 1)
+    for i in range(attempts):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            try:
+                sock.sendto(query, ("127.0.0.1", 53))
+                answer = sock.recv(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                time.sleep(timeout)     # not listening (yet)
+                continue
+        if len(answer) < 12:
+            continue
+        (aid, flags) = struct.unpack("!HH", answer[:4])
+        if (aid == qid) and (flags & 0x8000) and not (flags & 0x000f):
+            return True
+        logging.debug("[resolver] test query: rcode {}".format(flags & 0x000f))
+    return False
+
+# Points the system resolver and Postfix at the local resolver, if it answers
+# (see test_query).
+def setup_resolv_conf(ctx):
+    if os.path.islink(RESOLV_CONF):
+        logging.warning("[resolver] {} is a symbolic link (managed by {}): point it at 127.0.0.1 yourself".format(
+            RESOLV_CONF, os.path.realpath(RESOLV_CONF)))
+        return
+
+    if not (ctx.dry_run or test_query()):
+        logging.warning("[resolver] no answer from the local resolver (127.0.0.1), {} left unchanged: check unbound".format(
+            RESOLV_CONF))
+        return
+
+    # keep the original, to be restored (see restore_resolv_conf)
+    saved = saved_resolv_conf_path(ctx)
+    if os.path.isfile(RESOLV_CONF) and not os.path.exists(saved) and not ctx.dry_run:
+        logging.info("[resolver] saving {} to {}".format(RESOLV_CONF, saved))
+        os.makedirs(os.path.dirname(saved), mode=0o700, exist_ok=True)
+        shutil.copyfile(RESOLV_CONF, saved)
+
+    mkhost.common.write_file(ctx, RESOLV_CONF, gen_resolv_conf())
+    copy_resolv_conf(ctx)
+
+# Copies the system resolver configuration to Postfix chroot jail (chrooted
+# Postfix daemons read their own copy).
+def copy_resolv_conf(ctx):
+    chroot_etc = os.path.join(mkhost.postfix.QUEUE_DIR, "etc")
+    if os.path.isdir(chroot_etc) and not ctx.dry_run:
+        shutil.copyfile(RESOLV_CONF, os.path.join(chroot_etc, "resolv.conf"))
+
+# Restores the original system resolver configuration (saved by
+# setup_resolv_conf), if any, for the system and Postfix.
+def restore_resolv_conf(ctx):
+    saved = saved_resolv_conf_path(ctx)
+    if not os.path.isfile(saved):
+        return
+
+    logging.info("[resolver] restoring {} from {}".format(RESOLV_CONF, saved))
+    if os.path.islink(RESOLV_CONF):
+        logging.warning("[resolver] {} is a symbolic link (managed by {}): not restored".format(
+            RESOLV_CONF, os.path.realpath(RESOLV_CONF)))
+    else:
+        with open(saved) as f:
+            mkhost.common.write_file(ctx, RESOLV_CONF, f.read())
+        copy_resolv_conf(ctx)
+    if not ctx.dry_run:
+        os.remove(saved)
+
+# Returns the list of packages required by the resolver setup.
+def packages(ctx):
+    return ["unbound"] if ctx.cfg.RESOLVER_LOCAL else []
+
+# Installs and configures the local caching resolver (if RESOLVER_LOCAL);
+# restores the original system resolver configuration otherwise.
+def install(ctx):
+    if not ctx.cfg.RESOLVER_LOCAL:
+        restore_resolv_conf(ctx)
+        return
+
+    mkhost.unix.install_pkgs(ctx, packages(ctx))
+    if mkhost.common.write_file(ctx, UNBOUND_CONF, os.linesep.join(gen_conf(ctx)) + os.linesep) and not ctx.dry_run:
+        mkhost.cmd.execute_cmd(ctx, ["unbound-checkconf"])
+        mkhost.cmd.execute_cmd(ctx, ["systemctl", "restart", "unbound"])
+    setup_resolv_conf(ctx)
@@ -0,0 +1,181 @@
+import logging
+import os
+import os.path
+import time
+
+import mkhost.cfg_parser
+import mkhost.cmd
+import mkhost.dovecot
+import mkhost.log
+import mkhost.postfix
+
+# Virtual mailbox storage formats (see MAIL_STORAGE_FORMAT in cfg.py) and
+# their Dovecot mail locations, relative to the mailbox home directory.
+#
+# https://doc.dovecot.org/admin_manual/mailbox_formats/
+LOCATIONS = {
+    "maildir" : "maildir:~/mail/",
+    "sdbox"   : "sdbox:~/sdbox/",
+    "mdbox"   : "mdbox:~/mdbox/",
+}
+
+# Returns the path of the file recording the current storage format.
+def state_path(ctx):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "storage-format")
+
+# Returns the storage format the virtual mail is currently stored in, which
+# is what Dovecot and Postfix are configured for. This differs from
+# MAIL_STORAGE_FORMAT until the mail has been migrated (see migrate).
+#
+# Mail stored before the format was first recorded is maildir, unless there is
+# no virtual mailbox directory yet (new machine): then MAIL_STORAGE_FORMAT is
+# used straight away.
+def current_format(ctx):
+    if ctx.storage_format is None:
+        try:
+            with open(state_path(ctx)) as f:
+                ctx.storage_format = f.read().strip()
+        except FileNotFoundError:
+            ctx.storage_format = "maildir" if mkhost.postfix.scan_vmail_dirs(ctx) else ctx.cfg.MAIL_STORAGE_FORMAT
+    return ctx.storage_format
+
+# Records the current storage format (except in dry run mode).
+def set_current_format(ctx, fmt):
+    ctx.storage_format = fmt
+    if not ctx.dry_run:
+        os.makedirs(ctx.cfg.MKHOST_STATE_DIR, mode=0o700, exist_ok=True)
+        with open(state_path(ctx) + ".tmp", "w") as f:
+            print(fmt, file=f)
+        os.replace(state_path(ctx) + ".tmp", state_path(ctx))
+
+# Returns the agent which delivers virtual mail stored in the given format:
+#
+#   "virtual" : Postfix virtual(8) (writes maildirs only)
+#   "lda"     : Dovecot LDA, run by Postfix pipe(8) (other formats)
+#   "lmtp"    : Dovecot LMTP (any format, if MAIL_DELIVERY is "lmtp")
+def delivery_agent(ctx, fmt):
+    if ctx.cfg.MAIL_DELIVERY == "lmtp":
+        return "lmtp"
+    return "virtual" if (fmt == "maildir") else "lda"
+
+# Records the current storage format, if not recorded yet; warns if the mail
+# has yet to be migrated to MAIL_STORAGE_FORMAT.
+def install(ctx):
+    fmt = current_format(ctx)
+    if not os.path.isfile(state_path(ctx)):
+        set_current_format(ctx, fmt)
+    if fmt != ctx.cfg.MAIL_STORAGE_FORMAT:
+        logging.warning("virtual mail is stored in {}, not {} (MAIL_STORAGE_FORMAT): run the migrate command".format(
+            fmt, ctx.cfg.MAIL_STORAGE_FORMAT))
+
+##############################################################################
+# Storage format migration.
+#
+# 1. every mailbox is copied to the new format with dsync, while mail is
+#    delivered and read as usual, in batches of MAIL_MIGRATE_CONCURRENCY
+#    mailboxes (throttled on MAIL_MIGRATE_MAX_LOAD); the mailboxes done are
+#    checkpointed, so that an interrupted migration resumes where it stopped
+# 2. virtual mail delivery is put on hold (queued by Postfix), every mailbox
+#    gets a final (incremental, fast) dsync, then Dovecot mail location and
+#    Postfix delivery are switched over and delivery resumes
+#
+# The mail in the old format is left in place (rollback: migrate back).
+##############################################################################
+
+# Returns the path of the checkpoint file of the migration to the given format.
+def checkpoint_path(ctx, fmt):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "migrate-{}.done".format(fmt))
+
+# Returns the set of mailboxes already copied to the given format.
+def read_checkpoint(ctx, fmt):
+    try:
+        with open(checkpoint_path(ctx, fmt)) as f:
+            return set(x.strip() for x in f if x.strip())
+    except FileNotFoundError:
+        return set()
+
+# Returns dsync command which copies the mail of the given user (as stored in
+# the current format) to the given format.
+def dsync_cmd(username, fmt):
+    return ["doveadm", "backup", "-u", username, LOCATIONS[fmt]]
+
+# Waits while the system load is above MAIL_MIGRATE_MAX_LOAD.
+def throttle(ctx):
+    max_load = ctx.cfg.MAIL_MIGRATE_MAX_LOAD or (os.cpu_count() or 1)
+    while os.getloadavg()[0] > max_load:
+        mkhost.log.debug("[storage] load average {:.2f} above {}, pausing", os.getloadavg()[0], max_load)
+        time.sleep(5)
+
+# Copies the mail of the given users to the given format, in parallel batches.
+# Every user done is appended to the given checkpoint stream (if not None).
+def dsync_all(ctx, usernames, fmt, checkpoint=None):
+    async def dsync(username):
+        await mkhost.cmd.execute_cmd_batch_async(ctx, dsync_cmd(username, fmt))
+        if checkpoint is not None:
+            print(username, file=checkpoint, flush=True)
+        ev.add(username)
+
+    batch_size = ctx.cfg.MAIL_MIGRATE_CONCURRENCY
+    with mkhost.log.Events(ctx, "storage.dsync", "[storage] copied to {}: {{}}".format(fmt), "[storage] copied {} mailboxes") as ev:
+        for i in range(0, len(usernames), batch_size):
+            throttle(ctx)
+            mkhost.cmd.run_async(*(dsync(x) for x in usernames[i:i + batch_size]))
+
+# Returns the name of the Postfix transport (master.cf service) virtual mail
+# is delivered with, in the given storage format.
+def delivery_transport(ctx, fmt):
+    return {"virtual": "virtual", "lda": "dovecot", "lmtp": "lmtp"}[delivery_agent(ctx, fmt)]
+
+# Migrates virtual mail from the current storage format to MAIL_STORAGE_FORMAT.
+#
+# Params:
+#   doveconf         : path to the main Dovecot configuration file
+#   letsencrypt_home : Let's Encrypt home dir
+def migrate(ctx, doveconf, letsencrypt_home):
+    (src, dst) = (current_format(ctx), ctx.cfg.MAIL_STORAGE_FORMAT)
+    if src == dst:
+        logging.info("[storage] virtual mail is already stored in {}".format(dst))
+        return
+
+    usernames = sorted(mkhost.cfg_parser.get_virtual_mailboxes(ctx).intersection(mkhost.postfix.scan_vmail_dirs(ctx)))
+    done      = read_checkpoint(ctx, dst)
+    pending   = [x for x in usernames if x not in done]
+    logging.info("[storage] migrate {} mailboxes from {} to {}: {} already copied".format(
+        mkhost.log.fmt_count(len(usernames)), src, dst, mkhost.log.fmt_count(len(usernames) - len(pending))))
+
+    if ctx.dry_run:
+        for x in pending:
+            logging.info(" ".join(dsync_cmd(x, dst)))
+        return
+
+    # 1. bulk copy, resumable
+    ctx.max_concurrency = ctx.cfg.MAIL_MIGRATE_CONCURRENCY
+    os.makedirs(ctx.cfg.MKHOST_STATE_DIR, mode=0o700, exist_ok=True)
+    with open(checkpoint_path(ctx, dst), "a") as checkpoint:
+        dsync_all(ctx, pending, dst, checkpoint)
+
+    # 2. switch over, with delivery on hold
+    mkhost.postfix.postconf_set(ctx, 'defer_transports', delivery_transport(ctx, src))
+    mkhost.cmd.execute_cmd(ctx, ["postfix", "reload"])
+    try:
+        dsync_all(ctx, usernames, dst)
+
+        set_current_format(ctx, dst)
+        try:
+            mkhost.dovecot.write_config(ctx, doveconf, letsencrypt_home)
+            mkhost.postfix.postconf_all(ctx, letsencrypt_home)
+            mkhost.postfix.master_all(ctx)
+        except Exception:
+            set_current_format(ctx, src)
+            mkhost.dovecot.write_config(ctx, doveconf, letsencrypt_home)
+            mkhost.postfix.postconf_all(ctx, letsencrypt_home)
+            mkhost.postfix.master_all(ctx)
+            raise
+        mkhost.cmd.execute_cmd(ctx, ["doveadm", "reload"])
+    finally:
+        mkhost.postfix.postconf_del(ctx, 'defer_transports')
+        mkhost.cmd.execute_cmd(ctx, ["postfix", "reload"])
+        mkhost.cmd.execute_cmd(ctx, ["postqueue", "-f"])
+
+    os.remove(checkpoint_path(ctx, dst))
+    logging.info("[storage] virtual mail is now stored in {} (mail in {} left in place)".format(dst, src))
@@ -0,0 +1,86 @@
+import os
+import os.path
+
+import mkhost.cmd
+import mkhost.common
+import mkhost.unix
+
+##############################################################################
+# systemd drop-ins for the mail services: resource limits sized from this
+# machine, and CPU / IO weights between the services.
+#
+# Dovecot login processes in high-performance mode and Postfix smtpd
+# processes each hold many connections (file descriptors), beyond the
+# distribution default limits. The drop-ins are written to
+# /etc/systemd/system/<unit>.d/mkhost.conf; systemd is reloaded once (if any
+# drop-in has changed), and only the services whose drop-in has changed are
+# restarted (resource limits apply to new processes).
+#
+# https://www.freedesktop.org/software/systemd/man/systemd.resource-control.html
+# https://www.freedesktop.org/software/systemd/man/systemd.exec.html
+##############################################################################
+
+SYSTEMD_DIR = "/etc/systemd/system"
+
+# Mail services: service name => (unit the drop-in applies to, unit to restart).
+# On Debian, Postfix runs as postfix@-.service (part of postfix.service).
+UNITS = {
+    "postfix"  : ("postfix@.service",  "postfix.service"),
+    "dovecot"  : ("dovecot.service",   "dovecot.service"),
+    "opendkim" : ("opendkim.service",  "opendkim.service"),
+}
+
+# Returns the drop-in file path of the given unit.
+def dropin_path(unit):
+    return os.path.join(SYSTEMD_DIR, "{}.d".format(unit), "mkhost.conf")
+
+# Returns the max number of file descriptors a process may be allowed to open
+# on this machine (kernel limit).
+def nr_open():
+    try:
+        with open("/proc/sys/fs/nr_open") as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 1048576
+
+# Returns the resource settings of the given service, sized from this machine:
+# a file descriptor per 16 KB of memory (at least 16384), and 256 tasks per
+# CPU (at least 4096) for Postfix and Dovecot; a sixteenth of that for
+# OpenDKIM (a single, multi-threaded process).
+# Returns a list of pairs: (setting, value).
+def settings(ctx, service):
+    nofile = max(16384, min(nr_open(), mkhost.unix.mem_size() // (16 << 10)))
+    tasks  = max(4096, 256 * (os.cpu_count() or 1))
+    if service == "opendkim":
+        (nofile, tasks) = (max(4096, nofile // 16), max(512, tasks // 16))
+
+    xs = [("LimitNOFILE", nofile),
+          ("TasksMax",    tasks),
+          ("CPUWeight",   ctx.cfg.SYSTEMD_CPU_WEIGHT.get(service, 100)),
+          ("IOWeight",    ctx.cfg.SYSTEMD_IO_WEIGHT.get(service, 100))]
+    if service in ctx.cfg.SYSTEMD_CPU_AFFINITY:
+        xs.append(("CPUAffinity", ctx.cfg.SYSTEMD_CPU_AFFINITY[service]))
+    return xs
+
+# Generates the drop-in of the given service.
+# Returns the file text.
+def gen_dropin(ctx, service):
+    lines = [mkhost.common.mkhost_header(ctx), "[Service]"]
+    lines.extend("{}={}".format(k, v) for (k, v) in settings(ctx, service))
+    return os.linesep.join(lines) + os.linesep
+
+# Generates the drop-ins of all the mail services.
+# Returns a dictionary: service => (path, file text).
+def gen_dropins(ctx):
+    return {x: (dropin_path(unit), gen_dropin(ctx, x)) for (x, (unit, _)) in UNITS.items()}
+
+# Installs the drop-ins of the mail services (if SYSTEMD_DROPINS); reloads
+# systemd and restarts the services (if running) whose drop-in has changed.
+def install(ctx):
+    if not ctx.cfg.SYSTEMD_DROPINS:
+        return
+
+    changed = [UNITS[x][1] for (x, (path, text)) in sorted(gen_dropins(ctx).items()) if mkhost.common.write_file(ctx, path, text)]
+    if changed and not ctx.dry_run:
+        mkhost.cmd.execute_cmd(ctx, ["systemctl", "daemon-reload"])
+        mkhost.cmd.execute_cmd(ctx, ["systemctl", "try-restart"] + changed)
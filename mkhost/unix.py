@@ -5,7 +5,10 @@ import pwd
 import subprocess
 
 import mkhost.cmd
-import mkhost.common
+
+# Returns the physical memory size of this machine (bytes).
+def mem_size():
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
 
 # Atomically creates a directory owned by the given uid and gid.
 def makedir(path, uid, gid):
@@ -20,30 +23,49 @@ def makedir(path, uid, gid):
 
 # Returns the apt-get command with some default arguments applied.
 # A list.
-def apt_get_cmd(*args):
-    return ["apt-get"]                                                        +       \
-               (["--dry-run"] if mkhost.common.get_dry_run()         else []) +       \
-               (["--yes"]     if mkhost.common.get_non_interactive() else []) +       \
+def apt_get_cmd(ctx, *args):
+    return ["apt-get"]                                             +       \
+               (["--dry-run"] if ctx.dry_run         else []) +       \
+               (["--yes"]     if ctx.non_interactive else []) +       \
                list(args)
 
-def update_pkgs():
-    if not mkhost.common.get_dry_run():
-        mkhost.cmd.execute_cmd(apt_get_cmd("update"))
-        mkhost.cmd.execute_cmd(apt_get_cmd("upgrade"))
+def update_pkgs(ctx):
+    if not ctx.dry_run:
+        mkhost.cmd.execute_cmd(ctx, apt_get_cmd(ctx, "update"))
+        mkhost.cmd.execute_cmd(ctx, apt_get_cmd(ctx, "upgrade"))
+
+# Returns the set of installed packages, as recorded in dpkg status file
+# (no subprocess is involved).
+def get_installed_pkgs(status_file="/var/lib/dpkg/status"):
+    pkgs    = set()
+    package = None
+    try:
+        with open(status_file) as f:
+            for line in f:
+                if line.startswith("Package:"):
+                    package = line.partition(':')[2].strip()
+                elif line.startswith("Status:") and package:
+                    if line.split()[-1] == "installed":
+                        pkgs.add(package)
+                elif not line.strip():
+                    package = None
+    except FileNotFoundError:
+        logging.warning("dpkg status file does not exist: {}".format(status_file))
+    return pkgs
 
-def install_pkgs(pkgs):
+def install_pkgs(ctx, pkgs):
     if pkgs:
-        mkhost.cmd.execute_cmd(apt_get_cmd("install", *pkgs))
+        mkhost.cmd.execute_cmd(ctx, apt_get_cmd(ctx, "install", *pkgs))
 
 ##############################################################################
 # user management functions (system)
 ##############################################################################
 
-def add_system_user(username):
+def add_system_user(ctx, username):
     # TODO: validate username
     try:
         logging.info("[unix] add system user: {}".format(username))
-        if not mkhost.common.get_dry_run():
+        if not ctx.dry_run:
             mkhost.cmd.execute_cmd_batch(['useradd', '--system', '--user-group', '--no-create-home', '--comment', 'mkhost virtual mail owner', username])
     except subprocess.CalledProcessError as e:
         if 9 == e.returncode:
@@ -51,6 +73,12 @@ def add_system_user(username):
         else:
             raise
 
+# Adds the given (existing) user to the given (existing) supplementary group.
+def add_user_to_group(ctx, username, group):
+    logging.info("[unix] add user {} to group {}".format(username, group))
+    if not ctx.dry_run:
+        mkhost.cmd.execute_cmd_batch(['usermod', '--append', '--groups', group, username])
+
 # For the given user name, returns a tuple: (uid, gid).
 def get_user_info(username):
     pwinfo = pwd.getpwnam(username)
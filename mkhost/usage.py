@@ -0,0 +1,143 @@
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import os.path
+import re
+
+import mkhost.common
+import mkhost.log
+import mkhost.postfix
+import mkhost.storage
+
+# Mailbox storage usage, for capacity planning (e.g. quota decisions).
+#
+# Every virtual mailbox maildir (and its Maildir++ folders) is scanned for
+# messages (files in "cur" and "new"). Per-directory results are cached in
+# MKHOST_STATE_DIR, keyed by directory mtime: maildir messages are never
+# modified in place (a flag change is a rename), hence a directory whose mtime
+# has not changed need not be listed again.
+
+# Message size, as added to the file name by Dovecot (e.g. ...,S=1234:2,S).
+re_msg_size = re.compile(r',S=(\d+)')
+
+def cache_path(ctx):
+    return os.path.join(ctx.cfg.MKHOST_STATE_DIR, "usage.json")
+
+# Reads the per-directory cache.
+# Returns a dictionary: directory path => [mtime (ns), messages, bytes].
+def read_cache(ctx):
+    try:
+        with open(cache_path(ctx)) as f:
+            cache = json.load(f)
+        if cache.get("version") == list(mkhost.common.get_version()):
+            return cache["dirs"]
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError, AttributeError) as e:
+        logging.warning("ignoring usage cache {}: {}".format(cache_path(ctx), e))
+    return {}
+
+def write_cache(ctx, dirs):
+    os.makedirs(ctx.cfg.MKHOST_STATE_DIR, mode=0o700, exist_ok=True)
+    tmp_path = cache_path(ctx) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": mkhost.common.get_version(), "dirs": dirs}, f)
+    os.replace(tmp_path, cache_path(ctx))
+
+# Counts messages in a single maildir directory ("cur" or "new").
+# Returns a pair: (messages, bytes).
+def scan_msg_dir(path):
+    (n, size) = (0, 0)
+    with os.scandir(path) as xs:
+        for x in xs:
+            m = re_msg_size.search(x.name)
+            if m:
+                size += int(m.group(1))
+            else:
+                try:
+                    size += x.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue    # expunged meanwhile
+            n += 1
+    return (n, size)
+
+# Scans the maildir of a single virtual mailbox, using the given
+# (read-only) cache.
+# Returns a tuple: (messages, bytes, dictionary of scanned directories).
+def scan_mailbox(ctx, addr, cache):
+    maildir = os.path.join(mkhost.postfix.vmail_home(ctx, addr), "mail")
+    folders = [maildir]
+    try:
+        with os.scandir(maildir) as xs:
+            folders.extend(x.path for x in xs if x.name.startswith('.') and x.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        return (0, 0, {})
+
+    (n, size, dirs) = (0, 0, {})
+    for folder in folders:
+        for sub in ("cur", "new"):
+            path = os.path.join(folder, sub)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            entry = cache.get(path)
+            if (entry is None) or (entry[0] != mtime):
+                entry = [mtime, *scan_msg_dir(path)]
+            dirs[path] = entry
+            n    += entry[1]
+            size += entry[2]
+    return (n, size, dirs)
+
+# Scans all the virtual mailboxes found under VIRTUAL_MAILBOX_BASE, in
+# parallel. The cache is updated, except in dry run mode.
+# Returns a pair of dictionaries: (mailbox => [messages, bytes], domain => [messages, bytes]).
+def scan(ctx):
+    if mkhost.storage.current_format(ctx) != "maildir":
+        logging.warning("[usage] virtual mail is stored in {}: only maildirs are scanned".format(mkhost.storage.current_format(ctx)))
+
+    cache     = read_cache(ctx)
+    new_cache = {}
+    mailboxes = {}
+    domains   = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ctx.max_concurrency) as pool:
+        with mkhost.log.Events(ctx, "usage.mailbox", "[usage] {}: {} messages, {} bytes", "[usage] scanned {} mailboxes") as ev:
+            addrs = sorted(mkhost.postfix.scan_vmail_dirs(ctx))
+            for (x, (n, size, dirs)) in zip(addrs, pool.map(lambda x: scan_mailbox(ctx, x, cache), addrs)):
+                ev.add(x, n, size)
+                mailboxes[x] = [n, size]
+                d = domains.setdefault(mkhost.common.addr2dom(x), [0, 0])
+                d[0] += n
+                d[1] += size
+                new_cache.update(dirs)
+
+    rescanned = sum(1 for (k, v) in new_cache.items() if cache.get(k) != v)
+    mkhost.log.info("[usage] {} directories, {} rescanned",
+                    mkhost.log.fmt_count(len(new_cache)), mkhost.log.fmt_count(rescanned))
+    if not ctx.dry_run:
+        write_cache(ctx, new_cache)
+    return (mailboxes, domains)
+
+def report_json(mailboxes, domains, out):
+    json.dump({"mailboxes": {k: {"messages": v[0], "bytes": v[1]} for (k, v) in mailboxes.items()},
+               "domains":   {k: {"messages": v[0], "bytes": v[1]} for (k, v) in sorted(domains.items())}},
+              out, indent=2)
+    out.write(os.linesep)
+
+def report_csv(mailboxes, domains, out):
+    w = csv.writer(out)
+    w.writerow(["kind", "name", "messages", "bytes"])
+    w.writerows(["mailbox", k, v[0], v[1]] for (k, v) in mailboxes.items())
+    w.writerows(["domain",  k, v[0], v[1]] for (k, v) in sorted(domains.items()))
+
+# Scans virtual mailboxes and writes the usage report to the given stream.
+#
+# Params:
+#   fmt : report format: "json" or "csv"
+#   out : output stream
+def report(ctx, fmt, out):
+    (mailboxes, domains) = scan(ctx)
+    (report_csv if fmt == "csv" else report_json)(mailboxes, domains, out)
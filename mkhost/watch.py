@@ -0,0 +1,181 @@
+import datetime
+import logging
+import os
+import time
+
+import mkhost.cfg_parser
+import mkhost.cmd
+import mkhost.common
+import mkhost.dovecot
+import mkhost.letsencrypt
+import mkhost.log
+import mkhost.maildb
+import mkhost.opendkim
+import mkhost.postfix
+
+##############################################################################
+# Watch mode: the configuration file (cfg.py) is polled for changes, and only
+# the generators depending on what has actually changed are rerun.
+#
+# The configuration file is re-executed into a fresh namespace; the settings
+# of the configuration (of the run context) are replaced only if the file
+# runs and validates, so that a half-edited file never gets applied.
+##############################################################################
+
+POLL_INTERVAL = 0.2     # seconds between 2 checks of the configuration file
+DEBOUNCE      = 0.5     # seconds the file must stay unchanged before it is applied
+
+# Returns the stat signature of the given file: (inode, size, mtime), or None
+# if the file does not exist.
+def file_sig(path):
+    try:
+        st = os.stat(path)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+# Returns the settings (upper case names) of the configuration of the given
+# run context as a dictionary.
+def cfg_settings(ctx):
+    return {k: v for (k, v) in vars(ctx.cfg).items() if k.isupper()}
+
+# Replaces the settings of the configuration of the given run context with the
+# given ones.
+def set_cfg_settings(ctx, settings):
+    for k in list(cfg_settings(ctx)):
+        delattr(ctx.cfg, k)
+    for (k, v) in settings.items():
+        setattr(ctx.cfg, k, v)
+
+# Executes the given configuration file.
+# Returns its settings as a dictionary.
+def load_cfg(ctx, path):
+    with open(path) as f:
+        code = compile(f.read(), path, "exec")
+    ns = {"__name__": ctx.cfg.__name__, "__file__": path}
+    exec(code, ns)
+    return {k: v for (k, v) in ns.items() if k.isupper()}
+
+# Computes the sets derived from the current configuration which the
+# generators depend on.
+# Returns a dictionary.
+def derive(ctx):
+    return {
+        "mailboxes"       : frozenset(mkhost.cfg_parser.get_virtual_mailboxes(ctx)),
+        "forwarding"      : {k: tuple(mkhost.common.tolist(v)) for (k, v) in ctx.cfg.MAIL_FORWARDING.items()},
+        "mailbox_domains" : frozenset(mkhost.cfg_parser.get_mailbox_domains(ctx)),
+        "alias_domains"   : frozenset(mkhost.cfg_parser.get_alias_domains(ctx)),
+    }
+
+# Given 2 configurations (settings and derived sets, before and after),
+# applies the changes.
+#
+# Params:
+#   letsencrypt_home : Let's Encrypt home dir
+def apply_changes(ctx, old_settings, old_derived, new_settings, new_derived, letsencrypt_home):
+    changed = set(k for k in new_derived if old_derived[k] != new_derived[k])
+
+    # settings other than the ones watched: full run required
+    others = sorted(k for k in set(old_settings).union(new_settings)
+                    if (k not in ("MAILBOXES", "MAIL_FORWARDING")) and
+                       (repr(old_settings.get(k)) != repr(new_settings.get(k))))
+    if others:
+        logging.warning("[watch] changed settings not applied in watch mode: {}; run mkhost.py to apply them".format(
+            " ".join(others)))
+
+    if not changed:
+        logging.info("[watch] no change to apply")
+        return
+
+    logging.info("[watch] changed: {}".format(" ".join(sorted(changed))))
+    maps        = []
+    reload_pf   = False
+    dns_records = len(ctx.dns_log)
+
+    sqlite = (ctx.cfg.MAIL_BACKEND == "sqlite")
+
+    if "mailboxes" in changed:
+        mkhost.postfix.provision_vmail_dirs(ctx, archive=False)
+        if sqlite:
+            mkhost.maildb.sync_mailboxes(ctx)
+        else:
+            mkhost.dovecot.write_users_db(ctx)
+            if mkhost.postfix.write_vmailbox_map(ctx, postmap=False):
+                maps.append(ctx.cfg.POSTFIX_VIRTUAL_MAILBOX_MAP)
+
+    if "forwarding" in changed:
+        if sqlite:
+            mkhost.maildb.sync_aliases(ctx)
+        elif mkhost.postfix.write_valias_map(ctx, postmap=False):
+            maps.append(ctx.cfg.POSTFIX_VIRTUAL_ALIAS_MAP)
+
+    if changed.intersection(("mailbox_domains", "alias_domains")):
+        if ctx.cfg.X509_MAIL_HOST_PREFIX and ("mailbox_domains" in changed):
+            mkhost.letsencrypt.install(ctx, letsencrypt_home)
+        # keys for the new domains only: the existing keys (and their DNS records) stay
+        added = new_derived["mailbox_domains"].union(new_derived["alias_domains"]).difference(
+                    old_derived["mailbox_domains"].union(old_derived["alias_domains"]))
+        mkhost.opendkim.setup_keys(ctx, new_domains=added)
+        if not ctx.dry_run:
+            mkhost.cmd.execute_cmd(ctx, ["systemctl", "reload", "opendkim"])
+        mkhost.postfix.postconf_all(ctx, letsencrypt_home)
+        reload_pf = True
+
+    if not ctx.dry_run:
+        mkhost.cmd.run_many(ctx, [["postmap", x] for x in maps], batch=True)
+        if reload_pf:
+            mkhost.cmd.execute_cmd(ctx, ["postfix", "reload"])
+
+    if len(ctx.dns_log) > dns_records:
+        logging.warning("List of DNS changes to apply:{}{}".format(
+            2 * os.linesep, os.linesep.join(ctx.dns_log.records[dns_records:])))
+
+# Watches the configuration file and applies its changes, in the given run
+# context (see mkhost.context), until interrupted. Every change applied is a
+# run of its own (timestamp).
+#
+# Params:
+#   ctx              : run context (configuration and settings)
+#   letsencrypt_home : Let's Encrypt home dir
+def watch(ctx, letsencrypt_home):
+    path     = ctx.cfg.__file__
+    sig      = file_sig(path)
+    settings = cfg_settings(ctx)
+    derived  = derive(ctx)
+    logging.info("[watch] watching {}".format(path))
+
+    while True:
+        time.sleep(POLL_INTERVAL)
+        if file_sig(path) == sig:
+            continue
+
+        # debounce: wait until the file has stopped changing
+        new_sig = file_sig(path)
+        while True:
+            time.sleep(DEBOUNCE)
+            x = file_sig(path)
+            if x == new_sig:
+                break
+            new_sig = x
+        sig = new_sig
+
+        t0 = time.monotonic()
+        try:
+            new_settings = load_cfg(ctx, path)
+            set_cfg_settings(ctx, new_settings)
+            mkhost.cfg_parser.validate(ctx)
+            new_derived = derive(ctx)
+        except Exception as e:
+            logging.error("[watch] {}: {}; keeping the previous configuration".format(path, e))
+            set_cfg_settings(ctx, settings)
+            continue
+
+        ctx.run_ts = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            apply_changes(ctx, settings, derived, new_settings, new_derived, letsencrypt_home)
+        except Exception as e:
+            # keep the previous baseline, so that the next change retries
+            logging.error("[watch] cannot apply changes: {}".format(e))
+            continue
+        (settings, derived) = (new_settings, new_derived)
+        logging.info("[watch] applied in {:.3f}s".format(time.monotonic() - t0))